@@ -1,235 +1,465 @@
 """
-Contains the entire program, the other py files
-are just old files.
+Contains the GUI of the program. The upload logic lives in
+upload_core.py so that uploader_cli.py can share it without
+loading PyQt5.
 """
 import os
+import queue
+import threading
+import time
 
 from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtCore import QThreadPool, QRunnable, QObject, pyqtSignal, pyqtSlot
-from PyQt5.QtWidgets import QFileDialog, QMessageBox
+from PyQt5.QtCore import QThreadPool, QRunnable, QObject, QThread, pyqtSignal, pyqtSlot
+from PyQt5.QtWidgets import QFileDialog, QInputDialog, QMessageBox
 
-import glob
-from robobrowser import RoboBrowser
+import journal
+import scheduling
+import upload_core
+import validation
+from change_detection import ChangeDetector, find_changed
+from concurrency import AdaptiveLimit
+from file_table import FileTableModel, RowStatus, StatusUpdates
+from journal import Journal, file_hash
+from metrics import timings
+from retry import RetryPolicy, RetryScheduler
+from scheduling import FairScheduler, PRIORITY_FAILED, PRIORITY_NORMAL, number_order
+from upload_core import CANCELLED, UPLOADED, request_counts, session_manager, sign_in, upload_object, scan_objects
+from validation import validate_all, validate_file
 
-"""
-The max number of concurrent threads active
-in the thread pool.
-10 workers so the website is not overloaded
-with excessive uploading / parsing of the XML files
-This might be able to go higher, we just have to experiment
-"""
-max_threads = 10
+# How often status changes from the engines are applied to the table, in milliseconds
+update_interval = 66
+# How often the phase timings in the status bar are refreshed, in seconds
+timings_interval = 1.0
+# The environment variable startup_benchmark.py sets to have the program quit once its window is shown
+STARTUP_BENCHMARK_VARIABLE = 'DOH_UPLOADER_STARTUP_BENCHMARK'
 
 """
-Program logic
-"""
-"""
-The session that will be used by
-all browser instances to access the
-collections. Set in sign_in()
+Main UI stuff
 """
-global_session = None
-# The base URL of the DOH Arca website
-base_url = 'https://doh.arcabc.ca'
 
 
-def sign_in(username, password):
+def upload(items, row_index, controller=None, cancel=None):
     """
-    Signs into the DOH website and sets the global session
-    to allow other browser instances to access the cookies
-    :param username: the username to login with
-    :param password: the password to login with
+    Helper method that initiates the upload process. Called by
+    any Worker in the threadpool.
+    :param items: the cells of the row being processed, as text.
+    :param row_index: the index of the row being processed
+    :param controller: the AdaptiveLimit to report the latency and errors to
+    :param cancel: the threading.Event set when the upload session is cancelled
+    :return: the result of the upload as a tuple with the outcome
+    (see upload_core.outcome_of) and the row index.
     """
-    # If already logged in, don't log in again
-    global global_session
-    if global_session is not None:
-        return True
-    # Create Non-JS browser
-    browser = RoboBrowser(parser='html.parser')
-    # Open login page
-    browser.open('https://doh.arcabc.ca/user/login')
-    # Get the login form
-    form = browser.get_form(id='user-login')
-    # Set the username & password
-    form['name'].value = username
-    form['pass'].value = password
-    # Submit the form
-    browser.submit_form(form)
-    # If successfully signed in
-    h1 = browser.find(class_='page__title')
-    if h1.text == username:
-        # Set the global session
-        global_session = browser.session
-        return True
-    else:
-        return False
-
-
-def get_lock_link(links):
+    result = (upload_object(items[2], items[0], items[1], controller, cancel), row_index)
+    return result
+
+
+class Worker(QRunnable):
     """
-    Gets the link that allows to lock a
-    collection object in order to modify it
-    :param links: the list of links on the current page of the browser
-    :return: the href of the correct link to acquire the lock
+    Worker class that processes a single table widget row
+    i.e. a single collection object
+    https://www.learnpyqt.com/courses/concurrent-execution/multithreading-pyqt-applications-qthreadpool/
     """
-    for link in links:
-        if link.text == 'acquire the lock':
-            return link['href']
 
+    def __init__(self, fn, updates, retries, finished, *args, **kwargs):
+        """
+        :param fn: the function processing the row
+        :param updates: the StatusUpdates the progress of the row is reported to
+        :param retries: the RetryScheduler to put the row in if it is to be tried again
+        :param finished: the function called with the items of the row once it is processed
+        """
+        super(Worker, self).__init__()
+        self.fn = fn
+        self.updates = updates
+        self.retries = retries
+        self.finished = finished
+        self.args = args
+        self.kwargs = kwargs
+
+    @pyqtSlot()
+    def run(self):
+        items, row_index = self.args
+        self.updates.put(row_index, RowStatus.RUNNING)
+        try:
+            outcome, row_index = self.fn(items, row_index, **self.kwargs)
+            if self.retries.schedule(row_index, (row_index, items), outcome):
+                self.updates.put(row_index, RowStatus.RETRYING)
+            elif outcome == UPLOADED:
+                self.updates.put(row_index, RowStatus.SUCCEEDED)
+            elif outcome == CANCELLED:
+                self.updates.put(row_index, RowStatus.CANCELLED)
+            else:
+                self.updates.put(row_index, RowStatus.FAILED)
+        except Exception as e:
+            # The row must still end, or the upload session never finishes
+            print("Could not upload " + items[0] + ":" + items[1] + ": " + str(e))
+            self.updates.put(row_index, RowStatus.FAILED)
+        finally:
+            self.finished(items)
 
-def get_unlock_link(links):
+
+class LimitSignals(QObject):
     """
-    Gets the link that allows to unlock a
-    collection object in order to let others to modify it again
-    :param links: the list of links on the current page of the browser
-    :return: the href of the correct link to release the lock
+    Carries changes of the concurrency limit, which happen
+    on worker threads, over to the GUI thread
     """
-    for link in links:
-        if link.text == 'release':
-            return link['href']
+    changed = pyqtSignal(int)
 
 
-def acquire_lock(browser, manage_url):
+class FolderScanThread(QThread):
     """
-    Acquires the lock of a collection object in order to modify it
-    :param browser: the browser that is currently browsing the collection object
-    :param manage_url: the management url of the object to acquire the lock of
-    :return: a boolean indicating if the acquisition was successful
+    Scans a folder for MODS XML files (upload_core.scan_objects), hashes
+    and validates them (validation.py) without blocking the UI. The files
+    are handed over in small batches as they are found so uploads can
+    start right away.
     """
-    try:
-        browser.open(manage_url)
-        lock_link = get_lock_link(browser.get_links())
-
-        if lock_link is not None:
-            global base_url
-            # Open the link to lock
-            browser.open(base_url + lock_link)
-            # Find the form by class and submit it
-            browser.submit_form(browser.get_form(class_='confirmation'))
-            # Success
-            return True
-        # Failed to acquire lock because someone else
-        # has locked this object
-        else:
-            return False
-    # Any error indicates failure
-    except Exception as e:
-        return False
+    found = pyqtSignal(list)
 
+    def __init__(self, folder, validate=True, batch_size=500, batch_interval=0.2):
+        """
+        :param folder: the root folder to scan
+        :param validate: whether to check the files are valid MODS
+        :param batch_size: the max number of files in a batch
+        :param batch_interval: the max number of seconds a found file waits before being handed over
+        """
+        super(FolderScanThread, self).__init__()
+        self.folder = folder
+        self.validate = validate
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.stopped = False
 
-def release_lock(browser, manage_url):
+    def stop(self):
+        """
+        Stops the scan after the current file
+        :return: None
+        """
+        self.stopped = True
+
+    def hashed_objects(self):
+        """
+        :return: an iterator over the (repository, number, path, content_hash)
+        tuples of the files found, until the scan is stopped
+        """
+        for repository, number, path in scan_objects(self.folder, upload_core.scan_threads):
+            if self.stopped:
+                return
+            try:
+                # The content hash identifies the file in the journal
+                yield repository, number, path, file_hash(path)
+            except Exception as e:
+                print(e)
+
+    def run(self):
+        # Rows are (repository, number, path, content_hash, error), error being None if the file is valid
+        batch = []
+        objects = self.hashed_objects()
+        if self.validate:
+            objects = validate_all(objects, schema_file=validation.schema_path,
+                                   on_invalid=lambda obj, error: batch.append(obj + (error,)))
+        last_batch = time.monotonic()
+        for obj in objects:
+            batch.append(obj + (None,))
+            if len(batch) >= self.batch_size or time.monotonic() - last_batch >= self.batch_interval:
+                self.found.emit(batch)
+                batch = []
+                last_batch = time.monotonic()
+        self.found.emit(batch)
+
+
+class FolderWatchThread(QThread):
     """
-    Releases the lock of a collection object in order to let others
-    modify it.
-    :param browser: the browser that is currently browsing the collection object
-    :param manage_url: the management url of the object to release the lock of
+    Watches the folder once it is scanned (watch.py), hashing and validating
+    the files dropped or edited in it, which are handed over the same way as
+    the files the folder scan finds
     """
-    try:
-        browser.open(manage_url)
-        unlock_link = get_unlock_link(browser.get_links())
-        # if unlock_link is None, then
-        # the object is not locked anyways
-        if unlock_link is not None:
-            global base_url
-            browser.open(base_url + unlock_link)
-            browser.submit_form(browser.get_form(class_='confirmation'))
-    # No return for this as we don't really care
-    # if we released the lock since it automatically
-    # releases in 30 minutes.
-    except Exception as e:
-        pass
-
-
-def upload_xml(file, repo, num):
+    found = pyqtSignal(list)
+
+    def __init__(self, folder, is_done, known, since, validate=True):
+        """
+        :param folder: the root folder to watch
+        :param is_done: the function telling whether a file was already uploaded, or None
+        :param known: a dict of the content hash by path of the files already in the table
+        :param since: the time.time() the folder scan started, files modified since are checked too
+        :param validate: whether to check the files are valid MODS
+        """
+        super(FolderWatchThread, self).__init__()
+        self.folder = folder
+        self.is_done = is_done
+        self.known = known
+        self.since = since
+        self.validate = validate
+        self.stopped = False
+        # (path, content_hash) of the versions whose upload failed, forgotten by the watcher
+        self.failed = queue.Queue()
+
+    def stop(self):
+        """
+        Stops watching within half a second
+        :return: None
+        """
+        self.stopped = True
+
+    def forget(self, path, content_hash):
+        """
+        Called from the GUI thread when the upload of a file failed, so that
+        saving it again uploads it even if its content is the same
+        :param path: the path of the file
+        :param content_hash: the content hash of the version that failed
+        :return: None
+        """
+        self.failed.put((path, content_hash))
+
+    def run(self):
+        import watch
+        try:
+            watcher = watch.FolderWatcher(self.folder, self.is_done, self.known, self.since)
+        except Exception as e:
+            print('Could not watch ' + self.folder + ': ' + str(e))
+            return
+        try:
+            while not self.stopped:
+                while not self.failed.empty():
+                    watcher.forget(*self.failed.get())
+                # Rows are (repository, number, path, content_hash, error) like the folder scan's
+                rows = []
+                for obj in watcher.changes(0.5):
+                    error = validate_file(obj[2], obj[0], obj[1], validation.schema_path) if self.validate else None
+                    rows.append(obj + (error,))
+                if len(rows) > 0 and not self.stopped:
+                    self.found.emit(rows)
+        finally:
+            watcher.close()
+
+
+class SignInThread(QThread):
     """
-    Uploads the MODS XML file to the appropriate object given the
-    repository namespace and number of the specific object.
-    :param file: the path of the MODS XML file to reingest
-    :param repo: the repository namespace derived from the file name
-    :param num: the number of the object derived from the file name
-    :return: None
+    Signs into the website without blocking the UI, so the folder
+    scan keeps going while it does
     """
-    global base_url
-    global global_session
-    # URL for managing the object
-    manage_url = 'https://doh.arcabc.ca/islandora/object/' + repo + '%3A' + num + '/datastream/MODS/replace'
-    # Create a new browser instance
-    browser = RoboBrowser(session=global_session, parser='html.parser')
-    try:
-        # Acquire the lock for the object
-        if acquire_lock(browser, manage_url):
-            # Go to the MODS replace page
-            browser.open('https://doh.arcabc.ca/islandora/object/' + repo + '%3A' + num + '/datastream/MODS/replace')
-            # Get the upload file form
-            form = browser.get_form(id='islandora-datastream-version-replace-form')
-            # Set the file to upload
-            f = open(file, 'r')
-            form['files[file]'].value = f
-            # This submit submits the form
-            browser.submit_form(form, submit=form['op'])
-            # Release the lock
-            release_lock(browser, manage_url)
-            # Close the file
-            f.close()
-            # Success
-            return True
-        else:
-            print('Failed to update object: ' + file + ' as the lock could not be acquired.')
-    except Exception as e:
-        print('Failed to update object: ' + file)
-        # Release the lock
-        release_lock(browser, manage_url)
+    # Whether signing in succeeded and what went wrong if it did not
+    signed_in = pyqtSignal(bool, str)
+
+    def __init__(self, username, password):
+        """
+        :param username: the username to login with
+        :param password: the password to login with
+        """
+        super(SignInThread, self).__init__()
+        self.username = username
+        self.password = password
 
-    # FAIL
-    return False
+    def run(self):
+        try:
+            if sign_in(self.username, self.password):
+                self.signed_in.emit(True, "")
+            else:
+                self.signed_in.emit(False, session_manager.failure_message())
+        except Exception as e:
+            self.signed_in.emit(False, "Could not reach the website: " + str(e))
 
 
-"""
-Main UI stuff
-"""
+class AsyncUploadThread(QThread):
+    """
+    Runs the asyncio engine (async_engine.py) on its own thread
+    so that the whole batch shares one event loop and one
+    connection pool instead of one thread per object
+    """
+    # Why the engine stopped before every row was processed, if it did
+    failed = pyqtSignal(str)
+
+    def __init__(self, username, password, controller, updates, scheduler, cancel):
+        """
+        :param username: the username to login with
+        :param password: the password to login with
+        :param controller: the AdaptiveLimit deciding how many objects are in flight
+        :param updates: the StatusUpdates the progress of the rows is reported to
+        :param scheduler: the FairScheduler of the (row_index, items) of the rows to upload,
+        the engine stops once it is closed and empty
+        :param cancel: the threading.Event set when the upload session is cancelled
+        """
+        super(AsyncUploadThread, self).__init__()
+        self.username = username
+        self.password = password
+        self.controller = controller
+        self.updates = updates
+        self.scheduler = scheduler
+        self.cancel = cancel
+        # The keys of the rows started and not finished yet, including the rows waiting for a retry
+        self.unfinished = set()
+
+    def rows(self):
+        """
+        :return: an iterator over the rows to upload as (key, repository, number, path)
+        tuples, the key being the row index and the repository
+        """
+        for row_index, items in iter(self.scheduler.get, None):
+            repository, number, path = items
+            yield (row_index, repository), repository, number, path
+
+    def finished(self, key, outcome):
+        """
+        Reports the final result of a row
+        :param key: the row index and the repository of the row
+        :param outcome: the outcome of the row, see upload_core.outcome_of
+        :return: None
+        """
+        # A row being retried keeps its place until it is done, so its
+        # namespace does not get more than its cap of locks at once
+        self.scheduler.done(key[1])
+        self.unfinished.discard(key)
+        if outcome == UPLOADED:
+            self.updates.put(key[0], RowStatus.SUCCEEDED)
+        elif outcome == CANCELLED:
+            self.updates.put(key[0], RowStatus.CANCELLED)
+        else:
+            self.updates.put(key[0], RowStatus.FAILED)
+
+    def started(self, key):
+        """
+        Reports that a row is being uploaded
+        :param key: the row index and the repository of the row
+        :return: None
+        """
+        self.unfinished.add(key)
+        self.updates.put(key[0], RowStatus.RUNNING)
+
+    def run(self):
+        # Imported here so the threads engine does not need aiohttp installed
+        import async_engine
+        # Uploads with the session signed in by SignInThread rather than signing in again
+        session = session_manager.session()
+        try:
+            if async_engine.run(self.rows(), self.username, self.password, self.controller,
+                                on_started=self.started,
+                                on_result=self.finished,
+                                retries=RetryPolicy(),
+                                on_retry=lambda key: self.updates.put(key[0], RowStatus.RETRYING),
+                                cancel=self.cancel,
+                                cookies=None if session is None else session.cookies) is not None:
+                return
+            error = "Ensure your username and password are correct!"
+        except Exception as e:
+            error = "The upload stopped: " + str(e) + "."
+        # The rows the engine did not finish, the rest are ended by the GUI
+        for key in self.unfinished:
+            self.updates.put(key[0], RowStatus.FAILED)
+        self.failed.emit(error)
 
 
-def upload(items, row_index):
+class SnapshotThread(QThread):
     """
-    Helper method that initiates the upload process. Called by
-    any Worker in the threadpool.
-    :param items: the cells of the row being processed, as text.
-    :param row_index: the index of the row being processed
-    :return: the result of the upload as a tuple with a boolean
-    indicating if it was successful and the row index.
+    Downloads the MODS the website has for the loaded rows into a
+    snapshot folder (snapshot.py) without blocking the UI, as a backup
+    to restore if the upload goes wrong
     """
-    result = (upload_xml(items[2], items[0], items[1]), row_index)
-    return result
+    # The number of rows processed so far and the number of rows
+    progress = pyqtSignal(int, int)
+    # What happened, shown once done
+    done = pyqtSignal(str)
 
+    def __init__(self, username, password, rows, destination):
+        """
+        :param username: the username to login with
+        :param password: the password to login with
+        :param rows: a list of the (repository, number, path) of the rows
+        :param destination: the folder of the snapshot
+        """
+        super(SnapshotThread, self).__init__()
+        self.username = username
+        self.password = password
+        self.rows = rows
+        self.destination = destination
+        self.processed = 0
+        self.progress_shown = 0
 
-class WorkerSignals(QObject):
+    def result(self, row, result):
+        self.processed = self.processed + 1
+        # Not for every row, the signals would flood the GUI thread
+        if time.monotonic() - self.progress_shown >= 0.2:
+            self.progress_shown = time.monotonic()
+            self.progress.emit(self.processed, len(self.rows))
+
+    def run(self):
+        import snapshot
+        try:
+            if not sign_in(self.username, self.password):
+                self.done.emit(session_manager.failure_message())
+                return
+            counts = snapshot.export_all(self.rows, snapshot.open_snapshot(self.destination), on_result=self.result)
+            self.done.emit("Backed up " + str(counts[snapshot.EXPORTED] + counts[snapshot.SKIPPED]) + " objects to " +
+                           self.destination + ", " + str(counts[snapshot.MISSING]) + " have no MODS, " +
+                           str(counts[snapshot.FAILED]) + " failed")
+        except Exception as e:
+            self.done.emit("Could not back up the MODS: " + str(e))
+
+
+class PreviewThread(QThread):
     """
-    The possible return types from a Worker object
+    Compares the loaded rows with the MODS the website has (preview.py)
+    without blocking the UI, to show what the upload would change
     """
-    result = pyqtSignal(tuple)
-    started = pyqtSignal(int)
+    # The number of rows compared so far and the number of rows
+    progress = pyqtSignal(int, int)
+    # The summary, or what went wrong, and whether it worked
+    done = pyqtSignal(str, bool)
 
+    def __init__(self, username, password, rows):
+        """
+        :param username: the username to login with
+        :param password: the password to login with
+        :param rows: a list of the (repository, number, path) of the rows
+        """
+        super(PreviewThread, self).__init__()
+        self.username = username
+        self.password = password
+        self.rows = rows
+        self.processed = 0
+        self.progress_shown = 0
 
-class Worker(QRunnable):
+    def result(self, row, result):
+        self.processed = self.processed + 1
+        # Not for every row, the signals would flood the GUI thread
+        if time.monotonic() - self.progress_shown >= 0.2:
+            self.progress_shown = time.monotonic()
+            self.progress.emit(self.processed, len(self.rows))
+
+    def run(self):
+        import preview
+        try:
+            if not sign_in(self.username, self.password):
+                self.done.emit(session_manager.failure_message(), False)
+                return
+            self.done.emit(preview.preview_all(self.rows, on_result=self.result).text(), True)
+        except Exception as e:
+            self.done.emit("Could not compare with the website: " + str(e), False)
+
+
+class ChangeDetectionThread(QThread):
     """
-    Worker class that processes a single table widget row
-    i.e. a single collection object
-    https://www.learnpyqt.com/courses/concurrent-execution/multithreading-pyqt-applications-qthreadpool/
+    Compares the files of the rows with the MODS on the website
+    (change_detection.py) without blocking the UI. Unchanged rows are
+    reported as SKIPPED, changed ones are handed to the upload engine.
     """
 
-    def __init__(self, fn, *args, **kwargs):
-        super(Worker, self).__init__()
-        self.fn = fn
-        self.args = args
-        self.kwargs = kwargs
-        self.signals = WorkerSignals()
+    def __init__(self, detector, updates, submit):
+        """
+        :param detector: the ChangeDetector to check with
+        :param updates: the StatusUpdates unchanged rows are reported to
+        :param submit: the function called with the row index and its
+        (repository, number, path) to upload a changed row
+        """
+        super(ChangeDetectionThread, self).__init__()
+        # (repository, number, path, row_index) tuples to check, ended by None
+        self.rows = queue.Queue()
+        self.detector = detector
+        self.updates = updates
+        self.submit = submit
 
-    @pyqtSlot()
     def run(self):
-        items, row_index = self.args
-        self.signals.started.emit(row_index)
-        result = self.fn(items, row_index)
-        self.signals.result.emit(result)
+        changed = find_changed(iter(self.rows.get, None), self.detector,
+                               on_unchanged=lambda row: self.updates.put(row[3], RowStatus.SKIPPED))
+        for row in changed:
+            self.submit(row[3], row[:3])
 
 
 """
@@ -238,12 +468,6 @@ All UI setup is down here
 
 
 class Ui_MainWindow(object):
-    """
-    Some static colors that will be used often in the UI
-    """
-    GREEN = QtGui.QColor(196, 237, 194)
-    YELLOW = QtGui.QColor(247, 247, 181)
-    RED = QtGui.QColor(237, 194, 194)
 
     def __init__(self, MainWindow):
         """
@@ -290,34 +514,32 @@ class Ui_MainWindow(object):
         self.btnSelectFolder.setGeometry(QtCore.QRect(430, 70, 111, 31))
         self.btnSelectFolder.setObjectName("btnSelectFolder")
         self.btnStart = QtWidgets.QPushButton(self.centralwidget)
-        self.btnStart.setGeometry(QtCore.QRect(10, 440, 531, 31))
+        self.btnStart.setGeometry(QtCore.QRect(10, 440, 331, 31))
         self.btnStart.setObjectName("btnStart")
+        self.btnPause = QtWidgets.QPushButton(self.centralwidget)
+        self.btnPause.setGeometry(QtCore.QRect(350, 440, 91, 31))
+        self.btnPause.setObjectName("btnPause")
+        self.btnPause.setEnabled(False)
+        self.btnCancel = QtWidgets.QPushButton(self.centralwidget)
+        self.btnCancel.setGeometry(QtCore.QRect(450, 440, 91, 31))
+        self.btnCancel.setObjectName("btnCancel")
+        self.btnCancel.setEnabled(False)
         self.progressBar = QtWidgets.QProgressBar(self.centralwidget)
         self.progressBar.setGeometry(QtCore.QRect(10, 480, 531, 20))
         self.progressBar.setProperty("value", 0)
         self.progressBar.setObjectName("progressBar")
-        self.tableWidget = QtWidgets.QTableWidget(self.centralwidget)
-        self.tableWidget.setGeometry(QtCore.QRect(10, 150, 531, 281))
-        self.tableWidget.setColumnCount(3)
-        self.tableWidget.setObjectName("tableWidget")
-        self.tableWidget.setRowCount(0)
-        self.tableWidget.setEditTriggers(QtWidgets.QTableWidget.NoEditTriggers)
-        item = QtWidgets.QTableWidgetItem()
+        self.fileModel = FileTableModel()
+        self.tableView = QtWidgets.QTableView(self.centralwidget)
+        self.tableView.setGeometry(QtCore.QRect(10, 150, 531, 281))
+        self.tableView.setObjectName("tableView")
+        self.tableView.setModel(self.fileModel)
+        self.tableView.setEditTriggers(QtWidgets.QTableView.NoEditTriggers)
         font = QtGui.QFont()
         font.setFamily("Arial")
-        item.setFont(font)
-        self.tableWidget.setHorizontalHeaderItem(0, item)
-        item = QtWidgets.QTableWidgetItem()
-        font = QtGui.QFont()
-        font.setFamily("Arial")
-        item.setFont(font)
-        self.tableWidget.setHorizontalHeaderItem(1, item)
-        item = QtWidgets.QTableWidgetItem()
-        font = QtGui.QFont()
-        font.setFamily("Arial")
-        item.setFont(font)
-        item.setTextAlignment(QtCore.Qt.AlignLeft)
-        self.tableWidget.setHorizontalHeaderItem(2, item)
+        self.tableView.horizontalHeader().setFont(font)
+        # Fixed sizes so the view never measures rows that are not visible
+        self.tableView.horizontalHeader().setStretchLastSection(True)
+        self.tableView.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
         self.lblUsername = QtWidgets.QLabel(self.centralwidget)
         self.lblUsername.setGeometry(QtCore.QRect(10, 110, 81, 31))
         font = QtGui.QFont()
@@ -347,10 +569,38 @@ class Ui_MainWindow(object):
         self.menubar = QtWidgets.QMenuBar(MainWindow)
         self.menubar.setGeometry(QtCore.QRect(0, 0, 550, 25))
         self.menubar.setObjectName("menubar")
+        self.menuOptions = self.menubar.addMenu("Options")
+        self.actionAsyncEngine = self.menuOptions.addAction("Use asyncio engine")
+        self.actionAsyncEngine.setCheckable(True)
+        self.actionRest = self.menuOptions.addAction("Upload through the REST API where the website has it")
+        self.actionRest.setCheckable(True)
+        self.actionResume = self.menuOptions.addAction("Skip objects already uploaded")
+        self.actionResume.setCheckable(True)
+        self.actionResume.setChecked(True)
+        self.actionSkipUnchanged = self.menuOptions.addAction("Skip objects unchanged on the website")
+        self.actionSkipUnchanged.setCheckable(True)
+        self.actionWatch = self.menuOptions.addAction("Watch the folder and upload changes")
+        self.actionWatch.setCheckable(True)
+        self.actionValidate = self.menuOptions.addAction("Check files are valid MODS when loading")
+        self.actionValidate.setCheckable(True)
+        self.actionValidate.setChecked(True)
+        self.actionFailuresFirst = self.menuOptions.addAction("Upload objects that failed before first")
+        self.actionFailuresFirst.setCheckable(True)
+        self.actionFailuresFirst.setChecked(True)
+        self.actionNamespaceCaps = self.menuOptions.addAction("Limit uploads per collection...")
+        self.actionRequestRate = self.menuOptions.addAction("Limit requests per second...")
+        self.menuOptions.addSeparator()
+        self.actionBackup = self.menuOptions.addAction("Back up MODS from the website...")
+        self.actionPreview = self.menuOptions.addAction("Preview changes...")
+        self.actionExportTimings = self.menuOptions.addAction("Export timings...")
         MainWindow.setMenuBar(self.menubar)
         self.statusbar = QtWidgets.QStatusBar(MainWindow)
         self.statusbar.setObjectName("statusbar")
         MainWindow.setStatusBar(self.statusbar)
+        self.lblConcurrency = QtWidgets.QLabel(self.statusbar)
+        self.statusbar.addPermanentWidget(self.lblConcurrency)
+        self.lblTimings = QtWidgets.QLabel(self.statusbar)
+        self.statusbar.addPermanentWidget(self.lblTimings)
 
         """
         Set custom names and events for UI
@@ -363,14 +613,64 @@ class Ui_MainWindow(object):
         Thread pool for processing
         """
         self.threadpool = QThreadPool()
-        self.threadpool.setMaxThreadCount(max_threads)
+        self.threadpool.setMaxThreadCount(upload_core.initial_concurrency)
+        # Decides how many uploads run at once, replaced for every upload session
+        self.controller = None
+        self.limit_signals = LimitSignals()
+        self.limit_signals.changed.connect(self.limit_changed)
 
         """
         Variables for tracking progress
         """
         # The total number of upload attempts, successful or not
         self.completed_tasks = 0
-        self.completed_tasks_lock = QtCore.QMutex()
+        # Status changes reported by the engines, applied to the table on a timer
+        self.updates = StatusUpdates()
+        self.update_timer = QtCore.QTimer()
+        self.update_timer.setInterval(update_interval)
+        self.update_timer.timeout.connect(self.apply_updates)
+        # When the phase timings were last shown
+        self.timings_shown = 0
+        # The thread running the asyncio engine, if selected
+        self.async_thread = None
+        # Past results, used to skip objects that were already uploaded
+        self.journal = Journal()
+        # Compares files with the website when skipping unchanged objects
+        self.detector = None
+        self.detection_thread = None
+        # The rows waiting to be retried by the threads engine
+        self.retries = None
+        # Decides which row is uploaded next, replaced for every upload session
+        self.scheduler = None
+        # Whether rows that failed in an earlier session are uploaded first
+        self.failures_first = True
+        # Set when the upload session is cancelled, replaced for every upload session
+        self.cancel_event = threading.Event()
+        # Why the upload engine stopped before the end of the upload session, if it did
+        self.upload_error = None
+        # Whether the upload session is paused
+        self.paused = False
+        # The thread scanning the selected folder and whether it is still running
+        self.scan_thread = None
+        self.scanning = False
+        self.scan_started = 0
+        # The time.time() the scan started, files modified since are checked by the folder watch
+        self.scan_started_at = 0
+        # The thread watching the folder for changes once scanned and whether it is running
+        self.watch_thread = None
+        self.watching = False
+        # The number of rows found already uploaded and invalid while scanning
+        self.skipped_count = 0
+        self.invalid_count = 0
+        # Whether rows found by the scan go straight to the upload engine
+        self.uploading = False
+        # The thread backing up the MODS of the loaded rows, if running
+        self.snapshot_thread = None
+        # The thread comparing the loaded rows with the website, if running
+        self.preview_thread = None
+        # The thread signing in when Begin Upload is clicked and whether it is still running
+        self.sign_in_thread = None
+        self.signing_in = False
 
     @staticmethod
     def show_error_message(msg):
@@ -390,107 +690,706 @@ class Ui_MainWindow(object):
         """
         Called when the user clicks the Begin Upload button.
         This function checks if there are valid MODS XML files loaded,
-        whether there is a username and password and if there is, whether
-        the username and password are valid. Then creates a threadpool and
-        submits all the files to be processed
+        whether there is a username and password and if there is, signs in
+        in the background, see signed_in()
         :return: None
         """
         # Make sure table has files, username and password are entered
-        if self.tableWidget.rowCount() is 0:
+        if self.fileModel.rowCount() == 0 and not self.scanning:
             self.show_error_message("No files have been loaded! Select" +
                                     " a folder with valid MODS XML files.")
         elif len(self.txtUsername.text().strip()) is 0:
             self.show_error_message("You must enter a username!")
         elif len(self.txtPassword.text().strip()) is 0:
             self.show_error_message("You must enter a password!")
-        elif not sign_in(self.txtUsername.text(), self.txtPassword.text()):
-            self.show_error_message("Ensure your username and password are correct!")
         else:
-            for i in range(self.tableWidget.rowCount()):
-                items = []
-                for j in range(self.tableWidget.columnCount()):
-                    item = self.tableWidget.item(i, j)
-                    items.append(str(item.text()))
+            # The rest happens in signed_in() once signed in
+            self.signing_in = True
+            self.btnStart.setEnabled(False)
+            self.statusbar.showMessage("Signing in...")
+            self.sign_in_thread = SignInThread(self.txtUsername.text(), self.txtPassword.text())
+            self.sign_in_thread.signed_in.connect(self.signed_in)
+            self.sign_in_thread.start()
+
+    def signed_in(self, success, error):
+        """
+        Called once the sign in started by start() is done. Starts the upload
+        engine and submits the files loaded so far. If the folder is still being
+        scanned, the rest of the files are submitted as they are found.
+        :param success: whether signing in succeeded
+        :param error: what went wrong if it did not
+        :return: None
+        """
+        self.signing_in = False
+        self.btnStart.setEnabled(True)
+        if self.statusbar.currentMessage() == "Signing in...":
+            self.statusbar.clearMessage()
+        if not success:
+            self.show_error_message(error)
+        else:
+            # Skip the invalid rows and the rows the journal says were already uploaded
+            rows = [i for i in range(self.fileModel.rowCount())
+                    if self.fileModel.status(i) != RowStatus.INVALID and not self.is_done(i)]
+            self.completed_tasks = self.fileModel.rowCount() - len(rows)
+            if len(rows) == 0 and not self.scanning and self.invalid_count == self.fileModel.rowCount():
+                self.show_error_message("None of the files are valid MODS! Hover over a row to see why.")
+                return
+            elif len(rows) == 0 and not self.scanning:
+                self.show_error_message("Every file has already been uploaded! Uncheck " +
+                                        "Options > Skip objects already uploaded to upload them again.")
+                return
+            self.uploading = True
+            self.scheduler = FairScheduler()
+            self.failures_first = self.actionFailuresFirst.isChecked()
+            self.cancel_event = threading.Event()
+            self.upload_error = None
+            self.set_paused(False)
+            self.btnPause.setEnabled(True)
+            self.btnCancel.setEnabled(True)
+            import backends
+            backends.backend = backends.REST if self.actionRest.isChecked() else backends.SCRAPING
+            if self.actionAsyncEngine.isChecked():
+                self.set_controller(AdaptiveLimit(upload_core.async_initial_concurrency,
+                                                  maximum=upload_core.async_max_concurrency))
+                self.async_thread = AsyncUploadThread(self.txtUsername.text(), self.txtPassword.text(),
+                                                      self.controller, self.updates, self.scheduler,
+                                                      self.cancel_event)
+                self.async_thread.failed.connect(self.upload_failed)
+                self.async_thread.start()
+            else:
+                self.async_thread = None
+                self.set_controller(AdaptiveLimit(upload_core.initial_concurrency,
+                                                  maximum=upload_core.max_concurrency))
+                self.retries = RetryScheduler()
+            if self.actionSkipUnchanged.isChecked():
+                self.detector = ChangeDetector(self.journal)
+                self.detection_thread = ChangeDetectionThread(self.detector, self.updates, self.submit)
+                self.detection_thread.finished.connect(self.end_uploads)
+                self.detection_thread.start()
+            else:
+                self.detector = None
+                self.detection_thread = None
+            self.enqueue_rows(rows)
+            if not self.scanning and not self.watching:
+                self.end_rows()
+            self.update_timer.start()
+            self.check_completed()
+
+    def enqueue_rows(self, rows):
+        """
+        Sends rows to be uploaded, through the change detection
+        first if unchanged objects are skipped
+        :param rows: the indexes of the rows to upload
+        :return: None
+        """
+        if self.detection_thread is not None:
+            for i in rows:
+                self.detection_thread.rows.put(tuple(self.row_items(i)) + (i,))
+        else:
+            self.upload_rows(rows)
+
+    def end_rows(self):
+        """
+        Tells the upload session that no more rows will be sent
+        :return: None
+        """
+        if self.detection_thread is not None:
+            # The uploads end once the change detection is done with the last rows
+            self.detection_thread.rows.put(None)
+        else:
+            self.end_uploads()
+
+    def end_uploads(self):
+        """
+        Tells the upload engine that no more rows will be submitted
+        :return: None
+        """
+        if self.async_thread is not None:
+            self.scheduler.close()
+
+    def upload_rows(self, rows):
+        """
+        Submits rows to the selected upload engine
+        :param rows: the indexes of the rows to upload
+        :return: None
+        """
+        for i in rows:
+            self.submit(i, self.row_items(i))
+
+    def submit(self, row_index, items):
+        """
+        Submits one row to the selected upload engine, through the scheduler
+        deciding the order of the rows. Safe to call from any thread as it
+        does not touch the table.
+        :param row_index: the index of the row
+        :param items: the (repository, number, path) of the row
+        :return: None
+        """
+        if self.cancel_event.is_set():
+            # Rows still coming from the change detection once cancelled
+            self.updates.put(row_index, RowStatus.CANCELLED)
+            return
+        repository, number, path = items
+        priority = PRIORITY_NORMAL
+        if self.failures_first and self.journal.has_failed(repository + ':' + number):
+            priority = PRIORITY_FAILED
+        self.scheduler.put(repository, (row_index, tuple(items)), priority, number_order(number))
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Hands the next rows of the scheduler to the threadpool while fewer rows
+        than the concurrency limit are being uploaded, the asyncio engine pulls
+        them itself. Safe to call from any thread.
+        :return: None
+        """
+        if self.async_thread is not None or self.scheduler is None:
+            return
+        while True:
+            row = self.scheduler.take(self.controller.limit)
+            if row is None:
+                return
+            row_index, items = row
+            self.threadpool.start(Worker(upload, self.updates, self.retries, self.row_finished, list(items),
+                                         row_index, controller=self.controller, cancel=self.cancel_event))
 
-                worker = Worker(upload, items, i)
-                worker.signals.started.connect(self.started)
-                worker.signals.result.connect(self.worker_response_handler)
+    def row_finished(self, items):
+        """
+        Called by a Worker once it processed its row, frees its place in the
+        scheduler for the next row. Called from the worker threads.
+        :param items: the (repository, number, path) of the row
+        :return: None
+        """
+        self.scheduler.done(items[0])
+        self.dispatch()
 
-                self.threadpool.start(worker)
+    def apply_updates(self):
+        """
+        Called by the update timer. Applies every status change the engines
+        reported since the last call to the table, the journal and the
+        progress bar in one go, so the work done on the GUI thread does not
+        grow with the number of uploads finishing per second.
+        :return: None
+        """
+        # Rows waiting to be retried by the threads engine go back to the threadpool once due
+        if self.async_thread is None and self.retries is not None:
+            for row_index, items in self.retries.take_due():
+                self.submit(row_index, items)
+        changes = self.updates.take()
+        if len(changes) == 0:
+            return
+        self.fileModel.set_statuses(changes)
+        for row_index, status in changes:
+            if status in (RowStatus.RUNNING, RowStatus.RETRYING):
+                continue
+            if status == RowStatus.CANCELLED:
+                # Nothing happened to the object, it is uploaded by the next session
+                self.completed_tasks = self.completed_tasks + 1
+                continue
+            repository, number, path = self.row_items(row_index)
+            content_hash = self.fileModel.content_hash(row_index)
+            if status == RowStatus.SKIPPED:
+                # The file is the same as the MODS on the website
+                self.journal.record(repository + ':' + number, content_hash, path, journal.UNCHANGED)
+            else:
+                success = status == RowStatus.SUCCEEDED
+                self.journal.record(repository + ':' + number, content_hash, path,
+                                    journal.SUCCEEDED if success else journal.FAILED)
+                if success and self.detector is not None:
+                    self.detector.uploaded(repository, number, path)
+                if not success and self.watch_thread is not None:
+                    self.watch_thread.forget(path, content_hash)
+            self.completed_tasks = self.completed_tasks + 1
+        if time.monotonic() - self.timings_shown >= timings_interval:
+            self.show_timings()
+        self.check_completed()
 
-    def started(self, row_index):
+    def check_completed(self):
         """
-        The function that handles a started emit from a Worker.
-        When a upload task starts, it calls this method to update the UI
-        and set the row to yellow to inform the user the row is being
-        processed (i.e. the uploading process)
-        :param row_index: the index of the row being processed
+        Updates the progress bar and shows a summary once every
+        row is processed and the folder scan is done
         :return: None
         """
-        self.set_row_color(row_index, Ui_MainWindow.YELLOW)
+        if self.fileModel.rowCount() > 0:
+            self.progressBar.setValue(int(self.completed_tasks * 100 / self.fileModel.rowCount()))
+        if self.uploading and self.watching and not self.scanning and not self.paused and \
+                self.completed_tasks == self.fileModel.rowCount():
+            self.statusbar.showMessage("Up to date, watching the folder for changes... " + request_counts.summary())
+        if self.uploading and not self.scanning and not self.watching and \
+                self.completed_tasks == self.fileModel.rowCount():
+            self.uploading = False
+            self.update_timer.stop()
+            self.btnPause.setEnabled(False)
+            self.btnCancel.setEnabled(False)
+            self.set_paused(False)
+            self.show_timings()
+            if self.upload_error is not None:
+                self.statusbar.showMessage(self.upload_error + " " + request_counts.summary())
+            elif self.cancel_event.is_set():
+                cancelled = sum(1 for i in range(self.fileModel.rowCount())
+                                if self.fileModel.status(i) == RowStatus.CANCELLED)
+                self.statusbar.showMessage("Cancelled, " + str(cancelled) + " objects were not uploaded. " +
+                                           request_counts.summary())
+            else:
+                self.statusbar.showMessage(request_counts.summary())
 
-    def worker_response_handler(self, completed):
+    def toggle_pause(self):
         """
-        The handler to handle a response from a Worker when
-        an upload task is completed (not necessarily successful)
-        :param completed: the tuple holding the result from the Worker
+        Called when the user clicks the Pause or Resume button. While paused
+        no more rows are started, the rows being uploaded finish.
         :return: None
         """
-        # Pattern match the tuple
-        success, row_index = completed
-        if success:
-            self.set_row_color(row_index, Ui_MainWindow.GREEN)
+        if not self.uploading or self.cancel_event.is_set():
+            return
+        self.set_paused(not self.paused)
+        if self.paused:
+            self.scheduler.pause()
+            self.statusbar.showMessage("Paused, the objects being uploaded will finish")
         else:
-            self.set_row_color(row_index, Ui_MainWindow.RED)
+            self.scheduler.resume()
+            self.statusbar.clearMessage()
+            self.dispatch()
+
+    def set_paused(self, paused):
+        """
+        :param paused: whether the upload session is paused
+        :return: None
+        """
+        self.paused = paused
+        self.btnPause.setText("Resume" if paused else "Pause")
+
+    def cancel(self):
+        """
+        Called when the user clicks the Cancel button. No more rows are
+        started and the rows waiting are marked cancelled. The rows being
+        uploaded stop before their MODS is replaced, releasing their lock,
+        unless they are already replacing it.
+        :return: None
+        """
+        if not self.uploading or self.cancel_event.is_set():
+            return
+        answer = QMessageBox.question(None, "Cancel Upload",
+                                      "Stop the upload? The objects not uploaded yet are left as they are.",
+                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if answer != QMessageBox.Yes or not self.uploading:
+            return
+        self.stop_uploads(RowStatus.CANCELLED)
+        # Stopping the watch may have ended the session already
+        if self.uploading:
+            self.statusbar.showMessage("Cancelling, waiting for the objects being uploaded...")
+
+    def upload_failed(self, error):
+        """
+        Called when the asyncio engine stopped before processing every row,
+        the rows it did not get to are marked failed
+        :param error: why it stopped
+        :return: None
+        """
+        if self.uploading and not self.cancel_event.is_set():
+            self.upload_error = error
+            self.stop_uploads(RowStatus.FAILED)
+        self.show_error_message(error)
+
+    def stop_uploads(self, status):
+        """
+        Starts no more rows and ends the rows waiting with a status, the
+        rows being uploaded carry on
+        :param status: the RowStatus of the rows waiting
+        :return: None
+        """
+        self.cancel_event.set()
+        self.btnPause.setEnabled(False)
+        self.btnCancel.setEnabled(False)
+        self.set_paused(False)
+        # No more rows from the folder scan or the folder watch
+        if self.scan_thread is not None and self.scanning:
+            self.scan_thread.stop()
+        self.stop_watching()
+        cancelled = [row[0] for row in self.scheduler.cancel()]
+        if self.retries is not None:
+            cancelled.extend(row[0] for row in self.retries.take_all())
+        if self.detection_thread is not None:
+            # The rows the change detection did not get to yet
+            while True:
+                try:
+                    row = self.detection_thread.rows.get_nowait()
+                except queue.Empty:
+                    break
+                if row is not None:
+                    cancelled.append(row[3])
+            self.detection_thread.rows.put(None)
+        for row_index in cancelled:
+            self.updates.put(row_index, status)
+
+    def show_timings(self):
+        """
+        Shows the median time of the slowest upload phases in the
+        status bar, with the full table in its tooltip
+        :return: None
+        """
+        self.timings_shown = time.monotonic()
+        self.lblTimings.setText(timings.summary())
+        self.lblTimings.setToolTip(timings.table())
+
+    def export_timings(self):
+        """
+        Writes the timings of every upload phase to a file selected by the user,
+        as JSON or in the Prometheus text format depending on its extension
+        :return: None
+        """
+        path, selected = QFileDialog.getSaveFileName(None, 'Export Timings', 'timings.json',
+                                                     'JSON (*.json);;Prometheus (*.prom *.txt)')
+        if path is None or len(path) == 0:
+            return
+        try:
+            timings.write(path)
+        except Exception as e:
+            self.show_error_message('Could not write ' + path + ': ' + str(e))
+
+    def back_up(self):
+        """
+        Called when the user clicks Options > Back up MODS from the website...
+        Downloads what the website has for every loaded row into a folder
+        selected by the user, which can be uploaded to undo the upload
+        :return: None
+        """
+        if self.fileModel.rowCount() == 0:
+            self.show_error_message("No files have been loaded! Select" +
+                                    " a folder with valid MODS XML files.")
+            return
+        if len(self.txtUsername.text().strip()) == 0 or len(self.txtPassword.text().strip()) == 0:
+            self.show_error_message("You must enter a username and a password!")
+            return
+        if self.is_busy():
+            self.show_error_message("Wait for the upload, the backup or the preview to finish first!")
+            return
+        destination = QFileDialog.getExistingDirectory(None, 'Select Backup Folder', '', QFileDialog.ShowDirsOnly)
+        if destination is None or len(destination) == 0:
+            return
+        rows = [tuple(self.row_items(i)) for i in range(self.fileModel.rowCount())]
+        self.btnStart.setEnabled(False)
+        self.statusbar.showMessage("Backing up " + str(len(rows)) + " objects...")
+        self.snapshot_thread = SnapshotThread(self.txtUsername.text(), self.txtPassword.text(), rows,
+                                              destination.replace("/", os.sep))
+        self.snapshot_thread.progress.connect(self.show_read_progress)
+        self.snapshot_thread.done.connect(self.backed_up)
+        self.snapshot_thread.start()
+
+    def show_read_progress(self, processed, total):
+        """
+        Shows the progress of the backup or the preview
+        :param processed: the number of rows processed so far
+        :param total: the number of rows
+        :return: None
+        """
+        self.progressBar.setValue(int(processed * 100 / total))
+        self.statusbar.showMessage(("Backing up... " if self.snapshot_thread is not None else "Comparing... ") +
+                                   str(processed) + " of " + str(total) + " objects")
+
+    def backed_up(self, message):
+        """
+        Called once the backup is done
+        :param message: what happened
+        :return: None
+        """
+        self.snapshot_thread.wait()
+        self.snapshot_thread = None
+        self.btnStart.setEnabled(True)
+        self.progressBar.setValue(0)
+        self.statusbar.showMessage(message)
+
+    def preview(self):
+        """
+        Called when the user clicks Options > Preview changes...
+        Compares every loaded row with what the website has, without
+        locking anything, and shows what the upload would change
+        :return: None
+        """
+        if self.fileModel.rowCount() == 0:
+            self.show_error_message("No files have been loaded! Select" +
+                                    " a folder with valid MODS XML files.")
+            return
+        if len(self.txtUsername.text().strip()) == 0 or len(self.txtPassword.text().strip()) == 0:
+            self.show_error_message("You must enter a username and a password!")
+            return
+        if self.is_busy():
+            self.show_error_message("Wait for the upload, the backup or the preview to finish first!")
+            return
+        rows = [tuple(self.row_items(i)) for i in range(self.fileModel.rowCount())
+                if self.fileModel.status(i) != RowStatus.INVALID]
+        self.btnStart.setEnabled(False)
+        self.statusbar.showMessage("Comparing " + str(len(rows)) + " objects with the website...")
+        self.preview_thread = PreviewThread(self.txtUsername.text(), self.txtPassword.text(), rows)
+        self.preview_thread.progress.connect(self.show_read_progress)
+        self.preview_thread.done.connect(self.previewed)
+        self.preview_thread.start()
+
+    def previewed(self, summary, success):
+        """
+        Called once the preview is done, shows its summary
+        :param summary: the summary of what would change, or what went wrong
+        :param success: whether the comparison could be done
+        :return: None
+        """
+        self.preview_thread.wait()
+        self.preview_thread = None
+        self.btnStart.setEnabled(True)
+        self.progressBar.setValue(0)
+        self.statusbar.clearMessage()
+        if not success:
+            self.show_error_message(summary)
+            return
+        self.statusbar.showMessage(summary.splitlines()[0])
+        msg_box = QMessageBox()
+        msg_box.setIcon(QMessageBox.Information)
+        msg_box.setText("Uploading the loaded files would change:")
+        msg_box.setInformativeText(summary.splitlines()[0] + "\n" + summary.splitlines()[1])
+        msg_box.setDetailedText(summary)
+        msg_box.setWindowTitle("Preview")
+        msg_box.setStandardButtons(QMessageBox.Ok)
+        msg_box.exec_()
+
+    def is_busy(self):
+        """
+        :return: whether an upload, a backup or a preview is running
+        """
+        return self.uploading or self.signing_in or self.snapshot_thread is not None or \
+            self.preview_thread is not None
+
+    def watch_toggled(self, checked):
+        """
+        Called when the user checks or unchecks Options > Watch the folder and upload changes
+        :param checked: whether the folder is to be watched
+        :return: None
+        """
+        if not checked:
+            self.stop_watching()
+        elif self.scan_thread is not None and not self.scanning:
+            # Otherwise the watch starts once the scan is done
+            self.start_watching()
 
-        # Safely increment completed tasks
-        # and set progress bar value
-        self.completed_tasks_lock.lock()
-        self.completed_tasks = self.completed_tasks + 1
-        self.progressBar.setValue((self.completed_tasks / self.tableWidget.rowCount()) * 100)
-        self.completed_tasks_lock.unlock()
+    def start_watching(self):
+        """
+        Watches the scanned folder. The files dropped or edited in it are
+        added to the table, and uploaded if an upload is running, until
+        the watch is stopped.
+        :return: None
+        """
+        if self.watch_thread is not None:
+            return
+        known = dict((self.fileModel.row(i)[2], self.fileModel.content_hash(i))
+                     for i in range(self.fileModel.rowCount()))
+        self.watch_thread = FolderWatchThread(self.lblPath.text(),
+                                              self.journal.is_done if self.actionResume.isChecked() else None,
+                                              known, self.scan_started_at, self.actionValidate.isChecked())
+        self.watch_thread.found.connect(self.add_watched_rows)
+        self.watch_thread.start()
+        self.watching = True
+
+    def stop_watching(self):
+        """
+        Stops watching the folder, the upload session then ends once
+        the rows already added are done
+        :return: None
+        """
+        if self.watch_thread is None:
+            return
+        self.watching = False
+        self.watch_thread.stop()
+        self.watch_thread.wait()
+        self.watch_thread = None
+        if self.uploading:
+            self.end_rows()
+            self.check_completed()
+
+    def add_watched_rows(self, rows):
+        """
+        Adds the files the folder watch found changed
+        :param rows: a list of (repository, number, path, content_hash, error) tuples
+        :return: None
+        """
+        # Rows sent just before the watch was stopped are found again by the next watch
+        if self.watching:
+            self.add_rows(rows)
+
+    def set_namespace_caps(self):
+        """
+        Asks the user for the max number of objects of a collection uploaded at
+        once, e.g. "doh=2, 8" for 2 of doh and 8 of any other, used from the
+        next upload session on
+        :return: None
+        """
+        current = ', '.join(namespace + '=' + str(cap) for namespace, cap in sorted(scheduling.namespace_caps.items()))
+        if scheduling.default_namespace_cap is not None:
+            current = ', '.join(part for part in (current, str(scheduling.default_namespace_cap)) if part)
+        text, accepted = QInputDialog.getText(None, 'Limit uploads per collection',
+                                              'Max uploads at once per collection, e.g. "doh=2, 8" for 2 of doh\n'
+                                              'and 8 of any other collection. Leave empty for no limit:',
+                                              text=current)
+        if not accepted:
+            return
+        try:
+            scheduling.namespace_caps, scheduling.default_namespace_cap = scheduling.parse_caps(text)
+        except ValueError as e:
+            self.show_error_message('The limits are not valid: ' + str(e))
+
+    def set_request_rate(self):
+        """
+        Asks the user for the max number of requests per second made to the
+        website (see ratelimit.py), applied at once, to a running upload too
+        :return: None
+        """
+        # Imported here as it loads requests, which the window does not need to show
+        import ratelimit
+        current = '' if ratelimit.rate is None else format(ratelimit.rate, 'g')
+        text, accepted = QInputDialog.getText(None, 'Limit requests per second',
+                                              'Max requests per second made to the website, spaced out evenly.\n'
+                                              'Leave empty for no limit:', text=current)
+        if not accepted:
+            return
+        try:
+            rate = float(text) if text.strip() else None
+        except ValueError:
+            self.show_error_message('The limit must be a number: ' + text)
+            return
+        if rate is not None and rate <= 0:
+            self.show_error_message('The limit must be positive')
+            return
+        ratelimit.configure(rate)
+
+    def row_items(self, row_index):
+        """
+        :param row_index: the index of a row of the table
+        :return: the repository, number and path of the row, as text
+        """
+        return list(self.fileModel.row(row_index))
+
+    def is_done(self, row_index):
+        """
+        :param row_index: the index of a row of the table
+        :return: whether the journal says the file of the row was already
+        uploaded, always False if skipping is turned off
+        """
+        if not self.actionResume.isChecked():
+            return False
+        repository, number, path = self.row_items(row_index)
+        return self.journal.is_done(repository + ':' + number, self.fileModel.content_hash(row_index))
+
+    def set_controller(self, controller):
+        """
+        Sets the concurrency controller of a new upload session
+        :param controller: the AdaptiveLimit to use
+        :return: None
+        """
+        self.controller = controller
+        self.controller.on_change(self.limit_signals.changed.emit)
+        self.limit_changed(controller.limit)
+
+    def limit_changed(self, limit):
+        """
+        Applies a new concurrency limit to the threadpool and shows
+        it and its recent history in the status bar
+        :param limit: the new max number of concurrent uploads
+        :return: None
+        """
+        self.threadpool.setMaxThreadCount(limit)
+        self.lblConcurrency.setText("Concurrency: " + self.controller.history_text())
+        # A higher limit leaves room for more rows
+        self.dispatch()
 
     def load_xml_from_folder(self):
         """
-        Loads all XML files from a folder recursively using globe.
+        Loads all XML files from a folder recursively. The folder
+        is scanned on a FolderScanThread and the rows are added to
+        the table model in batches as the files are found.
         :return: None
         """
+        # Stop the scan and the watch of a previously selected folder
+        self.stop_watching()
+        if self.scan_thread is not None:
+            self.scan_thread.found.disconnect()
+            self.scan_thread.finished.disconnect()
+            self.scan_thread.stop()
+            self.scan_thread.wait()
         # Reset the UI and its variables
         self.reset()
-        # Create a set of all the files to upload
-        file_list = set()
-        for filename in glob.iglob(
-                self.lblPath.text().replace("/", os.sep) + os.sep + '**' + os.sep + '*.xml', recursive=True):
-            file_list.add(filename)
-        # Set the new file count
-        self.file_count = len(file_list)
-        # Reset the table widget
-        self.tableWidget.clearContents()
-        # Add the rows
-        self.tableWidget.setRowCount(len(file_list))
-        # Populate the rows
-        row_index = 0
-        for filename in file_list:
-            try:
-                # Parse the path to get the repository and number
-                fnms = filename.split(os.sep)
-                objIDpts = fnms[-1].split("_")
-                repository = objIDpts[0]
-                number = objIDpts[1].split(".")[0]
-                self.tableWidget.setItem(row_index, 0, QtWidgets.QTableWidgetItem(repository))
-                self.tableWidget.setItem(row_index, 1, QtWidgets.QTableWidgetItem(number))
-                self.tableWidget.setItem(row_index, 2, QtWidgets.QTableWidgetItem(filename))
-                row_index = row_index + 1
-            except Exception as e:
-                print(e)
+        # Reset the table
+        self.fileModel.clear()
+        self.skipped_count = 0
+        self.invalid_count = 0
+        self.scanning = True
+        self.scan_started = time.monotonic()
+        self.scan_started_at = time.time()
+        self.scan_thread = FolderScanThread(self.lblPath.text(), self.actionValidate.isChecked())
+        self.scan_thread.found.connect(self.add_rows)
+        self.scan_thread.finished.connect(self.scan_finished)
+        self.scan_thread.start()
 
-        # No valid DOH files found
-        if row_index is 0:
-            self.tableWidget.setRowCount(0)
+    def add_rows(self, rows):
+        """
+        Adds rows found by the scan to the table, marking the ones that are
+        invalid or already uploaded, and sends the others to be uploaded if
+        an upload is running
+        :param rows: a list of (repository, number, path, content_hash, error) tuples,
+        error being what is wrong with the file or None if it is valid
+        :return: None
+        """
+        first = self.fileModel.rowCount()
+        self.fileModel.append_rows([row[:4] for row in rows])
+        invalid = []
+        done = []
+        pending = []
+        for i, (repository, number, path, content_hash, error) in enumerate(rows, first):
+            if error is not None:
+                invalid.append((i, error))
+                self.journal.record(repository + ':' + number, content_hash, path, journal.INVALID)
+            elif self.is_done(i):
+                done.append(i)
+            else:
+                pending.append(i)
+        self.fileModel.set_invalid(invalid)
+        self.fileModel.set_statuses([(i, RowStatus.SKIPPED) for i in done])
+        self.invalid_count = self.invalid_count + len(invalid)
+        self.skipped_count = self.skipped_count + len(done)
+        if self.scanning:
+            elapsed = max(time.monotonic() - self.scan_started, 0.001)
+            self.statusbar.showMessage("Scanning... " + str(self.fileModel.rowCount()) + " files found (" +
+                                       str(int(self.fileModel.rowCount() / elapsed)) + " files/s)")
+        else:
+            self.statusbar.showMessage(str(len(rows)) + " changed files found at " + time.strftime("%H:%M:%S"))
+        if self.uploading:
+            self.completed_tasks = self.completed_tasks + len(invalid) + len(done)
+            if self.cancel_event.is_set():
+                self.fileModel.set_statuses([(i, RowStatus.CANCELLED) for i in pending])
+                self.completed_tasks = self.completed_tasks + len(pending)
+            else:
+                self.enqueue_rows(pending)
+            self.check_completed()
 
-        # Set Path column size
-        header = self.tableWidget.horizontalHeader()
-        header.setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeToContents)
+    def scan_finished(self):
+        """
+        Handles the end of the folder scan
+        :return: None
+        """
+        self.scanning = False
+        # Set the new file count
+        self.file_count = self.fileModel.rowCount()
+        if self.actionWatch.isChecked():
+            self.start_watching()
+        if self.uploading:
+            if not self.watching:
+                self.end_rows()
+            self.check_completed()
+            return
+        message = ("Found " + str(self.file_count) + " files in " +
+                   format(time.monotonic() - self.scan_started, '.1f') + "s")
+        if self.skipped_count > 0:
+            message = message + ", " + str(self.skipped_count) + " were already uploaded and will be skipped"
+        if self.invalid_count > 0:
+            message = message + ", " + str(self.invalid_count) + " are not valid MODS (shown in red)"
+        if self.watching:
+            message = message + ", watching for changes"
+        self.statusbar.showMessage(message)
 
     def set_folder(self):
         """
@@ -516,7 +1415,18 @@ class Ui_MainWindow(object):
         :return: None
         """
         self.completed_tasks = 0
+        self.uploading = False
+        self.btnPause.setEnabled(False)
+        self.btnCancel.setEnabled(False)
+        self.set_paused(False)
+        self.update_timer.stop()
+        self.updates.take()
         self.progressBar.setValue(0)
+        request_counts.reset()
+        timings.reset()
+        self.lblTimings.clear()
+        self.lblTimings.setToolTip('')
+        self.statusbar.clearMessage()
 
     def setup_events(self):
         """
@@ -526,17 +1436,14 @@ class Ui_MainWindow(object):
         """
         self.btnSelectFolder.clicked.connect(self.set_folder)
         self.btnStart.clicked.connect(self.start)
-
-    def set_row_color(self, row_index, color):
-        """
-        Sets the color of a row given the index of it
-        :param row_index: the index of the row to color
-        :param color: the color as a QtGui.QColor e.g. QtGui.QColor(QtCore.Qt.green)
-        Can also use the static color variables set in the UI for yellow, red & green
-        :return: None
-        """
-        for i in range(self.tableWidget.columnCount()):
-            self.tableWidget.item(row_index, i).setBackground(color)
+        self.btnPause.clicked.connect(self.toggle_pause)
+        self.btnCancel.clicked.connect(self.cancel)
+        self.actionExportTimings.triggered.connect(self.export_timings)
+        self.actionNamespaceCaps.triggered.connect(self.set_namespace_caps)
+        self.actionRequestRate.triggered.connect(self.set_request_rate)
+        self.actionBackup.triggered.connect(self.back_up)
+        self.actionPreview.triggered.connect(self.preview)
+        self.actionWatch.toggled.connect(self.watch_toggled)
 
     def retranslate_ui(self, MainWindow):
         """
@@ -551,21 +1458,28 @@ class Ui_MainWindow(object):
         self.lblPath.setText(_translate("MainWindow", os.path.dirname(os.path.realpath(__file__))))
         self.btnSelectFolder.setText(_translate("MainWindow", "Select Folder..."))
         self.btnStart.setText(_translate("MainWindow", "Start Upload"))
-        item = self.tableWidget.horizontalHeaderItem(0)
-        item.setText(_translate("MainWindow", "Repository"))
-        item = self.tableWidget.horizontalHeaderItem(1)
-        item.setText(_translate("MainWindow", "Number"))
-        item = self.tableWidget.horizontalHeaderItem(2)
-        item.setText(_translate("MainWindow", "Path"))
+        self.btnPause.setText(_translate("MainWindow", "Pause"))
+        self.btnCancel.setText(_translate("MainWindow", "Cancel"))
         self.lblUsername.setText(_translate("MainWindow", "Username"))
         self.lblPassword.setText(_translate("MainWindow", "Password"))
 
 
 if __name__ == "__main__":
+    import multiprocessing
     import sys
 
+    # Lets the validation processes start in a frozen executable
+    multiprocessing.freeze_support()
     app = QtWidgets.QApplication(sys.argv)
     MainWindow = QtWidgets.QMainWindow()
     ui = Ui_MainWindow(MainWindow)
+    app.aboutToQuit.connect(ui.stop_watching)
+    app.aboutToQuit.connect(ui.journal.close)
     MainWindow.show()
+    # Set by startup_benchmark.py: say when the first window was shown, then quit
+    if os.environ.get(STARTUP_BENCHMARK_VARIABLE):
+        def shown():
+            print('shown ' + repr(time.time()), flush=True)
+            app.quit()
+        QtCore.QTimer.singleShot(0, shown)
     sys.exit(app.exec_())
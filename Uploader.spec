@@ -2,6 +2,26 @@
 
 block_cipher = None
 
+# Modules the desktop application never uses. Left out so the executable
+# has less to unpack and scan every time it starts.
+# The command line tools (uploader_cli.py, watch.py, snapshot.py, preview.py)
+# are kept, as the GUI runs their code on its threads.
+excludes = [
+    # Stand-ins and benchmarks that are only run from the source tree
+    'mock_islandora', 'benchmark', 'parse_benchmark', 'startup_benchmark', 'upldFromFolder_old',
+    # Standard library modules nothing imports at run time
+    'tkinter', 'pydoc', 'pydoc_data', 'lib2to3', 'doctest', 'xmlrpc', 'curses',
+    # Optional parsers BeautifulSoup (needed by robobrowser) tries to load
+    'html5lib',
+    # Parts of PyQt5 the window does not use
+    'PyQt5.QtNetwork', 'PyQt5.QtQml', 'PyQt5.QtQuick', 'PyQt5.QtQuickWidgets', 'PyQt5.QtSql',
+    'PyQt5.QtMultimedia', 'PyQt5.QtMultimediaWidgets', 'PyQt5.QtWebEngine', 'PyQt5.QtWebEngineCore',
+    'PyQt5.QtWebEngineWidgets', 'PyQt5.QtWebSockets', 'PyQt5.QtBluetooth', 'PyQt5.QtPositioning',
+    'PyQt5.QtLocation', 'PyQt5.QtSensors', 'PyQt5.QtSerialPort', 'PyQt5.QtTest', 'PyQt5.QtDesigner',
+    'PyQt5.QtHelp', 'PyQt5.QtOpenGL', 'PyQt5.QtSvg', 'PyQt5.QtXml', 'PyQt5.QtXmlPatterns',
+    'PyQt5.QtDBus', 'PyQt5.QtNfc', 'PyQt5.Qt3DCore', 'PyQt5.QtChart',
+]
+
 
 a = Analysis(['Uploader.py'],
              pathex=['C:\\Users\\ragha\\code\\python\\DOH_uploader'],
@@ -10,7 +30,7 @@ a = Analysis(['Uploader.py'],
              hiddenimports=[],
              hookspath=[],
              runtime_hooks=[],
-             excludes=[],
+             excludes=excludes,
              win_no_prefer_redirects=False,
              win_private_assemblies=False,
              cipher=block_cipher,
@@ -27,7 +47,8 @@ exe = EXE(pyz,
           debug=False,
           bootloader_ignore_signals=False,
           strip=False,
-          upx=True,
+          # UPX packed libraries are unpacked again on every start and set off virus scanners
+          upx=False,
           upx_exclude=[],
           runtime_tmpdir=None,
           console=True )
@@ -0,0 +1,544 @@
+"""
+Asyncio based upload engine.
+Instead of one RoboBrowser and one OS thread per object, all
+objects share a single aiohttp session whose connection pool is
+bounded and kept alive, so hundreds of objects can be in flight
+from one thread. Replaces the MODS with the selected backend
+(backends.py), by default the same lock -> replace -> unlock
+transaction as upload_core.UploadTransaction.
+"""
+import asyncio
+import itertools
+import time
+
+import aiohttp
+from yarl import URL
+
+import backends
+import ratelimit
+import sessions
+import upload_core
+from concurrency import AdaptiveLimit
+from metrics import timings
+from page_parser import parse_page
+
+# How long an idle keep-alive connection is kept in the pool, in seconds
+keepalive_timeout = 60
+
+
+class AsyncTransaction(object):
+    """
+    The asyncio version of upload_core.UploadTransaction, reusing
+    every page it lands on in the same way
+    """
+
+    def __init__(self, uploader, repo, num, counter=None):
+        """
+        :param uploader: the AsyncUploader whose session is used
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :param counter: the PhaseCounter to record requests in, defaults to upload_core.request_counts
+        """
+        self.uploader = uploader
+        self.manage_url = upload_core.base_url + '/islandora/object/' + repo + '%3A' + num + '/datastream/MODS/replace'
+        self.counter = counter or upload_core.request_counts
+        self.counter.add_object()
+        # The page_parser.Page the transaction is currently on
+        self.page = None
+        # What went wrong, reported to the concurrency controller
+        self.server_error = False
+        self.lock_failed = False
+        # and used to decide whether to retry
+        self.network_error = False
+        self.locked_by_other = False
+        # Whether the website answered as to someone not signed in
+        self.signed_out = False
+        # Whether the upload was cancelled once the lock was acquired
+        self.cancelled = False
+
+    async def open(self, phase, url):
+        await self.landed(phase, self.uploader.open(url))
+
+    async def submit(self, phase, form, **kwargs):
+        await self.landed(phase, self.uploader.submit_form(form, **kwargs))
+
+    async def landed(self, phase, request):
+        """
+        Moves to the page a request lands on, recording what went wrong if anything.
+        The request is recorded against the phase once the website answered it,
+        like upload_core.UploadTransaction.open does.
+        :param phase: one of PhaseCounter.PHASES
+        :param request: the coroutine of AsyncUploader.open or submit_form
+        :return: None
+        """
+        try:
+            self.page = await request
+        except aiohttp.ClientResponseError as e:
+            self.counter.add(phase)
+            self.server_error = e.status >= 500
+            self.signed_out = e.status == 403
+            raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            self.network_error = True
+            raise
+        self.counter.add(phase)
+        if upload_core.is_signed_out(self.page, 200):
+            self.signed_out = True
+            raise IOError('Signed out of the website at ' + self.page.url)
+
+    def replace_form(self):
+        """
+        :return: the replace form of the current page, or None if it is not there
+        """
+        if self.page is None:
+            return None
+        return self.page.form(id='islandora-datastream-version-replace-form')
+
+    async def acquire_lock(self):
+        """
+        Acquires the lock of the object in order to modify it
+        :return: a boolean indicating if the acquisition was successful
+        """
+        try:
+            await self.open('lock', self.manage_url)
+            if self.replace_form() is not None:
+                return True
+            lock_link = upload_core.get_lock_link(self.page)
+            if lock_link is None:
+                self.lock_failed = True
+                self.locked_by_other = True
+                return False
+            await self.open('lock', upload_core.base_url + lock_link)
+            await self.submit('lock', self.page.form(class_='confirmation'))
+            return True
+        except Exception as e:
+            self.lock_failed = True
+            return False
+
+    async def replace(self, file):
+        """
+        Replaces the MODS datastream with the file. The lock must be held.
+        :param file: the path of the MODS XML file
+        """
+        form = self.replace_form()
+        if form is None:
+            with timings.time('replace_page'):
+                await self.open('replace', self.manage_url)
+                form = self.replace_form()
+        with timings.time('replace_submit'):
+            await self.submit('replace', form, submit='op', file_field='files[file]', file_path=file)
+
+    async def release_lock(self):
+        """
+        Releases the lock of the object in order to let others modify it.
+        """
+        try:
+            unlock_link = upload_core.get_unlock_link(self.page) if self.page is not None else None
+            if unlock_link is None:
+                await self.open('unlock', self.manage_url)
+                unlock_link = upload_core.get_unlock_link(self.page)
+            if unlock_link is not None:
+                await self.open('unlock', upload_core.base_url + unlock_link)
+                await self.submit('unlock', self.page.form(class_='confirmation'))
+        except Exception as e:
+            pass
+
+
+class AsyncUploader(object):
+    """
+    Uploads MODS XML files with a single shared aiohttp session
+    """
+
+    def __init__(self, controller=None, max_connections=None, cancel=None):
+        """
+        :param controller: the concurrency.AdaptiveLimit deciding how many objects
+        are processed at once, defaults to a fixed limit
+        :param max_connections: the size of the shared connection pool,
+        defaults to the max of the controller
+        :param cancel: an optional threading.Event set to cancel the uploads, see
+        upload_core.upload_object
+        """
+        self.controller = controller or AdaptiveLimit(upload_core.async_initial_concurrency,
+                                                      maximum=upload_core.async_max_concurrency, adaptive=False)
+        self.max_connections = max_connections or self.controller.maximum
+        self.session = None
+        # The credentials to sign in again with when the session expires
+        self.credentials = None
+        # Increased every time the session is signed in
+        self.generation = 0
+        self.signed_in_at = 0
+        self.reauth_lock = None
+        self.cancel = cancel
+        # What went wrong the last time signing in failed for a reason other than
+        # the username or password, None if it did not
+        self.error = None
+
+    async def __aenter__(self):
+        self.reauth_lock = asyncio.Lock()
+        connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=keepalive_timeout)
+        # unsafe allows cookies from IP address hosts e.g. a local test server
+        self.session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                             trace_configs=[ratelimit.trace_config()])
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def open(self, url, method='get', session=None, **kwargs):
+        """
+        Opens a page and parses it
+        :param url: the absolute URL of the page
+        :param method: the HTTP method
+        :param session: the aiohttp.ClientSession to open it with, defaults to the shared one
+        :return: the page_parser.Page, with the final URL after redirects
+        """
+        async with (session or self.session).request(method, url, **kwargs) as response:
+            response.raise_for_status()
+            text = await response.text()
+            with timings.time('html_parse'):
+                return parse_page(text, str(response.url))
+
+    async def submit_form(self, form, submit=None, file_field=None, file_path=None):
+        """
+        Submits a form the way a browser would
+        :param form: the page_parser.Form
+        :param submit: the name of the submit button to click, if any
+        :param file_field: the name of the file input to fill, if any
+        :param file_path: the path of the file to upload in file_field
+        :return: the resulting page_parser.Page
+        """
+        url = form.action
+        method = form.method
+        fields = form.fields(submit)
+        if method == 'get':
+            return await self.open(url, params=fields)
+        if file_field is None:
+            return await self.open(url, method, data=fields)
+        data = aiohttp.FormData()
+        for name, value in fields:
+            data.add_field(name, value)
+        # Large files are read block by block while the request is sent, and closed once it is answered
+        with upload_core.UploadFile(file_path) as upload:
+            data.add_field(file_field, upload.payload(), filename=upload.filename, content_type=upload.content_type)
+            return await self.open(url, method, data=data)
+
+    async def login(self, username, password):
+        """
+        Signs into the DOH website with a cookie jar of its own, so the
+        shared session keeps its cookies until new ones are known to work
+        :param username: the username to login with
+        :param password: the password to login with
+        :return: the aiohttp.CookieJar of the signed in session, or None if the username or password is wrong
+        :raises SignInError: if the website could not be reached, answered with an error or without the login form
+        """
+        url = upload_core.base_url + '/user/login'
+        jar = aiohttp.CookieJar(unsafe=True)
+        # Shares the connection pool, closing it leaves the connector open
+        async with aiohttp.ClientSession(connector=self.session.connector, connector_owner=False, cookie_jar=jar,
+                                         trace_configs=[ratelimit.trace_config()]) as session:
+            try:
+                with timings.time('sign_in'):
+                    page = await self.open(url, session=session)
+                    form = page.form(id='user-login')
+                    if form is None:
+                        raise sessions.SignInError('there is no login form at ' + url)
+                    fields = [(name, value) for name, value in form.fields('op') if name not in ('name', 'pass')]
+                    fields += [('name', username), ('pass', password)]
+                    page = await self.open(form.action, 'post', session=session, data=fields)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise sessions.SignInError('could not sign in at ' + url + ': ' + (str(e) or type(e).__name__))
+        if page.title != username:
+            return None
+        return jar
+
+    def use(self, cookies, credentials):
+        """
+        Replaces the cookies of the shared session with the ones of a new sign in
+        :param cookies: the cookies of the signed in session, an aiohttp.CookieJar or a requests cookie jar
+        :param credentials: the (username, password) to sign in again with when the session expires
+        :return: None
+        """
+        url = URL(upload_core.base_url)
+        if isinstance(cookies, aiohttp.CookieJar):
+            cookies = cookies.filter_cookies(url)
+        else:
+            cookies = {cookie.name: cookie.value for cookie in cookies}
+        self.session.cookie_jar.clear()
+        self.session.cookie_jar.update_cookies(cookies, url)
+        self.credentials = credentials
+        self.generation = self.generation + 1
+        self.signed_in_at = time.monotonic()
+
+    async def sign_in(self, username, password):
+        """
+        Signs into the DOH website, the session cookies are then
+        shared by every upload. Tried again after a SignInError
+        as often as sessions.sign_in_retries.
+        :param username: the username to login with
+        :param password: the password to login with
+        :return: a boolean indicating if the sign in was successful, self.error
+        tells why it was not if it was not the username or password
+        """
+        for attempt in range(sessions.sign_in_retries + 1):
+            try:
+                jar = await self.login(username, password)
+                self.error = None
+                break
+            except sessions.SignInError as e:
+                jar = None
+                self.error = str(e)
+            if attempt < sessions.sign_in_retries:
+                await asyncio.sleep(sessions.sign_in_backoff * 2 ** attempt)
+        if jar is None:
+            return False
+        self.use(jar, (username, password))
+        return True
+
+    async def reauthenticate(self, generation):
+        """
+        Signs in again after an upload found the session signed out. Only
+        the first upload to ask signs in, the others wait for it.
+        :param generation: the generation of the session when the upload started
+        :return: sessions.RETRY if the upload should be tried again, sessions.DENIED if not,
+        sessions.UNAVAILABLE if signing in failed for a reason other than the credentials
+        """
+        async with self.reauth_lock:
+            # Another upload already signed in again
+            if self.generation != generation:
+                return sessions.RETRY
+            # Just signed in, so the page was denied for another reason
+            if self.credentials is None or time.monotonic() - self.signed_in_at < sessions.reauth_interval:
+                return sessions.DENIED
+            try:
+                jar = await self.login(*self.credentials)
+            except sessions.SignInError as e:
+                print('Could not sign in again: ' + str(e))
+                return sessions.UNAVAILABLE
+            if jar is None:
+                return sessions.DENIED
+            self.use(jar, self.credentials)
+            return sessions.RETRY
+
+    async def upload_xml(self, file, repo, num):
+        """
+        Uploads the MODS XML file to the appropriate object given the
+        repository namespace and number of the specific object.
+        :param file: the path of the MODS XML file to reingest
+        :param repo: the repository namespace derived from the file name
+        :param num: the number of the object derived from the file name
+        :return: a boolean indicating if the upload was successful
+        """
+        return await self.upload_object(file, repo, num) == upload_core.UPLOADED
+
+    async def upload_object(self, file, repo, num):
+        """
+        Makes one attempt at uploading the MODS XML file, see upload_xml. The
+        attempt is started over once if the session turns out to have expired.
+        :param file: the path of the MODS XML file to reingest
+        :param repo: the repository namespace derived from the file name
+        :param num: the number of the object derived from the file name
+        :return: the outcome of the attempt, see upload_core.outcome_of
+        """
+        if self.cancelled():
+            return upload_core.CANCELLED
+        start = time.monotonic()
+        generation = self.generation
+        transaction, success = await self.transact(file, repo, num)
+        # Signed out e.g. as the session expired: sign in again, once
+        # for all the uploads that found out, and start over
+        if transaction.signed_out:
+            reauthenticated = await self.reauthenticate(generation)
+            if reauthenticated == sessions.RETRY:
+                transaction, success = await self.transact(file, repo, num)
+            elif reauthenticated == sessions.UNAVAILABLE:
+                # Retried later, like a server error
+                transaction.network_error = True
+        latency = time.monotonic() - start
+        timings.observe('object', latency)
+        self.controller.record(latency, transaction.server_error, transaction.lock_failed)
+        return upload_core.outcome_of(transaction, success)
+
+    def cancelled(self):
+        """
+        :return: whether the uploads were cancelled
+        """
+        return self.cancel is not None and self.cancel.is_set()
+
+    async def transact(self, file, repo, num):
+        """
+        Replaces the MODS of an object once with the selected backend, see backends.py
+        :param file: the path of the MODS XML file to reingest
+        :param repo: the repository namespace derived from the file name
+        :param num: the number of the object derived from the file name
+        :return: a tuple of the transaction, see upload_core.outcome_of, and whether the MODS was replaced
+        """
+        return await backends.current().transact_async(self, file, repo, num)
+
+    async def scrape(self, file, repo, num):
+        """
+        Runs the lock -> replace -> unlock transaction of an object once
+        through the pages of the website, the scraping backend
+        :param file: the path of the MODS XML file to reingest
+        :param repo: the repository namespace derived from the file name
+        :param num: the number of the object derived from the file name
+        :return: a tuple of the AsyncTransaction and whether the MODS was replaced
+        """
+        transaction = AsyncTransaction(self, repo, num)
+        success = False
+        try:
+            with timings.time('lock'):
+                locked = await transaction.acquire_lock()
+            if locked and self.cancelled():
+                transaction.cancelled = True
+                with timings.time('unlock'):
+                    await transaction.release_lock()
+            elif locked:
+                await transaction.replace(file)
+                with timings.time('unlock'):
+                    await transaction.release_lock()
+                success = True
+            elif transaction.signed_out:
+                print('Failed to update object: ' + file + ' as the website signed us out.')
+            else:
+                print('Failed to update object: ' + file + ' as the lock could not be acquired.')
+        except Exception as e:
+            print('Failed to update object: ' + file)
+            with timings.time('unlock'):
+                await transaction.release_lock()
+        return transaction, success
+
+    async def upload_all(self, objects, on_started=None, on_result=None, retries=None, on_retry=None):
+        """
+        Uploads objects with at most controller.limit in flight. The objects
+        are pulled lazily so the iterable may be arbitrarily large or still
+        being produced, e.g. by a folder scan.
+        :param objects: an iterable of (key, repository, number, path) tuples
+        :param on_started: optional callback called with the key when an object starts
+        :param on_result: optional callback called with the key and the outcome, see upload_core.outcome_of
+        :param retries: the retry.RetryPolicy deciding what is tried again, if any
+        :param on_retry: optional callback called with the key when an object is put back to be retried
+        :return: the number of objects that failed to upload
+        """
+        objects = iter(objects)
+        loop = asyncio.get_running_loop()
+        failed = 0
+        in_flight = 0
+        # Objects taken from the iterator that have no final result yet
+        unfinished = 0
+        # Woken whenever an object finishes, which is also
+        # the only time the controller changes the limit
+        room = asyncio.Condition()
+        # Objects are pulled from the iterator on a helper thread as it may
+        # block, e.g. on a folder scan that is still running
+        queue = asyncio.Queue(maxsize=self.controller.maximum)
+        workers = self.controller.maximum
+        # The objects sleeping until their retry, referenced so they are not garbage collected
+        waiting = set()
+
+        async def feed():
+            nonlocal unfinished
+            while True:
+                # Pulls no more objects than the limit ahead of the uploads, so objects stay
+                # with the iterator, e.g. a paused or cancelled scheduler, until there is room
+                async with room:
+                    await room.wait_for(lambda: unfinished - len(waiting) < self.controller.limit)
+                obj = await loop.run_in_executor(None, next, objects, None)
+                if obj is None:
+                    break
+                unfinished = unfinished + 1
+                await queue.put(obj)
+            # Retries may still put objects back until everything has a result
+            async with room:
+                await room.wait_for(lambda: unfinished == 0)
+            for i in range(workers):
+                await queue.put(None)
+
+        async def requeue(obj, delay):
+            # Sleeps here rather than on a worker so it does not take a slot,
+            # waking up early once cancelled so the object finishes as cancelled
+            deadline = loop.time() + delay
+            while loop.time() < deadline and not self.cancelled():
+                await asyncio.sleep(min(deadline - loop.time(), 0.5))
+            await queue.put(obj)
+
+        async def work():
+            nonlocal failed, in_flight, unfinished
+            while True:
+                obj = await queue.get()
+                if obj is None:
+                    return
+                key, repository, number, path = obj
+                async with room:
+                    await room.wait_for(lambda: in_flight < self.controller.limit)
+                    in_flight = in_flight + 1
+                if on_started is not None:
+                    on_started(key)
+                try:
+                    outcome = await self.upload_object(path, repository, number)
+                except Exception as e:
+                    # Failed rather than retried, the other objects go on
+                    print('Failed to update object: ' + path + ': ' + (str(e) or type(e).__name__))
+                    outcome = upload_core.FAILED
+                delay = retries.retry_delay(key, outcome) if retries is not None else None
+                if delay is not None:
+                    task = asyncio.ensure_future(requeue(obj, delay))
+                    waiting.add(task)
+                    task.add_done_callback(waiting.discard)
+                    if on_retry is not None:
+                        on_retry(key)
+                async with room:
+                    in_flight = in_flight - 1
+                    if delay is None:
+                        unfinished = unfinished - 1
+                    room.notify_all()
+                if delay is not None:
+                    continue
+                if outcome != upload_core.UPLOADED:
+                    failed = failed + 1
+                if on_result is not None:
+                    on_result(key, outcome)
+
+        await asyncio.gather(feed(), *[work() for i in range(workers)])
+        return failed
+
+
+def run(objects, username, password, controller=None, max_connections=None, on_started=None, on_result=None,
+        retries=None, on_retry=None, cancel=None, cookies=None):
+    """
+    Signs in and uploads all the objects on a new event loop.
+    Blocks until every object has been processed.
+    :param objects: an iterable of (key, repository, number, path) tuples
+    :param username: the username to login with
+    :param password: the password to login with
+    :param controller: the concurrency.AdaptiveLimit deciding how many objects are in flight
+    :param max_connections: the size of the shared connection pool
+    :param on_started: optional callback called with the key when an object starts
+    :param on_result: optional callback called with the key and the outcome, see upload_core.outcome_of
+    :param retries: the retry.RetryPolicy deciding what is tried again, if any
+    :param on_retry: optional callback called with the key when an object is put back to be retried
+    :param cancel: an optional threading.Event set to cancel the uploads, the objects
+    not yet replaced then finish as cancelled after releasing any lock they hold
+    :param cookies: the cookies of a session already signed in with the username and
+    password, e.g. a requests cookie jar, to use instead of signing in again
+    :return: the number of objects that failed, or None if the username or password is wrong
+    :raises SignInError: if the sign in failed as the website is unavailable
+    """
+    async def main():
+        async with AsyncUploader(controller, max_connections, cancel) as uploader:
+            if cookies is not None:
+                uploader.use(cookies, (username, password))
+                return await uploader.upload_all(remaining, on_started, on_result, retries, on_retry)
+            # Sign in while the first object is pulled, which starts the
+            # folder scan and the validation processes
+            signing_in = asyncio.ensure_future(uploader.sign_in(username, password))
+            first = await asyncio.get_running_loop().run_in_executor(None, next, remaining, None)
+            if not await signing_in:
+                if uploader.error is not None:
+                    raise sessions.SignInError(uploader.error)
+                return None
+            pending = remaining if first is None else itertools.chain([first], remaining)
+            return await uploader.upload_all(pending, on_started, on_result, retries, on_retry)
+
+    remaining = iter(objects)
+
+    return asyncio.run(main())
@@ -0,0 +1,491 @@
+"""
+How the MODS datastream of an object is replaced, behind one interface
+so both upload engines can use any of them:
+- scraping drives the website's pages like a browser: the replace page,
+  the lock link and its confirmation, the replace form and the release
+  (upload_core.UploadTransaction), 6 requests for an object not locked yet.
+- rest replaces the datastream with one request to the Islandora REST
+  API (islandora_rest), holding the lock of the object through the lock
+  endpoint of the API while it does, as the datastream update does not
+  take the lock itself: 3 requests per object. Websites that do not
+  expose the API or its lock endpoint, or do not let the user use them,
+  are found out on the first object and scraped instead.
+- mock makes no requests at all and keeps what it is sent in memory,
+  for measuring the engines on their own in tests and benchmarks.
+A backend's transact() runs on the threads of the threads engine with a
+signed in requests.Session, its transact_async() on the event loop of
+the asyncio engine with the AsyncUploader.
+"""
+import asyncio
+import random
+import threading
+import time
+
+import requests
+
+import upload_core
+from metrics import timings
+
+SCRAPING = 'scraping'
+REST = 'rest'
+MOCK = 'mock'
+BACKENDS = (SCRAPING, REST, MOCK)
+
+# The backend the uploads use
+backend = SCRAPING
+# How long the mock backend takes per object, in seconds
+mock_latency = 0.0
+# The fraction of objects the mock backend fails with a server error
+mock_error_rate = 0.0
+
+# The statuses of a REST request meaning the website does not expose the API to the user
+REST_UNAVAILABLE = (401, 403, 404, 405, 501)
+
+
+class RestUnavailable(Exception):
+    """
+    The website does not accept REST datastream updates
+    """
+
+    def __init__(self, status, request='datastream update'):
+        """
+        :param status: the HTTP status code the website answered with
+        :param request: what the request was for
+        """
+        super(RestUnavailable, self).__init__('the website answered ' + str(status) + ' to a REST ' + request)
+        self.status = status
+
+
+class Transaction(object):
+    """
+    What happened to an object, read by upload_core.outcome_of and
+    reported to the concurrency controller like an UploadTransaction
+    """
+
+    def __init__(self, repo, num, counter=None):
+        """
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :param counter: the PhaseCounter to record requests in, defaults to upload_core.request_counts
+        """
+        self.pid = repo + ':' + num
+        self.counter = counter or upload_core.request_counts
+        self.counter.add_object()
+        self.server_error = False
+        self.lock_failed = False
+        self.network_error = False
+        self.locked_by_other = False
+        self.signed_out = False
+        self.cancelled = False
+
+
+class RestTransaction(Transaction):
+    """
+    The lock, the REST update and the release of one object. Each step has
+    a version for a requests.Session and one for an aiohttp.ClientSession.
+    """
+
+    def __init__(self, repo, num, counter=None):
+        super(RestTransaction, self).__init__(repo, num, counter)
+        object_url = upload_core.base_url + '/islandora/rest/v1/object/' + repo + '%3A' + num
+        self.lock_url = object_url + '/lock'
+        # PHP does not read multipart PUT requests, islandora_rest takes a POST saying it is a PUT
+        self.datastream_url = object_url + '/datastream/MODS?method=PUT'
+
+    def locked(self, status):
+        """
+        :param status: the HTTP status code of the request for the lock
+        :return: whether the lock was acquired, or was already held by the user
+        :raises RestUnavailable: if the website does not expose the lock endpoint to the user
+        :raises IOError: if the request failed
+        """
+        self.counter.add('lock')
+        if status == 409:
+            self.lock_failed = True
+            self.locked_by_other = True
+            return False
+        if status in REST_UNAVAILABLE:
+            raise RestUnavailable(status, 'lock request')
+        if status >= 500:
+            self.server_error = True
+        if status >= 300:
+            self.lock_failed = True
+            raise IOError('Status ' + str(status) + ' from the REST lock of ' + self.pid)
+        return True
+
+    def updated(self, status):
+        """
+        :param status: the HTTP status code of the REST update
+        :return: None
+        :raises RestUnavailable: if the website does not expose the API to the user
+        :raises IOError: if the update failed
+        """
+        self.counter.add('replace')
+        if status in REST_UNAVAILABLE:
+            raise RestUnavailable(status)
+        if status >= 500:
+            self.server_error = True
+        if status >= 300:
+            raise IOError('Status ' + str(status) + ' from the REST update of ' + self.pid)
+
+    def acquire_lock(self, session):
+        """
+        :param session: the signed in requests.Session
+        :return: whether the object is locked by the user and may be updated
+        """
+        try:
+            response = session.post(self.lock_url)
+        except requests.RequestException as e:
+            self.network_error = True
+            raise
+        return self.locked(response.status_code)
+
+    def update(self, session, file):
+        """
+        Replaces the MODS datastream with the file
+        :param session: the signed in requests.Session
+        :param file: the path of the MODS XML file
+        :return: None
+        """
+        with upload_core.UploadFile(file) as upload:
+            try:
+                response = session.post(self.datastream_url, **upload.request_arguments([], 'file'))
+            except requests.RequestException as e:
+                self.network_error = True
+                raise
+        self.updated(response.status_code)
+
+    def release_lock(self, session):
+        """
+        Releases the lock, failing quietly as the website releases it after a while anyway
+        :param session: the signed in requests.Session
+        :return: None
+        """
+        try:
+            session.delete(self.lock_url)
+        except requests.RequestException as e:
+            return
+        self.counter.add('unlock')
+
+    async def acquire_lock_async(self, session):
+        """
+        :param session: the signed in aiohttp.ClientSession
+        :return: whether the object is locked by the user and may be updated
+        """
+        import aiohttp
+        try:
+            async with session.post(self.lock_url) as response:
+                await response.read()
+                status = response.status
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            self.network_error = True
+            raise
+        return self.locked(status)
+
+    async def update_async(self, session, file):
+        """
+        Replaces the MODS datastream with the file
+        :param session: the signed in aiohttp.ClientSession
+        :param file: the path of the MODS XML file
+        :return: None
+        """
+        import aiohttp
+        with upload_core.UploadFile(file) as upload:
+            data = aiohttp.FormData()
+            data.add_field('file', upload.payload(), filename=upload.filename, content_type=upload.content_type)
+            try:
+                async with session.post(self.datastream_url, data=data) as response:
+                    await response.read()
+                    status = response.status
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.network_error = True
+                raise
+        self.updated(status)
+
+    async def release_lock_async(self, session):
+        """
+        Releases the lock, failing quietly as the website releases it after a while anyway
+        :param session: the signed in aiohttp.ClientSession
+        :return: None
+        """
+        import aiohttp
+        try:
+            async with session.delete(self.lock_url) as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return
+        self.counter.add('unlock')
+
+
+class Backend(object):
+    """
+    Replaces the MODS datastream of one object
+    """
+
+    name = None
+
+    def transact(self, file, repo, num, session, cancel=None):
+        """
+        Makes one attempt at replacing the MODS of an object, on a thread
+        :param file: the path of the MODS XML file
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :param session: the signed in requests.Session to use
+        :param cancel: an optional threading.Event, if set before the MODS is
+        replaced the object is left as it is
+        :return: a tuple of the transaction, read by upload_core.outcome_of, and whether the MODS was replaced
+        """
+        raise NotImplementedError()
+
+    async def transact_async(self, uploader, file, repo, num):
+        """
+        Makes one attempt at replacing the MODS of an object, on the event loop
+        :param uploader: the async_engine.AsyncUploader whose session is used
+        :param file: the path of the MODS XML file
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :return: a tuple of the transaction, read by upload_core.outcome_of, and whether the MODS was replaced
+        """
+        raise NotImplementedError()
+
+
+class ScrapingBackend(Backend):
+    """
+    Locks, replaces and releases through the pages of the website
+    """
+
+    name = SCRAPING
+
+    def transact(self, file, repo, num, session, cancel=None):
+        return upload_core.scrape(file, repo, num, session, cancel)
+
+    async def transact_async(self, uploader, file, repo, num):
+        return await uploader.scrape(file, repo, num)
+
+
+class RestBackend(Backend):
+    """
+    Replaces the MODS with one request to the Islandora REST API while
+    holding the lock of the object, falling back to scraping if the
+    website does not expose the API or its lock endpoint
+    """
+
+    name = REST
+
+    def __init__(self):
+        # Whether the API works, None until an object found out
+        self.available = None
+        self.fallback = ScrapingBackend()
+        self.lock = threading.Lock()
+
+    def rejected(self, transaction, file, error):
+        """
+        Handles an update the website turned down, once it is known that the API works
+        :param transaction: the RestTransaction of the object
+        :param file: the path of the MODS XML file
+        :param error: the RestUnavailable saying why
+        :return: a tuple of the transaction and False
+        """
+        if error.status in (401, 403):
+            # The session expired, upload_core.upload_object signs in again and starts over
+            transaction.signed_out = True
+        else:
+            print('Failed to update object: ' + file + ' as ' + str(error))
+        return transaction, False
+
+    def unavailable(self, error):
+        """
+        Falls back to scraping for every object from now on
+        :param error: the RestUnavailable saying why
+        :return: None
+        """
+        with self.lock:
+            if self.available is None:
+                print('Scraping the pages instead of using the REST API as ' + str(error))
+            self.available = False
+
+    def probed(self, transaction, success, error):
+        """
+        Handles the scraping of an object the REST API turned down with a 401 or 403
+        before it is known whether the API works. If the pages were open to the user
+        the API is not and every object is scraped from now on. If they were not, the
+        session expired: upload_core.upload_object signs in again and starts over,
+        trying the API again.
+        :param transaction: the transaction of the scraping
+        :param success: whether the scraping replaced the MODS
+        :param error: the RestUnavailable the API answered with
+        :return: None
+        """
+        if success or transaction.locked_by_other:
+            self.unavailable(error)
+
+    def transact(self, file, repo, num, session, cancel=None):
+        if self.available is False:
+            return self.fallback.transact(file, repo, num, session, cancel)
+        transaction = RestTransaction(repo, num)
+        success = False
+        locked = False
+        error = None
+        try:
+            with timings.time('lock'):
+                locked = transaction.acquire_lock(session)
+            if locked and cancel is not None and cancel.is_set():
+                transaction.cancelled = True
+            elif locked:
+                with timings.time('replace_submit'):
+                    transaction.update(session, file)
+                success = True
+            elif transaction.locked_by_other:
+                print('Failed to update object: ' + file + ' as it is locked by someone else.')
+        except RestUnavailable as e:
+            error = e
+        except Exception as e:
+            print('Failed to update object: ' + file + ': ' + str(e))
+        if locked:
+            with timings.time('unlock'):
+                transaction.release_lock(session)
+        if error is None:
+            if success:
+                self.available = True
+            return transaction, success
+        if self.available:
+            return self.rejected(transaction, file, error)
+        if error.status in (401, 403):
+            # Also the answer to an expired session, the pages tell whether the user is signed in
+            transaction, success = self.fallback.transact(file, repo, num, session, cancel)
+            self.probed(transaction, success, error)
+            return transaction, success
+        self.unavailable(error)
+        return self.fallback.transact(file, repo, num, session, cancel)
+
+    async def transact_async(self, uploader, file, repo, num):
+        if self.available is False:
+            return await self.fallback.transact_async(uploader, file, repo, num)
+        transaction = RestTransaction(repo, num)
+        success = False
+        locked = False
+        error = None
+        try:
+            with timings.time('lock'):
+                locked = await transaction.acquire_lock_async(uploader.session)
+            if locked and uploader.cancelled():
+                transaction.cancelled = True
+            elif locked:
+                with timings.time('replace_submit'):
+                    await transaction.update_async(uploader.session, file)
+                success = True
+            elif transaction.locked_by_other:
+                print('Failed to update object: ' + file + ' as it is locked by someone else.')
+        except RestUnavailable as e:
+            error = e
+        except Exception as e:
+            print('Failed to update object: ' + file + ': ' + str(e))
+        if locked:
+            with timings.time('unlock'):
+                await transaction.release_lock_async(uploader.session)
+        if error is None:
+            if success:
+                self.available = True
+            return transaction, success
+        if self.available:
+            return self.rejected(transaction, file, error)
+        if error.status in (401, 403):
+            # Also the answer to an expired session, the pages tell whether the user is signed in
+            transaction, success = await self.fallback.transact_async(uploader, file, repo, num)
+            self.probed(transaction, success, error)
+            return transaction, success
+        self.unavailable(error)
+        return await self.fallback.transact_async(uploader, file, repo, num)
+
+
+class MockBackend(Backend):
+    """
+    Pretends to replace the MODS without any request, keeping what it is
+    sent by PID. Objects can be made to fail with a server error at random
+    or be locked by someone else.
+    """
+
+    name = MOCK
+
+    def __init__(self, latency=None, error_rate=None, locked=()):
+        """
+        :param latency: how long every object takes, in seconds, defaults to mock_latency
+        :param error_rate: the fraction of objects failed with a server error, defaults to mock_error_rate
+        :param locked: the PIDs locked by someone else e.g. doh:1
+        """
+        self.latency = mock_latency if latency is None else latency
+        self.error_rate = mock_error_rate if error_rate is None else error_rate
+        self.locked = set(locked)
+        self.lock = threading.Lock()
+        # PID -> the MODS it was sent
+        self.mods = {}
+
+    def attempt(self, file, repo, num, cancelled):
+        """
+        :param file: the path of the MODS XML file
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :param cancelled: whether the uploads were cancelled
+        :return: a tuple of the Transaction and whether the MODS was replaced
+        """
+        transaction = Transaction(repo, num)
+        transaction.counter.add('replace')
+        if transaction.pid in self.locked:
+            transaction.lock_failed = True
+            transaction.locked_by_other = True
+            return transaction, False
+        if cancelled:
+            transaction.cancelled = True
+            return transaction, False
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            transaction.server_error = True
+            return transaction, False
+        with timings.time('file_read'):
+            with open(file, 'rb') as f:
+                contents = f.read()
+        with self.lock:
+            self.mods[transaction.pid] = contents
+        return transaction, True
+
+    def transact(self, file, repo, num, session, cancel=None):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self.attempt(file, repo, num, cancel is not None and cancel.is_set())
+
+    async def transact_async(self, uploader, file, repo, num):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return self.attempt(file, repo, num, uploader.cancelled())
+
+
+"""
+The backend instances, kept so the rest backend remembers whether the API works
+"""
+instances = {}
+instances_lock = threading.Lock()
+
+
+def create(name):
+    """
+    :param name: SCRAPING, REST or MOCK
+    :return: a new Backend
+    :raises ValueError: if there is no such backend
+    """
+    if name == SCRAPING:
+        return ScrapingBackend()
+    if name == REST:
+        return RestBackend()
+    if name == MOCK:
+        return MockBackend()
+    raise ValueError('No backend named ' + str(name) + ', choose one of ' + ', '.join(BACKENDS))
+
+
+def current():
+    """
+    :return: the Backend of the selected backend
+    """
+    with instances_lock:
+        instance = instances.get(backend)
+        if instance is None:
+            instance = instances[backend] = create(backend)
+        return instance
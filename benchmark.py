@@ -0,0 +1,234 @@
+"""
+Throughput benchmark of the upload engines against the local
+stand-in website (mock_islandora.py), so performance changes can
+be verified without touching production.
+Every engine, backend (see backends.py) and concurrency level is run
+in its own process so
+that the peak memory of each one is measured on its own, while
+the stand-in website is served from this process.
+
+Example:
+    python benchmark.py --objects 500 --concurrency 10 50 200 --latency 0.02
+    python benchmark.py --backends scraping rest mock --concurrency 50
+    python benchmark.py --rate 100 --concurrency 10 50
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import backends
+import ratelimit
+from mock_islandora import MockIslandora
+
+# The credentials the stand-in website accepts during the benchmark
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+
+
+def percentile(values, fraction):
+    """
+    :param values: a sorted list of numbers
+    :param fraction: the percentile as a fraction e.g. 0.99
+    :return: the value at the percentile, nearest rank
+    """
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_memory():
+    """
+    :return: the peak resident memory of this process in MB, or None where it can't be measured
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def write_objects(folder, count):
+    """
+    Writes MODS files for the benchmark objects
+    :param folder: the folder to write them in
+    :param count: the number of objects
+    :return: a list of (repository, number, path) tuples
+    """
+    objects = []
+    for i in range(count):
+        path = os.path.join(folder, 'bench_' + str(i) + '.xml')
+        with open(path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<mods xmlns="http://www.loc.gov/mods/v3">'
+                    '<titleInfo><title>Benchmark object ' + str(i) + '</title></titleInfo>'
+                    '<identifier type="local">bench:' + str(i) + '</identifier></mods>\n')
+        objects.append(('bench', str(i), path))
+    return objects
+
+
+def run_threads(objects, concurrency):
+    """
+    Uploads the objects with the threads engine at a fixed concurrency
+    :param objects: a list of (repository, number, path) tuples
+    :param concurrency: the number of objects uploaded at once
+    :return: a tuple of the list of per object latencies and the number of failures
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from upload_core import UPLOADED, upload_object
+
+    def upload(obj):
+        start = time.monotonic()
+        outcome = upload_object(obj[2], obj[0], obj[1])
+        return time.monotonic() - start, outcome == UPLOADED
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(upload, objects))
+    return [latency for latency, success in results], sum(1 for latency, success in results if not success)
+
+
+def run_async(objects, concurrency):
+    """
+    Uploads the objects with the asyncio engine at a fixed concurrency
+    :param objects: a list of (repository, number, path) tuples
+    :param concurrency: the number of objects in flight at once
+    :return: a tuple of the list of per object latencies and the number of failures
+    """
+    import async_engine
+    from concurrency import AdaptiveLimit
+    started = {}
+    latencies = []
+
+    def on_started(key):
+        started[key] = time.monotonic()
+
+    def on_result(key, outcome):
+        latencies.append(time.monotonic() - started.pop(key))
+
+    failed = async_engine.run([(i,) + obj for i, obj in enumerate(objects)], USERNAME, PASSWORD,
+                              AdaptiveLimit(concurrency, maximum=concurrency, adaptive=False),
+                              on_started=on_started, on_result=on_result)
+    return latencies, failed
+
+
+def run_one(args):
+    """
+    Runs a single engine, backend and concurrency level, in the process started by run()
+    :param args: the parsed command line arguments
+    :return: None, the result is printed as JSON
+    """
+    import upload_core
+    upload_core.base_url = args.url
+    backends.backend = args.backend
+    ratelimit.configure(args.rate, args.burst)
+    upload_core.request_counts.reset()
+    objects = []
+    for name in sorted(os.listdir(args.folder)):
+        objects.append(('bench', name[len('bench_'):-len('.xml')], os.path.join(args.folder, name)))
+    if not upload_core.sign_in(USERNAME, PASSWORD):
+        raise SystemExit('Could not sign in to ' + args.url)
+    start = time.monotonic()
+    if args.engine == 'async':
+        latencies, failed = run_async(objects, args.run_one)
+    else:
+        latencies, failed = run_threads(objects, args.run_one)
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    print(json.dumps({
+        'engine': args.engine,
+        'backend': args.backend,
+        'concurrency': args.run_one,
+        'objects': len(objects),
+        'failed': failed,
+        'seconds': elapsed,
+        'objects_per_second': len(objects) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_memory_mb': peak_memory(),
+    }))
+
+
+def run(args):
+    """
+    Serves the stand-in website and runs every engine with every backend at every concurrency level
+    :param args: the parsed command line arguments
+    :return: the list of results
+    """
+    folder = tempfile.mkdtemp(prefix='doh_benchmark_')
+    website = MockIslandora(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            users={USERNAME: PASSWORD}).start()
+    results = []
+    try:
+        write_objects(folder, args.objects)
+        print('{:<8} {:<9} {:>11} {:>10} {:>10} {:>9} {:>9} {:>9} {:>7}'.format(
+            'engine', 'backend', 'concurrency', 'objects/s', 'requests/s', 'p50 ms', 'p99 ms', 'peak MB', 'failed'))
+        rate = [] if args.rate is None else ['--rate', str(args.rate), '--burst', str(args.burst)]
+        for engine in args.engines:
+            for backend in args.backends:
+                for concurrency in args.concurrency:
+                    requests_before = website.requests
+                    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                                      '--run-one', str(concurrency), '--engine', engine,
+                                                      '--backend', backend, '--url', website.url,
+                                                      '--folder', folder] + rate)
+                    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+                    # Signing in is made before the clock starts, the rate is a little high for short runs
+                    result['requests_per_second'] = (website.requests - requests_before) / result['seconds']
+                    results.append(result)
+                    memory = result['peak_memory_mb']
+                    print('{:<8} {:<9} {:>11} {:>10.1f} {:>10.1f} {:>9.1f} {:>9.1f} {:>9} {:>7}'.format(
+                        engine, backend, concurrency, result['objects_per_second'], result['requests_per_second'],
+                        result['p50_ms'], result['p99_ms'], '-' if memory is None else format(memory, '.1f'),
+                        result['failed']))
+    finally:
+        website.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measures the upload engines against a local stand-in website.')
+    parser.add_argument('--objects', type=int, default=300, help='the number of objects uploaded per run '
+                                                                 '(default: %(default)s)')
+    parser.add_argument('--engines', nargs='+', choices=['threads', 'async'], default=['threads', 'async'],
+                        help='the engines to measure (default: both)')
+    parser.add_argument('--backends', nargs='+', choices=backends.BACKENDS, default=[backends.SCRAPING],
+                        help='the backends to measure, mock measures the engines alone (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200],
+                        help='the fixed concurrency levels to measure (default: 10 50 200)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='how long the website takes to answer every request, in seconds (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help='a random extra delay of up to this many seconds per request (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='the fraction of requests answered with a 503 (default: %(default)s)')
+    parser.add_argument('--rate', type=float,
+                        help='the most requests per second each run makes, see ratelimit.py (default: no limit)')
+    parser.add_argument('--burst', type=int, default=ratelimit.burst,
+                        help='the number of requests that may go at once under --rate (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='path of a JSON file to write the results to')
+    # Used by run() to measure a single engine and concurrency level in its own process
+    parser.add_argument('--run-one', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--engine', default='threads', help=argparse.SUPPRESS)
+    parser.add_argument('--backend', default=backends.SCRAPING, help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--folder', help=argparse.SUPPRESS)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.run_one is not None:
+        run_one(args)
+    else:
+        run(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Change detection stage run before uploading.
+Compares a normalized hash of each local MODS file against the
+MODS datastream the website currently has, so that objects which
+would not change are neither locked nor given a useless new
+datastream version. What the website has is cached in the journal
+and revalidated with conditional requests, so repeat runs mostly
+get cheap 304 Not Modified answers instead of the whole datastream.
+"""
+import collections
+import hashlib
+import queue
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+import upload_core
+
+# How long a fingerprint without an ETag or Last-Modified
+# to revalidate with is trusted, in seconds
+max_age = 24 * 60 * 60
+# The number of datastreams fetched at once
+default_threads = 16
+
+
+def normalized_hash(data):
+    """
+    Hashes MODS XML so that formatting differences which don't change
+    the content (attribute order, whitespace between elements, the XML
+    declaration, encoding) give the same hash
+    :param data: the XML as bytes
+    :return: the hex SHA-1 of the canonical form, or of the raw bytes if it is not well-formed
+    """
+    try:
+        canonical = ElementTree.canonicalize(data.decode('utf-8-sig') if isinstance(data, bytes) else data,
+                                             strip_text=True)
+        data = canonical.encode('utf-8')
+    except (ElementTree.ParseError, UnicodeDecodeError) as e:
+        pass
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_normalized_hash(path):
+    """
+    :param path: the path of a MODS XML file
+    :return: the normalized hash of its content
+    """
+    with open(path, 'rb') as f:
+        return normalized_hash(f.read())
+
+
+def mods_url(repo, num):
+    """
+    :param repo: the repository namespace of the object
+    :param num: the number of the object
+    :return: the URL of the raw MODS datastream of the object
+    """
+    return upload_core.base_url + '/islandora/object/' + repo + '%3A' + num + '/datastream/MODS/view'
+
+
+class ChangeDetector(object):
+    """
+    Decides whether a local file differs from the MODS on the website
+    """
+
+    def __init__(self, results_journal, session=None):
+        """
+        :param results_journal: the Journal caching the fingerprints
+        :param session: the signed in requests session, defaults to one of upload_core.session_manager
+        """
+        self.journal = results_journal
+        self.session = session
+
+    def fetch_fingerprint(self, repo, num):
+        """
+        Gets the normalized hash of the MODS the website has for an object,
+        from the cache when it is still valid
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :return: the hash, or None if the object has no MODS
+        """
+        pid = repo + ':' + num
+        cached = self.journal.get_fingerprint(pid)
+        headers = {}
+        if cached is not None:
+            mods_hash, etag, last_modified, fetched = cached
+            if etag is None and last_modified is None:
+                if time.time() - fetched < max_age:
+                    return mods_hash
+            else:
+                if etag is not None:
+                    headers['If-None-Match'] = etag
+                if last_modified is not None:
+                    headers['If-Modified-Since'] = last_modified
+
+        session = self.session or upload_core.session_manager.session()
+        response = session.get(mods_url(repo, num), headers=headers)
+        if response.status_code == 304:
+            return cached[0]
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        mods_hash = normalized_hash(response.content)
+        self.journal.set_fingerprint(pid, mods_hash, response.headers.get('ETag'),
+                                     response.headers.get('Last-Modified'))
+        return mods_hash
+
+    def is_unchanged(self, repo, num, path):
+        """
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :param path: the path of the local MODS XML file
+        :return: whether the website already has the same MODS. Any error
+        counts as changed so the object is still uploaded.
+        """
+        try:
+            return self.fetch_fingerprint(repo, num) == file_normalized_hash(path)
+        except Exception as e:
+            return False
+
+    def uploaded(self, repo, num, path):
+        """
+        Records that the website now has the local file, so the
+        next run does not need to fetch it
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :param path: the path of the MODS XML file that was uploaded
+        :return: None
+        """
+        self.journal.set_fingerprint(repo + ':' + num, file_normalized_hash(path))
+
+
+def find_changed(objects, detector, threads=default_threads, on_unchanged=None):
+    """
+    Checks objects against the website concurrently, streaming the ones that
+    changed out as soon as they are known so uploads can start right away.
+    The objects are read on a thread of their own, so a checked object is
+    handed over even while the iterable blocks waiting for the next one, e.g.
+    a queue fed by a folder scan or a folder watch.
+    :param objects: an iterable of tuples starting with (repository, number, path)
+    :param detector: the ChangeDetector to check with
+    :param threads: the number of objects checked at once
+    :param on_unchanged: optional callback called with every unchanged object
+    :return: an iterator over the objects that need to be uploaded, in the original order
+    """
+    # Objects read, checks finished (None) and the end of the objects, in the order they happen
+    events = queue.Queue()
+    end = object()
+    # Don't run more than a couple of batches ahead of the uploads
+    room = threading.Semaphore(threads * 2)
+    errors = []
+
+    def read():
+        try:
+            for obj in objects:
+                room.acquire()
+                events.put((obj,))
+        except Exception as e:
+            errors.append(e)
+        events.put(end)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        threading.Thread(target=read, name='change-detection-input', daemon=True).start()
+        pending = collections.deque()
+        ended = False
+        while not ended or len(pending) > 0:
+            event = events.get()
+            if event is end:
+                ended = True
+            elif event is not None:
+                future = executor.submit(detector.is_unchanged, event[0][0], event[0][1], event[0][2])
+                future.add_done_callback(lambda future: events.put(None))
+                pending.append((event[0], future))
+            # Hand over what is already checked
+            while len(pending) > 0 and pending[0][1].done():
+                obj, future = pending.popleft()
+                room.release()
+                if future.result():
+                    if on_unchanged is not None:
+                        on_unchanged(obj)
+                else:
+                    yield obj
+    if len(errors) > 0:
+        raise errors[0]
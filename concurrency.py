@@ -0,0 +1,130 @@
+"""
+Adaptive concurrency control for the upload engines.
+Replaces the fixed number of upload threads with an AIMD
+(additive increase, multiplicative decrease) limit that grows
+while the website answers quickly and backs off as soon as
+response times climb, 5xx errors appear or locks fail.
+"""
+import collections
+import threading
+import time
+
+import upload_core
+
+
+class AdaptiveLimit(object):
+    """
+    AIMD limit on the number of objects being uploaded at once.
+    The engines report every finished object with record() and
+    either gate themselves with acquire()/release() or apply the
+    limit to their pool from an on_change listener.
+    The limit is re-evaluated once per round, i.e. every time as many
+    objects as the current limit have finished, so that every decision
+    is based on a full window of the current load.
+    """
+
+    def __init__(self, initial=upload_core.initial_concurrency, minimum=1, maximum=upload_core.max_concurrency,
+                 latency_tolerance=2.0, error_threshold=0.05, decrease_factor=0.75, adaptive=True):
+        """
+        :param initial: the limit to start at
+        :param minimum: the limit never goes below this
+        :param maximum: the limit never goes above this
+        :param latency_tolerance: back off when the average latency of a round is more than
+        this many times the best latency seen
+        :param error_threshold: back off when more than this fraction of a round had errors
+        :param decrease_factor: what the limit is multiplied by when backing off
+        :param adaptive: if False the limit stays at initial, i.e. the old fixed behaviour
+        """
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = min(max(initial, minimum), self.maximum)
+        self.latency_tolerance = latency_tolerance
+        self.error_threshold = error_threshold
+        self.decrease_factor = decrease_factor
+        self.adaptive = adaptive
+        # The best round average latency, slowly forgotten so a
+        # permanently slower site is eventually accepted as normal
+        self.base_latency = None
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        # (time, limit) of every change
+        self.history = collections.deque([(time.time(), self.limit)], maxlen=200)
+        self.listeners = []
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_count = 0
+        self.window_latency = 0.0
+        self.window_errors = 0
+
+    def on_change(self, listener):
+        """
+        Registers a function called with the new limit whenever it changes.
+        It is called from whichever thread recorded the result.
+        :param listener: the function to call
+        :return: None
+        """
+        self.listeners.append(listener)
+
+    def acquire(self):
+        """
+        Blocks until there is room for one more object under the limit
+        :return: None
+        """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight = self.in_flight + 1
+
+    def release(self):
+        """
+        Frees the room taken by acquire()
+        :return: None
+        """
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+            self.condition.notify_all()
+
+    def record(self, latency, server_error=False, lock_failed=False):
+        """
+        Records a finished object and adjusts the limit at the end of a round
+        :param latency: how long the object took in seconds
+        :param server_error: whether the website answered with a 5xx
+        :param lock_failed: whether the lock of the object could not be acquired
+        :return: None
+        """
+        with self.condition:
+            self.window_count = self.window_count + 1
+            self.window_latency = self.window_latency + latency
+            if server_error or lock_failed:
+                self.window_errors = self.window_errors + 1
+            if not self.adaptive or self.window_count < self.limit:
+                return
+            average = self.window_latency / self.window_count
+            error_rate = self.window_errors / self.window_count
+            self.reset_window()
+            if self.base_latency is None or average < self.base_latency:
+                self.base_latency = average
+            else:
+                self.base_latency = self.base_latency * 1.01
+
+            if error_rate > self.error_threshold or average > self.base_latency * self.latency_tolerance:
+                new_limit = max(self.minimum, int(self.limit * self.decrease_factor))
+            else:
+                new_limit = min(self.maximum, self.limit + 1)
+            if new_limit == self.limit:
+                return
+            self.limit = new_limit
+            self.history.append((time.time(), new_limit))
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener(new_limit)
+
+    def history_text(self, count=6):
+        """
+        :param count: the number of most recent limits to include
+        :return: the recent limits as text e.g. "10 > 11 > 8"
+        """
+        with self.condition:
+            limits = [str(limit) for changed, limit in list(self.history)[-count:]]
+        return ' > '.join(limits)
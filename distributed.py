@@ -0,0 +1,554 @@
+"""
+Distributed reingest of a collection across several machines.
+A coordinator scans the folder once and partitions the objects into
+shards, by repository namespace or by a hash of the PID, in a SQLite
+queue file on storage every machine can reach. Workers claim shards
+from the queue and upload them with the same validation and engines
+as uploader_cli.py, recording the result of every object back in it.
+A claim is a lease renewed by a heartbeat while the worker runs, so the
+shards of a worker that died are claimed again by the others once its
+lease expires; objects it already finished are not uploaded again.
+The results of every worker merge into one report. Running plan again
+adds new files and reopens the shards with objects that failed.
+The folder must be reachable at the same path from every worker.
+SQLite locking works on most shared storage but not all: on NFS without
+working locks, keep the queue on one machine and share it over SMB or
+use a local path when testing.
+
+Example:
+    python distributed.py plan /data/UpdatedXML /shared/reingest.sqlite --by hash --shards 64
+    python distributed.py work /shared/reingest.sqlite -u "Jane Doe" -e async     (on every machine)
+    python distributed.py status /shared/reingest.sqlite
+    python distributed.py report /shared/reingest.sqlite -o report.csv
+"""
+import argparse
+import csv
+import getpass
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+import backends
+import ratelimit
+import sessions
+import upload_core
+import uploader_cli
+from metrics import timings
+from upload_core import session_manager, scan_objects
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+# The results after which an object is not uploaded again when its shard is reclaimed
+FINAL_RESULTS = ('uploaded', 'unchanged', 'invalid')
+
+# How long a claim lasts without a heartbeat, in seconds
+lease_seconds = 300.0
+# How often an idle worker checks for shards to claim, in seconds
+poll_interval = 10.0
+# The number of results a worker writes to the queue at once
+results_batch_size = 200
+# The longest a result waits before being written to the queue, in seconds
+results_flush_interval = 5.0
+
+
+def shard_of(repository, number, by='hash', shards=64):
+    """
+    :param repository: the repository namespace of the object
+    :param number: the number of the object
+    :param by: 'namespace' for a shard per repository namespace, 'hash' to spread
+    the objects evenly over a fixed number of shards
+    :param shards: the number of shards when partitioning by hash
+    :return: the id of the shard the object belongs to
+    """
+    if by == 'namespace':
+        return repository
+    pid = repository + ':' + number
+    # crc32 rather than hash() as it must be the same in every process
+    return 'hash-' + str(zlib.crc32(pid.encode('utf-8')) % shards).zfill(len(str(shards - 1)))
+
+
+class ShardQueue(object):
+    """
+    The shards, their objects and the results, in a SQLite file shared by
+    the coordinator and the workers. Safe to use from any thread.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the SQLite file, created if missing
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # Autocommit, transactions are begun explicitly. The rollback journal
+        # rather than WAL as WAL does not work on network file systems.
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS shards ('
+                                    'id TEXT PRIMARY KEY, state TEXT NOT NULL, worker TEXT, lease_expires REAL, '
+                                    'claims INTEGER NOT NULL DEFAULT 0)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS objects ('
+                                    'repository TEXT NOT NULL, number TEXT NOT NULL, path TEXT NOT NULL, '
+                                    'shard TEXT NOT NULL, PRIMARY KEY (repository, number))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS objects_shard ON objects (shard)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                                    'repository TEXT NOT NULL, number TEXT NOT NULL, path TEXT, result TEXT NOT NULL, '
+                                    'worker TEXT, updated REAL, PRIMARY KEY (repository, number))')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def add_objects(self, objects, by='hash', shards=64, batch_size=1000):
+        """
+        Adds objects to the queue, in the shards they belong to. Objects already in
+        the queue are left alone, shards that were done are reopened for new objects.
+        :param objects: an iterable of (repository, number, path) tuples
+        :param by: how objects are partitioned, see shard_of
+        :param shards: the number of shards when partitioning by hash
+        :param batch_size: the number of objects inserted per transaction
+        :return: the number of objects added
+        """
+        added = 0
+        batch = []
+        for repository, number, path in objects:
+            batch.append((repository, number, path, shard_of(repository, number, by, shards)))
+            if len(batch) == batch_size:
+                added = added + self.insert_objects(batch)
+                batch = []
+        if len(batch) > 0:
+            added = added + self.insert_objects(batch)
+        return added
+
+    def insert_objects(self, batch):
+        """
+        :param batch: a list of (repository, number, path, shard) tuples
+        :return: the number of objects that were not in the queue yet
+        """
+        with self.lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                added = 0
+                # The shards that got new objects, objects already in the queue stay in theirs
+                shards = set()
+                for row in batch:
+                    cursor = connection.execute('INSERT OR IGNORE INTO objects (repository, number, path, shard) '
+                                                'VALUES (?, ?, ?, ?)', row)
+                    if cursor.rowcount == 1:
+                        added = added + 1
+                        shards.add(row[3])
+                connection.executemany('INSERT OR IGNORE INTO shards (id, state) VALUES (?, ?)',
+                                       [(shard, PENDING) for shard in shards])
+                connection.executemany('UPDATE shards SET state = ?, worker = NULL, lease_expires = NULL '
+                                       'WHERE id = ? AND state = ?', [(PENDING, shard, DONE) for shard in shards])
+                connection.execute('COMMIT')
+            except Exception as e:
+                connection.execute('ROLLBACK')
+                raise
+        return added
+
+    def reopen_failed(self):
+        """
+        Makes the shards that are done but have objects without a final result,
+        i.e. that failed to upload, pending again so the workers retry them
+        :return: the number of shards reopened
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                'UPDATE shards SET state = ? WHERE state = ? AND id IN (SELECT o.shard FROM objects o '
+                'LEFT JOIN results r ON r.repository = o.repository AND r.number = o.number '
+                'WHERE r.result IS NULL OR r.result NOT IN (?, ?, ?))', (PENDING, DONE) + FINAL_RESULTS)
+            return cursor.rowcount
+
+    def claim(self, worker, lease=None):
+        """
+        Claims a pending shard, or one whose worker stopped renewing its lease
+        :param worker: the name of the worker
+        :param lease: how long the claim lasts without being renewed, defaults to lease_seconds
+        :return: the id of the shard, or None if there is nothing to claim
+        """
+        now = time.time()
+        with self.lock:
+            connection = self.connection
+            # Taking the write lock first so two workers can not claim the same shard
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT id FROM shards WHERE state = ? OR (state = ? AND lease_expires < ?) '
+                                         'ORDER BY claims, id LIMIT 1', (PENDING, CLAIMED, now)).fetchone()
+                if row is not None:
+                    connection.execute('UPDATE shards SET state = ?, worker = ?, lease_expires = ?, claims = claims + 1 '
+                                       'WHERE id = ?', (CLAIMED, worker, now + (lease or lease_seconds), row[0]))
+                connection.execute('COMMIT')
+            except Exception as e:
+                connection.execute('ROLLBACK')
+                raise
+        return None if row is None else row[0]
+
+    def renew(self, shard, worker, lease=None):
+        """
+        Extends the claim of a worker on a shard
+        :param shard: the id of the shard
+        :param worker: the name of the worker
+        :param lease: how long the claim lasts from now, defaults to lease_seconds
+        :return: whether the worker still holds the shard, if not another worker reclaimed it
+        """
+        with self.lock:
+            cursor = self.connection.execute('UPDATE shards SET lease_expires = ? WHERE id = ? AND state = ? '
+                                             'AND worker = ?',
+                                             (time.time() + (lease or lease_seconds), shard, CLAIMED, worker))
+            return cursor.rowcount == 1
+
+    def release(self, shard, worker, done):
+        """
+        Gives up a claim, e.g. once every object of the shard was processed
+        :param shard: the id of the shard
+        :param worker: the name of the worker
+        :param done: whether the shard is done, if not it is claimed again by the next worker
+        :return: None
+        """
+        with self.lock:
+            self.connection.execute('UPDATE shards SET state = ?, worker = NULL, lease_expires = NULL '
+                                    'WHERE id = ? AND state = ? AND worker = ?',
+                                    (DONE if done else PENDING, shard, CLAIMED, worker))
+
+    def remaining(self, shard):
+        """
+        :param shard: the id of the shard
+        :return: a list of the (repository, number, path) tuples of the objects of
+        the shard without a final result yet
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT o.repository, o.number, o.path FROM objects o LEFT JOIN results r '
+                'ON r.repository = o.repository AND r.number = o.number '
+                'WHERE o.shard = ? AND (r.result IS NULL OR r.result NOT IN (?, ?, ?)) '
+                'ORDER BY o.repository, o.number', (shard,) + FINAL_RESULTS).fetchall()
+
+    def add_results(self, rows, worker):
+        """
+        Records the results of objects, replacing earlier ones
+        :param rows: a list of [repository, number, path, result] rows as in the report
+        :param worker: the name of the worker
+        :return: None
+        """
+        now = time.time()
+        with self.lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany('INSERT OR REPLACE INTO results (repository, number, path, result, worker, '
+                                       'updated) VALUES (?, ?, ?, ?, ?, ?)',
+                                       [tuple(row) + (worker, now) for row in rows])
+                connection.execute('COMMIT')
+            except Exception as e:
+                connection.execute('ROLLBACK')
+                raise
+
+    def unfinished(self):
+        """
+        :return: the number of shards that are not done
+        """
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM shards WHERE state != ?', (DONE,)).fetchone()[0]
+
+    def status(self):
+        """
+        :return: a tuple of a dict of the number of shards per state, a dict of the number of
+        objects per result ('pending' for no result yet) and a list of the (shard, worker,
+        seconds left on the lease) of the claimed shards
+        """
+        with self.lock:
+            connection = self.connection
+            shards = dict(connection.execute('SELECT state, COUNT(*) FROM shards GROUP BY state'))
+            results = dict(connection.execute(
+                'SELECT COALESCE(r.result, ?), COUNT(*) FROM objects o LEFT JOIN results r '
+                'ON r.repository = o.repository AND r.number = o.number GROUP BY 1', (PENDING,)))
+            claims = [(shard, worker, expires - time.time()) for shard, worker, expires in connection.execute(
+                'SELECT id, worker, lease_expires FROM shards WHERE state = ? ORDER BY id', (CLAIMED,))]
+        return shards, results, claims
+
+    def write_report(self, path):
+        """
+        Writes the merged results of every worker as one CSV report
+        :param path: the path of the CSV file
+        :return: the number of objects in the report
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT o.repository, o.number, o.path, COALESCE(r.result, ?), r.worker FROM objects o '
+                'LEFT JOIN results r ON r.repository = o.repository AND r.number = o.number '
+                'ORDER BY o.repository, o.number', (PENDING,)).fetchall()
+        with open(path, 'w', newline='') as f:
+            report = csv.writer(f)
+            report.writerow(['repository', 'number', 'path', 'result', 'worker'])
+            report.writerows(rows)
+        return len(rows)
+
+
+class ShardReport(object):
+    """
+    Stands in for the csv.writer of uploader_cli.ResultRecorder, writing the
+    results of a worker to the queue in batches instead
+    """
+
+    def __init__(self, shard_queue, worker):
+        """
+        :param shard_queue: the ShardQueue
+        :param worker: the name of the worker
+        """
+        self.queue = shard_queue
+        self.worker = worker
+        self.rows = []
+        self.flushed = time.monotonic()
+
+    def writerow(self, row):
+        """
+        :param row: a [repository, number, path, result] row
+        :return: None
+        """
+        self.rows.append(row)
+        if len(self.rows) >= results_batch_size or time.monotonic() - self.flushed >= results_flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the results not yet written
+        :return: None
+        """
+        if len(self.rows) > 0:
+            self.queue.add_results(self.rows, self.worker)
+            self.rows = []
+        self.flushed = time.monotonic()
+
+
+class Lease(object):
+    """
+    Renews the claim of a worker on a shard on a background thread
+    """
+
+    def __init__(self, shard_queue, shard, worker, seconds=None):
+        """
+        :param shard_queue: the ShardQueue
+        :param shard: the id of the claimed shard
+        :param worker: the name of the worker
+        :param seconds: how long the claim lasts without being renewed, defaults to lease_seconds
+        """
+        self.queue = shard_queue
+        self.shard = shard
+        self.worker = worker
+        self.seconds = seconds or lease_seconds
+        # Set once another worker reclaimed the shard, e.g. after this one was suspended
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.renew_loop, name='lease-' + shard, daemon=True)
+        self.thread.start()
+
+    def renew_loop(self):
+        """
+        Renews the claim three times per lease until stopped or lost
+        :return: None
+        """
+        while not self.stopped.wait(self.seconds / 3):
+            try:
+                if not self.queue.renew(self.shard, self.worker, self.seconds):
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                # The shared storage may be briefly unavailable, the next renewal may work
+                print('Could not renew the claim on shard ' + self.shard + ': ' + str(e))
+
+    def held(self, objects):
+        """
+        :param objects: an iterable of objects of the shard
+        :return: an iterator over them that stops once the claim is lost
+        """
+        for obj in objects:
+            if self.lost:
+                print('Stopping shard ' + self.shard + ' as another worker claimed it')
+                return
+            yield obj
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def plan(args):
+    """
+    Scans the folder and adds its objects to the queue
+    :param args: the parsed command line arguments
+    :return: the exit code
+    """
+    shard_queue = ShardQueue(args.queue)
+    try:
+        start = time.monotonic()
+        added = shard_queue.add_objects(scan_objects(os.path.abspath(args.folder), args.scan_threads), args.by, args.shards)
+        reopened = shard_queue.reopen_failed()
+        shards, results, claims = shard_queue.status()
+    finally:
+        shard_queue.close()
+    print('Added ' + str(added) + ' objects in ' + format(time.monotonic() - start, '.1f') + ' s, the queue has ' +
+          str(sum(shards.values())) + ' shards and ' + str(sum(results.values())) + ' objects')
+    if reopened > 0:
+        print('Reopened ' + str(reopened) + ' shards with objects that failed to upload')
+    return 0
+
+
+def work(args):
+    """
+    Claims shards and uploads them until every shard is done
+    :param args: the parsed command line arguments
+    :return: the exit code
+    """
+    error = uploader_cli.check_upload_arguments(args)
+    if error is not None:
+        print(error)
+        return 2
+    password = args.password or os.environ.get('DOH_PASSWORD') or getpass.getpass()
+    upload_core.base_url = args.base_url.rstrip('/')
+    backends.backend = args.backend
+    ratelimit.configure(args.rate, args.burst, args.rate_file)
+    # A sign in failing as the website is unavailable is tried again as often as an upload
+    sessions.sign_in_retries = args.retries
+    worker = args.worker or socket.gethostname() + ':' + str(os.getpid())
+    signing_in = session_manager.start_sign_in(args.username, password, args.sessions)
+    shard_queue = ShardQueue(args.queue)
+    report = ShardReport(shard_queue, worker)
+    recorder = uploader_cli.ResultRecorder(report)
+    shards = 0
+    try:
+        while True:
+            shard = shard_queue.claim(worker, args.lease)
+            if shard is None:
+                if shard_queue.unfinished() == 0 or args.exit_when_idle:
+                    break
+                # Other workers hold the rest, wait in case one of them dies
+                time.sleep(poll_interval)
+                continue
+            objects = shard_queue.remaining(shard)
+            print(worker + ' claimed shard ' + shard + ' with ' + str(len(objects)) + ' objects left')
+            lease = Lease(shard_queue, shard, worker, args.lease)
+            try:
+                signed_in = uploader_cli.upload_changed(args, password, lease.held(
+                    (repository, number, path, None) for repository, number, path in objects), recorder, signing_in)
+                report.flush()
+            finally:
+                lease.stop()
+            if not signed_in:
+                shard_queue.release(shard, worker, False)
+                print(session_manager.failure_message())
+                return 1
+            if not lease.lost:
+                shard_queue.release(shard, worker, True)
+            shards = shards + 1
+    finally:
+        shard_queue.close()
+    print(worker + ' finished ' + str(shards) + ' shards. Uploaded ' + str(recorder.uploaded) + ' objects, ' +
+          str(recorder.failed) + ' failed, ' + str(recorder.invalid) + ' invalid, after ' +
+          str(recorder.retried) + ' retries.')
+    print(timings.table())
+    for path in args.metrics:
+        timings.write(path)
+    return 0 if recorder.failed == 0 and recorder.invalid == 0 else 1
+
+
+def status(args):
+    """
+    Prints the progress of the reingest
+    :param args: the parsed command line arguments
+    :return: the exit code, 0 once every shard is done
+    """
+    shard_queue = ShardQueue(args.queue)
+    try:
+        shards, results, claims = shard_queue.status()
+    finally:
+        shard_queue.close()
+    print('Shards: ' + ', '.join(str(count) + ' ' + state for state, count in sorted(shards.items())))
+    print('Objects: ' + ', '.join(str(count) + ' ' + result for result, count in sorted(results.items())))
+    for shard, worker, seconds in claims:
+        print('  ' + shard + ' claimed by ' + worker + (' (lease expired)' if seconds < 0 else ''))
+    return 0 if shards.get(PENDING, 0) + shards.get(CLAIMED, 0) == 0 else 1
+
+
+def report(args):
+    """
+    Writes the merged report of every worker
+    :param args: the parsed command line arguments
+    :return: the exit code
+    """
+    shard_queue = ShardQueue(args.queue)
+    try:
+        count = shard_queue.write_report(args.output)
+    finally:
+        shard_queue.close()
+    print('Wrote the results of ' + str(count) + ' objects to ' + args.output)
+    return 0
+
+
+def parse_args(argv):
+    """
+    Parses the command line arguments
+    :param argv: the arguments without the program name
+    :return: the parsed arguments namespace
+    """
+    parser = argparse.ArgumentParser(description='Reingests MODS XML files into the DOH Arca website '
+                                                 'from several machines at once.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    planning = commands.add_parser('plan', help='scan a folder and add its objects to the queue')
+    planning.add_argument('folder', help='the folder to search recursively for <repository>_<number>.xml files')
+    planning.add_argument('queue', help='the SQLite file of the queue, on storage every worker can reach')
+    planning.add_argument('--by', choices=['hash', 'namespace'], default='hash',
+                          help='partition by a hash of the PID or by repository namespace (default: %(default)s)')
+    planning.add_argument('--shards', type=int, default=64,
+                          help='the number of shards when partitioning by hash (default: %(default)s)')
+    planning.add_argument('--scan-threads', type=int, default=upload_core.scan_threads,
+                          help='the number of directories listed at once (default: %(default)s)')
+    planning.set_defaults(run=plan)
+
+    working = commands.add_parser('work', help='claim shards from the queue and upload them')
+    working.add_argument('queue', help='the SQLite file of the queue')
+    uploader_cli.add_upload_arguments(working)
+    working.add_argument('--worker', help='the name of this worker (default: <host name>:<process id>)')
+    working.add_argument('--lease', type=float, default=lease_seconds,
+                         help='how many seconds a claimed shard is held without a heartbeat before other '
+                              'workers reclaim it (default: %(default)s)')
+    working.add_argument('--exit-when-idle', action='store_true',
+                         help='stop when nothing is left to claim instead of waiting for the shards of '
+                              'other workers to finish or be reclaimed')
+    working.set_defaults(run=work)
+
+    showing = commands.add_parser('status', help='show the progress of the reingest')
+    showing.add_argument('queue', help='the SQLite file of the queue')
+    showing.set_defaults(run=status)
+
+    reporting = commands.add_parser('report', help='write the merged results of every worker to a CSV file')
+    reporting.add_argument('queue', help='the SQLite file of the queue')
+    reporting.add_argument('-o', '--output', required=True, help='the path of the CSV file')
+    reporting.set_defaults(run=report)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Entry point of the distributed reingest
+    :param argv: the arguments without the program name, defaults to sys.argv
+    :return: the exit code
+    """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'plan' and args.shards < 1:
+        print('The number of shards must be at least 1')
+        return 2
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    # Lets the validation processes start in a frozen executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+Model behind the table of files in the GUI.
+Keeps every column in compact storage (interned strings,
+a byte array of hashes and a byte array of statuses) instead
+of three QTableWidgetItems per file, so hundreds of thousands
+of files take little memory and the view only asks for the
+rows that are visible.
+"""
+import collections
+import enum
+import sys
+from array import array
+
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+# The size of a SHA-1 digest in bytes
+HASH_SIZE = 20
+# Above this many ranges of changed rows, a single range covering them all is emitted
+max_ranges = 32
+
+
+class RowStatus(enum.IntEnum):
+    """
+    The state of the upload of a row
+    """
+    PENDING = 0
+    RUNNING = 1
+    SUCCEEDED = 2
+    FAILED = 3
+    # Already uploaded according to the journal or unchanged on the website
+    SKIPPED = 4
+    # Not well-formed MODS or not about the object its name says, see validation.py
+    INVALID = 5
+    # Waiting to be tried again after an error or because someone else held the lock
+    RETRYING = 6
+    # Not uploaded as the upload was cancelled
+    CANCELLED = 7
+
+
+class StatusUpdates(object):
+    """
+    Collects the status changes of rows from any thread so that the
+    GUI applies them in batches on a timer, instead of handling one
+    queued signal and one repaint per change. Safe to use from any thread.
+    """
+
+    def __init__(self):
+        self.changes = collections.deque()
+
+    def put(self, row_index, status):
+        """
+        Queues a status change
+        :param row_index: the index of the row
+        :param status: the new RowStatus
+        :return: None
+        """
+        self.changes.append((row_index, status))
+
+    def take(self):
+        """
+        Removes every queued change
+        :return: a list of (row_index, RowStatus) tuples in the order they were queued
+        """
+        changes = []
+        try:
+            while True:
+                changes.append(self.changes.popleft())
+        except IndexError:
+            pass
+        return changes
+
+
+class FileTableModel(QAbstractTableModel):
+    """
+    Table of (repository, number, path) rows with an upload status each
+    """
+    HEADERS = ('Repository', 'Number', 'Path')
+    COLORS = {
+        RowStatus.RUNNING: QtGui.QColor(247, 247, 181),
+        RowStatus.SUCCEEDED: QtGui.QColor(196, 237, 194),
+        RowStatus.FAILED: QtGui.QColor(237, 194, 194),
+        RowStatus.SKIPPED: QtGui.QColor(196, 237, 194),
+        RowStatus.INVALID: QtGui.QColor(237, 194, 194),
+        RowStatus.RETRYING: QtGui.QColor(247, 221, 181),
+        RowStatus.CANCELLED: QtGui.QColor(221, 221, 221),
+    }
+
+    def __init__(self, parent=None):
+        super(FileTableModel, self).__init__(parent)
+        self.clear()
+
+    def clear(self):
+        """
+        Removes every row
+        :return: None
+        """
+        self.beginResetModel()
+        self.repositories = []
+        self.numbers = []
+        self.paths = []
+        self.hashes = bytearray()
+        self.statuses = array('b')
+        # What is wrong with the file of each INVALID row, by row index
+        self.errors = {}
+        self.endResetModel()
+
+    def append_rows(self, rows):
+        """
+        Adds rows at the end of the table
+        :param rows: a list of (repository, number, path, content_hash) tuples,
+        content_hash being a hex SHA-1
+        :return: None
+        """
+        if len(rows) == 0:
+            return
+        first = len(self.paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        for repository, number, path, content_hash in rows:
+            # There are only a handful of repositories, share their strings
+            self.repositories.append(sys.intern(repository))
+            self.numbers.append(number)
+            self.paths.append(path)
+            self.hashes += bytes.fromhex(content_hash)
+            self.statuses.append(RowStatus.PENDING)
+        self.endInsertRows()
+
+    def row(self, row_index):
+        """
+        :param row_index: the index of a row
+        :return: the (repository, number, path) of the row
+        """
+        return self.repositories[row_index], self.numbers[row_index], self.paths[row_index]
+
+    def content_hash(self, row_index):
+        """
+        :param row_index: the index of a row
+        :return: the hex SHA-1 of the file of the row
+        """
+        return self.hashes[row_index * HASH_SIZE:(row_index + 1) * HASH_SIZE].hex()
+
+    def status(self, row_index):
+        """
+        :param row_index: the index of a row
+        :return: the RowStatus of the row
+        """
+        return RowStatus(self.statuses[row_index])
+
+    def set_status(self, row_index, status):
+        """
+        Sets the status of one row
+        :param row_index: the index of the row
+        :param status: the new RowStatus
+        :return: None
+        """
+        self.set_statuses([(row_index, status)])
+
+    def set_invalid(self, rows):
+        """
+        Marks rows whose files did not pass validation
+        :param rows: a list of (row_index, error) tuples
+        :return: None
+        """
+        self.errors.update(rows)
+        self.set_statuses([(row_index, RowStatus.INVALID) for row_index, error in rows])
+
+    def set_statuses(self, changes):
+        """
+        Sets the status of many rows, notifying the view once
+        per range of consecutive rows rather than once per row
+        :param changes: an iterable of (row_index, RowStatus) tuples
+        :return: None
+        """
+        changed = []
+        for row_index, status in changes:
+            self.statuses[row_index] = status
+            changed.append(row_index)
+        if len(changed) == 0:
+            return
+        changed.sort()
+        ranges = []
+        start = end = changed[0]
+        for row_index in changed[1:]:
+            if row_index > end + 1:
+                ranges.append((start, end))
+                start = row_index
+            end = row_index
+        ranges.append((start, end))
+        # Scattered rows are sent as one range, the view only
+        # repaints what is visible anyway
+        if len(ranges) > max_ranges:
+            ranges = [(changed[0], changed[-1])]
+        last_column = len(FileTableModel.HEADERS) - 1
+        for start, end in ranges:
+            self.dataChanged.emit(self.index(start, 0), self.index(end, last_column), [Qt.BackgroundRole])
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.paths)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(FileTableModel.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self.row(index.row())[index.column()]
+        if role == Qt.BackgroundRole:
+            return FileTableModel.COLORS.get(self.statuses[index.row()])
+        if role == Qt.ToolTipRole and index.row() in self.errors:
+            return 'Not uploaded as the file is ' + self.errors[index.row()]
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal:
+            if role == Qt.DisplayRole:
+                return QtCore.QCoreApplication.translate("MainWindow", FileTableModel.HEADERS[section])
+            if role == Qt.TextAlignmentRole and section == 2:
+                return Qt.AlignLeft
+        return super(FileTableModel, self).headerData(section, orientation, role)
@@ -0,0 +1,210 @@
+"""
+Persistent journal of upload results so an interrupted
+reingest can resume without uploading everything again.
+Each object is keyed by its PID and the hash of the file
+content, so an edited file is uploaded again even if an
+earlier version of it already succeeded. Only the version
+uploaded last counts as done, so a file reverted to an
+earlier version is uploaded again as well.
+Writes are queued and committed in batches by a background
+thread so that journaling never slows down the uploads.
+"""
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Where the journal is kept unless another path is given
+default_path = os.path.join(os.path.expanduser('~'), '.doh_uploader', 'journal.sqlite')
+
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+# Skipped because the website already has the same MODS
+UNCHANGED = 'unchanged'
+# Not uploaded because the file is not valid MODS, see validation.py
+INVALID = 'invalid'
+
+UPSERT_OBJECT = ('INSERT INTO objects (pid, hash, path, state, attempts, updated) VALUES (?, ?, ?, ?, 1, ?) '
+                 'ON CONFLICT (pid, hash) DO UPDATE SET path = excluded.path, state = excluded.state, '
+                 'attempts = attempts + 1, updated = excluded.updated')
+UPSERT_FINGERPRINT = ('INSERT OR REPLACE INTO fingerprints (pid, hash, etag, last_modified, fetched) '
+                      'VALUES (?, ?, ?, ?, ?)')
+
+
+def file_hash(path):
+    """
+    Hashes the content of a file
+    :param path: the path of the file
+    :return: the hex SHA-1 of the file content
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class Journal(object):
+    """
+    SQLite journal of the state of every (pid, hash) pair and of the
+    fingerprints of what the website has. Safe to use from any thread.
+    """
+
+    def __init__(self, path=default_path, batch_size=500, flush_interval=1.0):
+        """
+        :param path: the path of the SQLite file, created if missing
+        :param batch_size: the max number of writes committed in one transaction
+        :param flush_interval: the max number of seconds a write waits before being committed
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        connection = self.connect()
+        connection.execute('CREATE TABLE IF NOT EXISTS objects ('
+                           'pid TEXT NOT NULL, hash TEXT NOT NULL, path TEXT, state TEXT NOT NULL, '
+                           'attempts INTEGER NOT NULL DEFAULT 0, updated REAL, PRIMARY KEY (pid, hash))')
+        # What the website had for each object when last checked, see change_detection.py
+        connection.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                           'pid TEXT PRIMARY KEY, hash TEXT NOT NULL, etag TEXT, last_modified TEXT, fetched REAL)')
+        connection.commit()
+        # The hash of the file last uploaded to each object, i.e. what the website has,
+        # kept in memory for fast lookups (SQLite takes the hash of the row with the MAX)
+        self.succeeded = dict((pid, content_hash) for pid, content_hash, updated in connection.execute(
+            'SELECT pid, hash, MAX(updated) FROM objects WHERE state IN (?, ?) GROUP BY pid', (SUCCEEDED, UNCHANGED)))
+        # The PIDs whose last attempt failed, uploaded first by scheduling.py
+        # (SQLite takes the state of the row with the MAX)
+        self.failed = set(pid for pid, state, updated in connection.execute(
+            'SELECT pid, state, MAX(updated) FROM objects GROUP BY pid') if state == FAILED)
+        connection.close()
+        self.succeeded_lock = threading.Lock()
+        # Read connections, one per thread as SQLite connections can't be shared
+        self.readers = threading.local()
+
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, name='journal-writer', daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        """
+        :return: a new connection to the journal in WAL mode, which
+        keeps commits durable without an fsync per write
+        """
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def is_done(self, pid, content_hash):
+        """
+        :param pid: the PID of the object e.g. "doh:123"
+        :param content_hash: the hash of the file that would be uploaded
+        :return: whether this exact file is the last one uploaded to the object
+        """
+        with self.succeeded_lock:
+            return pid in self.succeeded and self.succeeded[pid] == content_hash
+
+    def has_failed(self, pid):
+        """
+        :param pid: the PID of the object e.g. "doh:123"
+        :return: whether the last attempt to upload the object, of any version of its file, failed
+        """
+        with self.succeeded_lock:
+            return pid in self.failed
+
+    def record(self, pid, content_hash, path, state):
+        """
+        Queues the new state of an object to be written
+        :param pid: the PID of the object e.g. "doh:123"
+        :param content_hash: the hash of the file
+        :param path: the path of the file
+        :param state: SUCCEEDED, FAILED, UNCHANGED or INVALID
+        :return: None
+        """
+        with self.succeeded_lock:
+            if state in (SUCCEEDED, UNCHANGED):
+                self.succeeded[pid] = content_hash
+            if state == FAILED:
+                self.failed.add(pid)
+            else:
+                self.failed.discard(pid)
+        self.writes.put((UPSERT_OBJECT, (pid, content_hash, path, state, time.time())))
+
+    def get_fingerprint(self, pid):
+        """
+        Gets the cached fingerprint of the MODS the website has for an object.
+        Only sees fingerprints already committed by the writer thread.
+        :param pid: the PID of the object e.g. "doh:123"
+        :return: a (hash, etag, last_modified, fetched) tuple or None if not cached
+        """
+        connection = getattr(self.readers, 'connection', None)
+        if connection is None:
+            connection = self.readers.connection = self.connect()
+        return connection.execute('SELECT hash, etag, last_modified, fetched FROM fingerprints WHERE pid = ?',
+                                  (pid,)).fetchone()
+
+    def set_fingerprint(self, pid, mods_hash, etag=None, last_modified=None):
+        """
+        Queues the fingerprint of the MODS the website has for an object to be written
+        :param pid: the PID of the object e.g. "doh:123"
+        :param mods_hash: the normalized hash of the MODS
+        :param etag: the ETag header the website sent with it, if any
+        :param last_modified: the Last-Modified header the website sent with it, if any
+        :return: None
+        """
+        self.writes.put((UPSERT_FINGERPRINT, (pid, mods_hash, etag, last_modified, time.time())))
+
+    def write_loop(self):
+        """
+        Runs on the writer thread, committing queued writes in batches
+        :return: None
+        """
+        connection = self.connect()
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Writes are (statement, row) tuples, anything else is a flush() event or the None of close()
+            while len(batch) < self.batch_size and isinstance(batch[-1], tuple):
+                try:
+                    batch.append(self.writes.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            statements = {}
+            for write in batch:
+                if isinstance(write, tuple):
+                    statement, row = write
+                    statements.setdefault(statement, []).append(row)
+            if len(statements) > 0:
+                for statement, rows in statements.items():
+                    connection.executemany(statement, rows)
+                connection.commit()
+            for write in batch:
+                if isinstance(write, threading.Event):
+                    write.set()
+            if batch[-1] is None:
+                connection.close()
+                return
+
+    def flush(self):
+        """
+        Blocks until every write queued so far is committed
+        :return: None
+        """
+        if not self.writer.is_alive():
+            return
+        event = threading.Event()
+        self.writes.put(event)
+        event.wait()
+
+    def close(self):
+        """
+        Commits every queued write and stops the writer thread
+        :return: None
+        """
+        if self.writer.is_alive():
+            self.writes.put(None)
+            self.writer.join()
@@ -0,0 +1,187 @@
+"""
+Timing instrumentation of the upload hot path.
+Every phase of an upload (signing in, acquiring the lock, fetching
+the replace form, submitting it, releasing the lock) as well as
+reading the files and parsing the HTML pages is timed into a
+histogram, so a slow run shows where the time goes. The histograms
+can be exported as JSON or in the Prometheus text format.
+Phases overlap: html_parse and file_read happen inside the others.
+"""
+import bisect
+import json
+import threading
+import time
+
+# The upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# The phases in the order they are shown
+PHASES = ('sign_in', 'lock', 'replace_page', 'replace_submit', 'unlock', 'file_read', 'html_parse', 'object')
+
+
+class Histogram(object):
+    """
+    Counts of durations per bucket, plus their total. Not thread safe on its own.
+    """
+
+    def __init__(self):
+        # The last count is for durations above the largest bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + seconds
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile by interpolating inside the bucket it falls in
+        :param fraction: the quantile e.g. 0.99
+        :return: the estimated duration in seconds, 0 if nothing was observed
+        """
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count > 0 and seen + count >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                # Durations above the largest bucket are reported as the largest bucket
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen = seen + count
+        return BUCKETS[-1]
+
+    def to_dict(self):
+        """
+        :return: the histogram as a JSON serializable dict, with cumulative buckets
+        """
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative = cumulative + count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99), 'buckets': buckets}
+
+
+class PhaseTimer(object):
+    """
+    Context manager timing a block into a phase of Timings
+    """
+
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.observe(self.phase, time.perf_counter() - self.start)
+        return False
+
+
+class Timings(object):
+    """
+    A histogram of durations per phase. Safe to use from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every duration, e.g. at the start of a new upload session
+        :return: None
+        """
+        with self.lock:
+            self.histograms = dict((phase, Histogram()) for phase in PHASES)
+
+    def observe(self, phase, seconds):
+        """
+        Records a duration
+        :param phase: the name of the phase, one of PHASES
+        :param seconds: how long it took
+        :return: None
+        """
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+            histogram.observe(seconds)
+
+    def time(self, phase):
+        """
+        :param phase: the name of the phase, one of PHASES
+        :return: a context manager timing its block into the phase
+        """
+        return PhaseTimer(self, phase)
+
+    def to_dict(self):
+        """
+        :return: the histograms of the phases that were observed as a JSON serializable dict
+        """
+        with self.lock:
+            return dict((phase, histogram.to_dict()) for phase, histogram in self.histograms.items()
+                        if histogram.count > 0)
+
+    def to_json(self):
+        """
+        :return: the histograms as JSON text
+        """
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """
+        :return: the histograms in the Prometheus text exposition format
+        """
+        lines = ['# HELP doh_uploader_phase_seconds Time spent in each phase of the uploads',
+                 '# TYPE doh_uploader_phase_seconds histogram']
+        for phase, histogram in self.to_dict().items():
+            for bound, count in histogram['buckets'].items():
+                lines.append('doh_uploader_phase_seconds_bucket{phase="' + phase + '",le="' + bound + '"} ' +
+                             str(count))
+            lines.append('doh_uploader_phase_seconds_sum{phase="' + phase + '"} ' + repr(histogram['sum']))
+            lines.append('doh_uploader_phase_seconds_count{phase="' + phase + '"} ' + str(histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Exports the histograms to a file, as JSON if its name ends
+        with .json and in the Prometheus text format otherwise
+        :param path: the path of the file
+        :return: None
+        """
+        with open(path, 'w') as f:
+            f.write(self.to_json() if path.lower().endswith('.json') else self.to_prometheus())
+
+    def summary(self, phases=('lock', 'replace_submit', 'unlock')):
+        """
+        :param phases: the phases to include
+        :return: the median durations of the phases as short text e.g. "lock 120 ms, unlock 60 ms"
+        """
+        with self.lock:
+            parts = [phase + ' ' + format(self.histograms[phase].quantile(0.5) * 1000, '.0f') + ' ms'
+                     for phase in phases if phase in self.histograms and self.histograms[phase].count > 0]
+        return ', '.join(parts)
+
+    def table(self):
+        """
+        :return: a text table of the count, median, 99th percentile and total time of every phase
+        """
+        rows = ['{:<15} {:>8} {:>9} {:>9} {:>10}'.format('phase', 'count', 'p50 ms', 'p99 ms', 'total s')]
+        for phase, histogram in self.to_dict().items():
+            rows.append('{:<15} {:>8} {:>9.1f} {:>9.1f} {:>10.2f}'.format(
+                phase, histogram['count'], histogram['p50'] * 1000, histogram['p99'] * 1000, histogram['sum']))
+        return '\n'.join(rows)
+
+
+"""
+The timings of every upload
+"""
+timings = Timings()
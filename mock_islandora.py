@@ -0,0 +1,447 @@
+"""
+Local stand-in for the DOH Islandora website, so the uploader can
+be run and measured (see benchmark.py) without touching production.
+Implements only the pages the upload code relies on: the user-login
+form, the MODS replace page with its "acquire the lock" and "release"
+links, the confirmation forms of the lock and the release, the
+islandora-datastream-version-replace-form and the raw MODS datastream,
+the REST datastream update of islandora_rest, which like the real one
+does not look at the locks, and a REST endpoint taking and releasing the
+lock of an object, which stock islandora_rest does not have.
+Every response can be slowed down and a fraction of them turned into
+server errors, and sessions can be made to expire.
+
+Example:
+    python mock_islandora.py --port 8080 --latency 0.05 --error-rate 0.01
+    python uploader_cli.py /data/UpdatedXML -u admin -p secret --base-url http://127.0.0.1:8080
+"""
+import argparse
+import hashlib
+import html
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, unquote
+
+OBJECT_PATH = re.compile(r'^/islandora/object/([^/]+)/(.+)$')
+REST_DATASTREAM_PATH = re.compile(r'^/islandora/rest/v1/object/([^/]+)/datastream/([^/]+)$')
+REST_LOCK_PATH = re.compile(r'^/islandora/rest/v1/object/([^/]+)/lock$')
+
+
+def page(title, body):
+    """
+    :param title: the title of the page, shown in the page__title heading
+    :param body: the HTML of the content of the page
+    :return: the page as bytes
+    """
+    title = html.escape(title)
+    return ('<html><head><title>' + title + '</title></head><body>'
+            '<h1 class="page__title">' + title + '</h1>' + body + '</body></html>').encode('utf-8')
+
+
+def confirmation_form(action):
+    """
+    :param action: the URL the form posts to
+    :return: the HTML of a Drupal confirmation form
+    """
+    return ('<form class="confirmation" method="post" action="' + html.escape(action) + '">'
+            '<input type="hidden" name="confirm" value="1">'
+            '<input type="hidden" name="form_id" value="confirm_form">'
+            '<input type="submit" name="op" value="Confirm"></form>')
+
+
+def parse_multipart(content_type, body):
+    """
+    :param content_type: the Content-Type header of the request
+    :param body: the body of the request
+    :return: a dict of the field names to their content as bytes
+    """
+    message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + content_type.encode('latin-1') +
+                                                  b'\r\n\r\n' + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if name is not None:
+            fields[name] = part.get_payload(decode=True)
+    return fields
+
+
+class MockIslandora(object):
+    """
+    The state of the stand-in website and the HTTP server serving it
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, users=None,
+                 locked_by_others=(), session_lifetime=None, rest=True, rest_lock=True):
+        """
+        :param host: the address to listen on
+        :param port: the port to listen on, 0 picks a free one
+        :param latency: how long every response is delayed, in seconds
+        :param jitter: a random delay of up to this many seconds added to the latency
+        :param error_rate: the fraction of requests answered with 503 Service Unavailable
+        :param users: a dict of the usernames to their passwords, defaults to admin/secret
+        :param locked_by_others: the PIDs that someone else holds the lock of
+        :param session_lifetime: how long a sign in lasts, in seconds, None for ever
+        :param rest: whether the REST API is served, otherwise its requests are answered with 404
+        :param rest_lock: whether the REST API has the lock endpoint, otherwise its requests are answered with 404
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.users = users or {'admin': 'secret'}
+        self.session_lifetime = session_lifetime
+        self.rest = rest
+        self.rest_lock = rest_lock
+        self.lock = threading.Lock()
+        # Session cookie -> (username, when it signed in)
+        self.sessions = {}
+        # PID -> username holding the lock
+        self.locks = dict((pid, 'someone else') for pid in locked_by_others)
+        # PID -> the MODS datastream
+        self.mods = {}
+        self.requests = 0
+        self.errors = 0
+        self.uploads = 0
+        self.sign_ins = 0
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+        :return: the base URL of the website e.g. http://127.0.0.1:8080
+        """
+        host, port = self.server.server_address[:2]
+        return 'http://' + host + ':' + str(port)
+
+    def start(self):
+        """
+        Serves the website on a background thread
+        :return: self
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mock-islandora', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops serving and closes the socket
+        :return: None
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        """
+        :return: a dict of the number of requests, server errors, MODS uploads and sign ins served
+        """
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'uploads': self.uploads,
+                    'sign_ins': self.sign_ins}
+
+    def handler_class(self):
+        """
+        :return: a request handler class bound to this website
+        """
+        website = self
+
+        class Handler(IslandoraHandler):
+            pass
+
+        Handler.website = website
+        return Handler
+
+
+class IslandoraHandler(BaseHTTPRequestHandler):
+    """
+    Answers one request of the stand-in website
+    """
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, without this every
+    # keep-alive response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+    website = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def username(self):
+        """
+        :return: the username of the signed in user, or None if not signed in or the session expired
+        """
+        match = re.search(r'SESS=([^;]+)', self.headers.get('Cookie', ''))
+        if match is None:
+            return None
+        website = self.website
+        with website.lock:
+            username, signed_in = website.sessions.get(match.group(1), (None, 0))
+            if website.session_lifetime is not None and time.monotonic() - signed_in > website.session_lifetime:
+                website.sessions.pop(match.group(1), None)
+                return None
+            return username
+
+    def send(self, status, body=b'', headers=None):
+        """
+        Sends a response
+        :param status: the HTTP status code
+        :param body: the body as bytes
+        :param headers: a dict of extra headers
+        :return: None
+        """
+        headers = headers or {}
+        self.send_response(status)
+        if 'Content-Type' not in headers:
+            headers['Content-Type'] = 'text/html; charset=utf-8'
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def redirect(self, location, headers=None):
+        headers = dict(headers or {})
+        headers['Location'] = location
+        self.send(302, b'', headers)
+
+    def begin(self):
+        """
+        Counts the request, applies the latency and decides whether it fails
+        :return: whether the request should be answered with a server error
+        """
+        website = self.website
+        delay = website.latency + random.uniform(0, website.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        fail = website.error_rate > 0 and random.random() < website.error_rate
+        with website.lock:
+            website.requests = website.requests + 1
+            if fail:
+                website.errors = website.errors + 1
+        return fail
+
+    def do_GET(self):
+        if self.begin():
+            return self.send(503, page('Service unavailable', ''))
+        url = urlparse(self.path)
+        if url.path == '/user/login':
+            return self.send(200, page('User account',
+                                       '<form id="user-login" action="/user/login" method="post">'
+                                       '<input type="text" name="name"><input type="password" name="pass">'
+                                       '<input type="hidden" name="form_id" value="user_login">'
+                                       '<input type="submit" name="op" value="Log in"></form>'))
+        if url.path.startswith('/user/'):
+            username = self.username()
+            return self.send(200 if username else 403, page(username or 'Access denied', ''))
+        match = OBJECT_PATH.match(url.path)
+        if match is None:
+            return self.send(404, page('Page not found', ''))
+        pid, rest = unquote(match.group(1)), match.group(2)
+        username = self.username()
+        if username is None:
+            return self.redirect('/user/login')
+        if rest == 'datastream/MODS/replace':
+            return self.send(200, page('Update Datastream', self.replace_page(pid, url.path, username)))
+        if rest in ('manage/lock', 'manage/unlock'):
+            return self.send(200, page('Are you sure?', confirmation_form(self.path)))
+        if rest == 'datastream/MODS/view':
+            return self.view(pid)
+        return self.send(404, page('Page not found', ''))
+
+    def replace_page(self, pid, path, username):
+        """
+        :param pid: the PID of the object
+        :param path: the path of the replace page
+        :param username: the signed in user
+        :return: the HTML of the replace page, which depends on who holds the lock
+        """
+        with self.website.lock:
+            holder = self.website.locks.get(pid)
+        object_url = '/islandora/object/' + quote(pid)
+        if holder is None:
+            return ('<div class="messages">This object is not locked. To edit it, '
+                    '<a href="' + object_url + '/manage/lock?destination=' + quote(path) + '">'
+                    'acquire the lock</a>.</div>')
+        if holder != username:
+            return '<div class="messages">This object is locked by ' + html.escape(holder) + '.</div>'
+        return ('<div class="messages">You hold the lock of this object, '
+                '<a href="' + object_url + '/manage/unlock?destination=' + quote(path) + '">release</a> it '
+                'when you are done.</div>'
+                '<form id="islandora-datastream-version-replace-form" enctype="multipart/form-data" '
+                'method="post" action="' + path + '">'
+                '<input type="file" name="files[file]">'
+                '<input type="hidden" name="form_id" value="islandora_datastream_version_replace_form">'
+                '<input type="submit" name="op" value="Add Contents"></form>')
+
+    def view(self, pid):
+        """
+        Sends the raw MODS datastream, with an ETag to revalidate it with
+        :param pid: the PID of the object
+        :return: None
+        """
+        with self.website.lock:
+            mods = self.website.mods.get(pid)
+        if mods is None:
+            return self.send(404, page('Page not found', ''))
+        etag = '"' + hashlib.sha1(mods).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, b'', {'ETag': etag})
+        return self.send(200, mods, {'Content-Type': 'application/xml', 'ETag': etag})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.begin():
+            return self.send(503, page('Service unavailable', ''))
+        url = urlparse(self.path)
+        website = self.website
+        if url.path == '/user/login':
+            fields = parse_qs(body.decode('utf-8'))
+            username = fields.get('name', [''])[0]
+            if username in website.users and website.users[username] == fields.get('pass', [''])[0]:
+                session = uuid.uuid4().hex
+                with website.lock:
+                    website.sessions[session] = (username, time.monotonic())
+                    website.sign_ins = website.sign_ins + 1
+                return self.redirect('/user/1', {'Set-Cookie': 'SESS=' + session + '; path=/'})
+            return self.send(200, page('User account', '<div class="messages error">Sorry, unrecognized '
+                                                       'username or password.</div>'))
+        match = REST_DATASTREAM_PATH.match(url.path)
+        if match is not None:
+            return self.rest_update(unquote(match.group(1)), match.group(2), url, body)
+        match = REST_LOCK_PATH.match(url.path)
+        if match is not None:
+            return self.rest_lock(unquote(match.group(1)), True)
+        match = OBJECT_PATH.match(url.path)
+        if match is None:
+            return self.send(404, page('Page not found', ''))
+        pid, rest = unquote(match.group(1)), match.group(2)
+        username = self.username()
+        if username is None:
+            return self.redirect('/user/login')
+        destination = parse_qs(url.query).get('destination', ['/'])[0]
+        if rest == 'manage/lock':
+            with website.lock:
+                if website.locks.get(pid) in (None, username):
+                    website.locks[pid] = username
+            return self.redirect(destination)
+        if rest == 'manage/unlock':
+            with website.lock:
+                if website.locks.get(pid) == username:
+                    del website.locks[pid]
+            return self.redirect(destination)
+        if rest == 'datastream/MODS/replace':
+            with website.lock:
+                holder = website.locks.get(pid)
+            if holder != username:
+                return self.send(403, page('Access denied', ''))
+            mods = parse_multipart(self.headers.get('Content-Type', ''), body).get('files[file]')
+            if mods is None:
+                return self.send(200, page('Update Datastream', '<div class="messages error">'
+                                                                'A file is required.</div>'))
+            with website.lock:
+                website.mods[pid] = mods
+                website.uploads = website.uploads + 1
+            return self.redirect(url.path)
+        return self.send(404, page('Page not found', ''))
+
+    def do_DELETE(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.begin():
+            return self.send(503, page('Service unavailable', ''))
+        match = REST_LOCK_PATH.match(urlparse(self.path).path)
+        if match is None:
+            return self.send(404, page('Page not found', ''))
+        return self.rest_lock(unquote(match.group(1)), False)
+
+    def rest_lock(self, pid, acquire):
+        """
+        Takes or releases the lock of an object through the REST API
+        :param pid: the PID of the object
+        :param acquire: True to take the lock, which the user may already hold, False to release it
+        :return: None
+        """
+        website = self.website
+        json = {'Content-Type': 'application/json'}
+        if not website.rest or not website.rest_lock:
+            return self.send(404, b'{"message": "Not Found"}', json)
+        username = self.username()
+        if username is None:
+            return self.send(401, b'{"message": "Unauthorized"}', json)
+        with website.lock:
+            holder = website.locks.get(pid)
+            if holder not in (None, username):
+                return self.send(409, b'{"message": "Locked by another user"}', json)
+            if acquire:
+                website.locks[pid] = username
+            else:
+                website.locks.pop(pid, None)
+        return self.send(200, ('{"pid": "' + pid + '", "locked": ' + ('true' if acquire else 'false') +
+                               '}').encode('utf-8'), json)
+
+    def rest_update(self, pid, dsid, url, body):
+        """
+        Replaces a datastream through the REST API, a POST with method=PUT
+        as PHP does not read multipart PUT requests
+        :param pid: the PID of the object
+        :param dsid: the ID of the datastream, only MODS is served
+        :param url: the parsed URL of the request
+        :param body: the multipart body of the request, with the content in its file field
+        :return: None
+        """
+        website = self.website
+        if not website.rest or dsid != 'MODS':
+            return self.send(404, b'{"message": "Not Found"}', {'Content-Type': 'application/json'})
+        if parse_qs(url.query).get('method') != ['PUT']:
+            return self.send(405, b'{"message": "Method Not Allowed"}', {'Content-Type': 'application/json'})
+        if self.username() is None:
+            return self.send(401, b'{"message": "Unauthorized"}', {'Content-Type': 'application/json'})
+        mods = parse_multipart(self.headers.get('Content-Type', ''), body).get('file')
+        if mods is None:
+            return self.send(400, b'{"message": "No file given"}', {'Content-Type': 'application/json'})
+        with website.lock:
+            website.mods[pid] = mods
+            website.uploads = website.uploads + 1
+        return self.send(200, ('{"dsid": "MODS", "label": "MODS Record", "size": ' + str(len(mods)) +
+                               '}').encode('utf-8'), {'Content-Type': 'application/json'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a local stand-in for the DOH Islandora website.')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8080, help='the port to listen on (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='how long every response is delayed, in seconds (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='a random extra delay of up to this many seconds (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='the fraction of requests answered with a 503 (default: %(default)s)')
+    parser.add_argument('--username', default='admin', help='the username to accept (default: %(default)s)')
+    parser.add_argument('--password', default='secret', help='the password to accept (default: %(default)s)')
+    parser.add_argument('--locked', nargs='*', default=[], help='PIDs locked by someone else e.g. doh:1')
+    parser.add_argument('--session-lifetime', type=float,
+                        help='how long a sign in lasts, in seconds (default: for ever)')
+    parser.add_argument('--no-rest', action='store_true',
+                        help='answer the requests to the REST API with 404, like a website without it')
+    parser.add_argument('--no-rest-lock', action='store_true',
+                        help='answer the requests to the lock endpoint of the REST API with 404, '
+                             'like stock islandora_rest')
+    args = parser.parse_args()
+    website = MockIslandora(args.host, args.port, args.latency, args.jitter, args.error_rate,
+                            {args.username: args.password}, args.locked, args.session_lifetime,
+                            not args.no_rest, not args.no_rest_lock)
+    print('Serving ' + website.url)
+    try:
+        website.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    website.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
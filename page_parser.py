@@ -0,0 +1,278 @@
+"""
+Targeted extraction of what the uploads need from the website's pages.
+Building a full BeautifulSoup tree of every page with the pure Python
+html.parser, then searching it, costs far more CPU than the uploads
+need, and holds the GIL while doing it so the upload threads can not
+overlap. Only the forms (with the fields a browser would send), the
+links whose text is one of LINK_TEXTS and the page title are kept.
+Pages are parsed with lxml, whose parser is written in C, when it is
+installed, and otherwise with a streaming parser that never builds a tree.
+See parse_benchmark.py for how they compare.
+"""
+import importlib.util
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+# Whether lxml is installed, it is only imported once the first page is parsed as it takes a while to load
+has_lxml = importlib.util.find_spec('lxml') is not None
+
+# The text of the links the uploads follow
+LINK_TEXTS = ('acquire the lock', 'release')
+# The class of the heading holding the title of the page, e.g. the username after signing in
+TITLE_CLASS = 'page__title'
+
+# How pages are parsed: 'lxml', or 'stream' which only needs the standard library
+parser = 'lxml' if has_lxml else 'stream'
+
+
+class Form(object):
+    """
+    A form and the values of its fields
+    """
+
+    def __init__(self, page_url, attributes):
+        """
+        :param page_url: the URL of the page the form is on
+        :param attributes: a dict of the attributes of the form tag
+        """
+        self.id = attributes.get('id')
+        self.classes = (attributes.get('class') or '').split()
+        # Where the form is submitted to, as an absolute URL
+        self.action = urljoin(page_url, attributes.get('action') or page_url)
+        self.method = (attributes.get('method') or 'get').lower()
+        # (kind, name, value) tuples in the order of the page, the kind
+        # being 'value', 'submit' for buttons or 'file' for file inputs
+        self.controls = []
+
+    def add_control(self, tag, attributes, text=None):
+        """
+        Adds a field of the form the way a browser would send it
+        :param tag: the name of the tag, input, textarea or select
+        :param attributes: a dict of the attributes of the tag
+        :param text: the text of a textarea or the value of the selected option of a select
+        :return: None
+        """
+        name = attributes.get('name')
+        if name is None or 'disabled' in attributes:
+            return
+        kind = (attributes.get('type') or 'text').lower()
+        if tag == 'textarea' or tag == 'select':
+            if text is not None:
+                self.controls.append(('value', name, text))
+        elif kind in ('submit', 'image', 'button'):
+            self.controls.append(('submit', name, attributes.get('value', '')))
+        elif kind in ('checkbox', 'radio'):
+            if 'checked' in attributes:
+                self.controls.append(('value', name, attributes.get('value', 'on')))
+        elif kind == 'file':
+            self.controls.append(('file', name, None))
+        else:
+            self.controls.append(('value', name, attributes.get('value', '')))
+
+    def fields(self, submit=None):
+        """
+        Collects the name/value pairs a browser would send when
+        submitting the form. Only the given submit button is included.
+        :param submit: the name of the submit button to click, if any
+        :return: a list of (name, value) tuples
+        """
+        return [(name, value) for kind, name, value in self.controls
+                if kind == 'value' or (kind == 'submit' and name == submit)]
+
+
+class Page(object):
+    """
+    What the uploads need from a page of the website
+    """
+
+    def __init__(self, url):
+        """
+        :param url: the URL of the page, after redirects
+        """
+        self.url = url
+        self.forms = []
+        # The href of the first link with each of the wanted texts
+        self.links = {}
+        # The text of the title heading, if any
+        self.title = None
+
+    def form(self, id=None, class_=None):
+        """
+        :param id: the id the form must have, if any
+        :param class_: a class the form must have, if any
+        :return: the first form of the page matching the arguments, or None
+        """
+        for form in self.forms:
+            if (id is None or form.id == id) and (class_ is None or class_ in form.classes):
+                return form
+        return None
+
+    def link(self, text):
+        """
+        :param text: the exact text of the link, one of the link_texts the page was parsed with
+        :return: the href of the first link with the text, or None if there is no such link
+        """
+        return self.links.get(text)
+
+
+def parse_page(text, url, link_texts=LINK_TEXTS):
+    """
+    Extracts the forms, the wanted links and the title of a page
+    :param text: the HTML of the page
+    :param url: the URL of the page, after redirects
+    :param link_texts: the texts of the links to find
+    :return: the Page
+    """
+    if parser == 'lxml':
+        return parse_page_lxml(text, url, link_texts)
+    return parse_page_stream(text, url, link_texts)
+
+
+def parse_page_lxml(text, url, link_texts=LINK_TEXTS):
+    """
+    parse_page with lxml, which builds the tree in C and is then queried with XPath
+    """
+    from lxml import etree
+    from lxml import html as lxml_html
+    page = Page(url)
+    try:
+        root = lxml_html.document_fromstring(text)
+    except (etree.ParserError, ValueError) as e:
+        # Empty pages, e.g. the body of a redirect
+        return page
+    for form_tag in root.iter('form'):
+        form = Form(url, form_tag.attrib)
+        for tag in form_tag.iter('input', 'textarea', 'select'):
+            if tag.tag == 'textarea':
+                form.add_control('textarea', tag.attrib, tag.text or '')
+            elif tag.tag == 'select':
+                options = tag.xpath('.//option[@selected]') or tag.xpath('.//option')
+                value = None
+                if len(options) > 0:
+                    value = options[0].get('value', options[0].text_content())
+                form.add_control('select', tag.attrib, value)
+            else:
+                form.add_control('input', tag.attrib)
+        page.forms.append(form)
+    for link_text in link_texts:
+        hrefs = root.xpath('(//a[@href][string(.)=$text])[1]/@href', smart_strings=False, text=link_text)
+        if len(hrefs) > 0:
+            page.links[link_text] = hrefs[0]
+    titles = root.find_class(TITLE_CLASS)
+    if len(titles) > 0:
+        page.title = titles[0].text_content()
+    return page
+
+
+class StreamingExtractor(HTMLParser):
+    """
+    Fills a Page while the HTML is tokenized, without building a tree
+    """
+
+    def __init__(self, page, link_texts):
+        super().__init__(convert_charrefs=True)
+        self.page = page
+        self.link_texts = link_texts
+        self.form = None
+        # The href and the text so far of the link being read
+        self.link = None
+        # The name, attributes and text so far of the textarea or select being read
+        self.control = None
+        # The value of the first and of the selected option of the select being read
+        self.first_option = None
+        self.selected_option = None
+        # The attributes and text so far of the option being read
+        self.option = None
+        # The tag name, nesting depth and text so far of the title being read
+        self.title = None
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict((name, '' if value is None else value) for name, value in attrs)
+        if self.title is not None and tag == self.title[0]:
+            self.title[1] = self.title[1] + 1
+        elif self.title is None and self.page.title is None and TITLE_CLASS in attributes.get('class', '').split():
+            self.title = [tag, 1, []]
+        if tag == 'form':
+            self.form = Form(self.page.url, attributes)
+            self.page.forms.append(self.form)
+        elif tag == 'a' and 'href' in attributes:
+            self.link = (attributes['href'], [])
+        elif self.form is None:
+            return
+        elif tag == 'input':
+            self.form.add_control('input', attributes)
+        elif tag in ('textarea', 'select'):
+            self.control = (tag, attributes, [])
+            self.first_option = None
+            self.selected_option = None
+        elif tag == 'option' and self.control is not None:
+            self.end_option()
+            self.option = (attributes, [])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag == 'option':
+            self.end_option()
+
+    def handle_data(self, data):
+        if self.link is not None:
+            self.link[1].append(data)
+        if self.title is not None:
+            self.title[2].append(data)
+        if self.option is not None:
+            self.option[1].append(data)
+        elif self.control is not None and self.control[0] == 'textarea':
+            self.control[2].append(data)
+
+    def handle_endtag(self, tag):
+        if self.title is not None and tag == self.title[0]:
+            self.title[1] = self.title[1] - 1
+            if self.title[1] == 0:
+                self.page.title = ''.join(self.title[2])
+                self.title = None
+        if tag == 'a' and self.link is not None:
+            text = ''.join(self.link[1])
+            if text in self.link_texts and text not in self.page.links:
+                self.page.links[text] = self.link[0]
+            self.link = None
+        elif tag == 'form':
+            self.form = None
+        elif tag == 'option':
+            self.end_option()
+        elif self.control is not None and tag == self.control[0]:
+            name, attributes, text = self.control
+            self.end_option()
+            if name == 'textarea':
+                value = ''.join(text)
+            else:
+                value = self.selected_option if self.selected_option is not None else self.first_option
+            self.form.add_control(name, attributes, value)
+            self.control = None
+
+    def end_option(self):
+        """
+        Records the value of the option being read, if any
+        :return: None
+        """
+        if self.option is None:
+            return
+        attributes, text = self.option
+        value = attributes.get('value', ''.join(text))
+        if self.first_option is None:
+            self.first_option = value
+        if self.selected_option is None and 'selected' in attributes:
+            self.selected_option = value
+        self.option = None
+
+
+def parse_page_stream(text, url, link_texts=LINK_TEXTS):
+    """
+    parse_page with the standard library's tokenizer, for when lxml is not installed
+    """
+    page = Page(url)
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    extractor = StreamingExtractor(page, link_texts)
+    extractor.feed(text)
+    extractor.close()
+    return page
@@ -0,0 +1,197 @@
+"""
+Benchmark of the time taken to read a page of the website, comparing
+the BeautifulSoup html.parser tree the uploads used to build of every
+page with the targeted extraction of page_parser (with lxml and with
+the streaming parser).
+Pages saved from the website can be given, otherwise pages shaped like
+the replace page and the lock confirmation page of the website, with
+its navigation, blocks and scripts, are generated.
+
+Example:
+    python parse_benchmark.py --repeat 500
+    python parse_benchmark.py saved/replace.html saved/confirm.html
+"""
+import argparse
+import sys
+import threading
+import time
+
+import page_parser
+
+# The URL the pages are parsed as coming from, which form actions are relative to
+PAGE_URL = 'https://doh.arcabc.ca/islandora/object/doh%3A1/datastream/MODS/replace'
+
+
+def theme(title, content, links=150):
+    """
+    Wraps content in a page the size of the ones of the website
+    :param title: the title of the page
+    :param content: the HTML of the content of the page
+    :param links: the number of navigation links around the content
+    :return: the HTML of the page
+    """
+    head = ''.join('<link rel="stylesheet" href="/sites/all/themes/doh/css/style' + str(i) + '.css?q">'
+                   for i in range(20))
+    head = head + ''.join('<script src="/misc/script' + str(i) + '.js?v=7.59"></script>' for i in range(15))
+    head = head + '<script>jQuery.extend(Drupal.settings, {"basePath":"\\/","pathPrefix":"",' + \
+        '"ajaxPageState":{"theme":"doh","css":{' + ','.join('"c' + str(i) + '":1' for i in range(200)) + '}}});</script>'
+    navigation = ''.join('<li class="menu__item leaf"><a href="/islandora/object/doh%3Acollection' + str(i) +
+                         '" class="menu__link" title="Collection ' + str(i) + '">Collection ' + str(i) +
+                         '</a></li>' for i in range(links))
+    blocks = ''.join('<div class="block block-views" id="block-' + str(i) + '"><h2 class="block__title">Recent ' +
+                     str(i) + '</h2><div class="item-list"><ul>' +
+                     ''.join('<li><span class="field-content"><a href="/islandora/object/doh%3A' + str(j) + '">' +
+                             'Heritage object ' + str(j) + '</a></span></li>' for j in range(10)) +
+                     '</ul></div></div>' for i in range(6))
+    search = ('<form action="/islandora/search" method="post" id="islandora-solr-simple-search-form" '
+              'accept-charset="UTF-8"><div><input type="text" name="islandora_simple_search_query" value="">'
+              '<input type="hidden" name="form_build_id" value="form-x1">'
+              '<input type="hidden" name="form_id" value="islandora_solr_simple_search_form">'
+              '<input type="submit" name="op" value="search"></div></form>')
+    return ('<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>' + title + ' | DOH</title>' +
+            head + '</head><body class="html not-front logged-in page-islandora">'
+            '<div id="page"><header class="header"><a href="/" title="Home" class="header__logo">'
+            '<img src="/logo.png" alt="Home"></a>' + search + '</header>'
+            '<nav id="navigation"><ul class="menu">' + navigation + '</ul></nav>'
+            '<main id="main"><h1 class="page__title title">' + title + '</h1>' + content + '</main>'
+            '<aside class="sidebars">' + blocks + '</aside>'
+            '<footer class="footer">Digitized Okanagan History</footer></div></body></html>')
+
+
+def sample_pages():
+    """
+    :return: a list of (name, HTML) tuples of generated pages like the ones the uploads read
+    """
+    token = '<input type="hidden" name="form_token" value="0123456789abcdef0123456789abcdef">'
+    replace = theme('Update Datastream',
+                    '<div class="messages status">You hold the lock of this object, '
+                    '<a href="/islandora/object/doh%3A1/manage/unlock?destination=x">release</a> it '
+                    'when you are done.</div>'
+                    '<form enctype="multipart/form-data" action="/islandora/object/doh%3A1/datastream/MODS/replace" '
+                    'method="post" id="islandora-datastream-version-replace-form" accept-charset="UTF-8"><div>'
+                    '<input type="file" name="files[file]" size="48">'
+                    '<input type="hidden" name="form_build_id" value="form-abc">' + token +
+                    '<input type="hidden" name="form_id" value="islandora_datastream_version_replace_form">'
+                    '<input type="submit" name="op" value="Add Contents"></div></form>')
+    unlocked = theme('Update Datastream',
+                     '<div class="messages status">This object is not locked. To edit it, '
+                     '<a href="/islandora/object/doh%3A1/manage/lock?destination=x">acquire the lock</a>.</div>')
+    confirmation = theme('Are you sure you want to lock this object?',
+                         '<form action="/islandora/object/doh%3A1/manage/lock?destination=x" method="post" '
+                         'id="islandora-object-lock-form" class="confirmation" accept-charset="UTF-8"><div>'
+                         '<input type="hidden" name="confirm" value="1">'
+                         '<input type="hidden" name="form_build_id" value="form-def">' + token +
+                         '<input type="hidden" name="form_id" value="islandora_object_lock_form">'
+                         '<input type="submit" name="op" value="Confirm"></div></form>')
+    return [('replace', replace), ('unlocked', unlocked), ('confirmation', confirmation)]
+
+
+def extract_beautifulsoup(text, url):
+    """
+    What the uploads used to do with every page: build the BeautifulSoup
+    tree with html.parser, then search it for the forms and links
+    :param text: the HTML of the page
+    :param url: the URL of the page
+    :return: a tuple of the forms (id, action, fields) and the wanted links, to compare the parsers
+    """
+    from bs4 import BeautifulSoup
+    from urllib.parse import urljoin
+    soup = BeautifulSoup(text, 'html.parser')
+    forms = []
+    for form in soup.find_all('form'):
+        fields = []
+        for tag in form.find_all(['input', 'textarea', 'select']):
+            name = tag.get('name')
+            if name is None or tag.has_attr('disabled'):
+                continue
+            kind = tag.get('type', 'text').lower()
+            if kind in ('submit', 'image', 'button', 'file'):
+                continue
+            if kind in ('checkbox', 'radio'):
+                if tag.has_attr('checked'):
+                    fields.append((name, tag.get('value', 'on')))
+            elif tag.name == 'textarea':
+                fields.append((name, tag.text))
+            elif tag.name == 'select':
+                option = tag.find('option', selected=True) or tag.find('option')
+                if option is not None:
+                    fields.append((name, option.get('value', option.text)))
+            else:
+                fields.append((name, tag.get('value', '')))
+        forms.append((form.get('id'), urljoin(url, form.get('action') or url), fields))
+    links = {}
+    for link in soup.find_all('a', href=True):
+        if link.text in page_parser.LINK_TEXTS and link.text not in links:
+            links[link.text] = link['href']
+    return forms, links
+
+
+def extract_with(parse):
+    """
+    :param parse: a page_parser parse function
+    :return: a function extracting the same as extract_beautifulsoup with it
+    """
+    def extract(text, url):
+        page = parse(text, url)
+        return [(form.id, form.action, form.fields()) for form in page.forms], page.links
+    return extract
+
+
+def measure(extract, text, repeat, threads=1):
+    """
+    :param extract: the function to measure
+    :param text: the HTML of the page
+    :param repeat: the number of times every thread parses it
+    :param threads: the number of threads parsing at once, like the upload threads do
+    :return: the wall clock time per page in seconds
+    """
+    def parse():
+        for i in range(repeat):
+            extract(text, PAGE_URL)
+
+    workers = [threading.Thread(target=parse) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (repeat * threads)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measures the time taken to read a page of the website.')
+    parser.add_argument('pages', nargs='*', help='HTML files saved from the website (default: generated pages)')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='the number of times every page is parsed (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='the number of threads parsing at once, with --repeat pages each (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    pages = []
+    for path in args.pages:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            pages.append((path, f.read()))
+    pages = pages or sample_pages()
+
+    parsers = [('beautifulsoup', extract_beautifulsoup)]
+    if page_parser.has_lxml:
+        parsers.append(('lxml', extract_with(page_parser.parse_page_lxml)))
+    parsers.append(('stream', extract_with(page_parser.parse_page_stream)))
+
+    print('{:<14} {:>8} {:<14} {:>9} {:>8}'.format('page', 'KB', 'parser', 'ms/page', 'speedup'))
+    mismatches = 0
+    for name, text in pages:
+        expected = extract_beautifulsoup(text, PAGE_URL)
+        baseline = None
+        for parser_name, extract in parsers:
+            if extract(text, PAGE_URL) != expected:
+                print(parser_name + ' does not extract the same as beautifulsoup from ' + name)
+                mismatches = mismatches + 1
+            seconds = measure(extract, text, args.repeat, args.threads)
+            baseline = baseline or seconds
+            print('{:<14} {:>8.1f} {:<14} {:>9.3f} {:>7.1f}x'.format(
+                name, len(text) / 1024.0, parser_name, seconds * 1000, baseline / seconds))
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""
+Dry run of a reingest: what uploading a folder would change on the
+website, without locking or replacing anything.
+The MODS the website has for every object is downloaded (see
+snapshot.download) many at once, as nothing is written, and compared
+with the local file. Files the same as the website once formatting is
+ignored (see change_detection.normalized_hash) are unchanged. For the
+others the elements of both documents are compared by their path, e.g.
+mods/titleInfo/title, their attributes and their text, regardless of
+the order of siblings, giving the elements added, removed and changed.
+As the order counts for the upload, the elements found in both but in
+another order are then given as moved.
+The summary counts the results and the elements changed in the most objects.
+
+Example:
+    python preview.py /path/to/UpdatedXML -u "Jane Doe" -o preview.csv
+"""
+import argparse
+import collections
+import csv
+import difflib
+import getpass
+import io
+import itertools
+import os
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+import ratelimit
+import snapshot
+import upload_core
+from change_detection import normalized_hash
+from retry import RetryPolicy
+from upload_core import session_manager, scan_objects
+
+"""
+The results of comparing an object
+"""
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+# The website has no MODS for the object
+MISSING = 'missing'
+# The local file is not well-formed XML
+INVALID = 'invalid'
+FAILED = 'failed'
+RESULTS = (CHANGED, UNCHANGED, MISSING, INVALID, FAILED)
+
+# The number of objects compared at once, higher than the uploads as nothing is locked
+default_threads = 64
+# The number of elements listed in the summary
+default_top = 10
+
+
+def local_name(tag):
+    """
+    :param tag: an ElementTree tag, e.g. {http://www.loc.gov/mods/v3}title
+    :return: the tag without its namespace, e.g. title
+    """
+    return tag.rpartition('}')[2]
+
+
+def flatten(data):
+    """
+    Lists the elements of an XML document in a form compared element by element
+    :param data: the XML as bytes
+    :return: a list of (path, attributes, text) tuples in document order, the path being the
+    local names from the root e.g. mods/titleInfo/title and the text normalized for whitespace
+    :raises ElementTree.ParseError: if the XML is not well-formed
+    """
+    elements = []
+
+    def visit(element, parent_path):
+        path = parent_path + '/' + local_name(element.tag) if parent_path else local_name(element.tag)
+        attributes = tuple(sorted((local_name(name), value) for name, value in element.attrib.items()))
+        elements.append((path, attributes, ' '.join((element.text or '').split())))
+        for child in element:
+            # Comments and processing instructions have a function as their tag
+            if isinstance(child.tag, str):
+                visit(child, path)
+
+    visit(ElementTree.fromstring(data), '')
+    return elements
+
+
+def structural_diff(website, local):
+    """
+    Compares two MODS documents element by element
+    :param website: the MODS the website has, as bytes
+    :param local: the MODS of the local file, as bytes
+    :return: a dict of (added, removed, changed, moved) counts of elements by path: elements
+    only in the local file, only on the website, with the same path on both but different
+    attributes or text, and on both but in another order
+    :raises ElementTree.ParseError: if either document is not well-formed
+    """
+    before = flatten(website)
+    after = flatten(local)
+    before_counts = collections.Counter(before)
+    after_counts = collections.Counter(after)
+    added = collections.Counter(element[0] for element in (after_counts - before_counts).elements())
+    removed = collections.Counter(element[0] for element in (before_counts - after_counts).elements())
+    # The elements on both that are not in the longest run kept in order were moved
+    in_order = collections.Counter()
+    for block in difflib.SequenceMatcher(None, before, after, autojunk=False).get_matching_blocks():
+        in_order.update(after[block.b:block.b + block.size])
+    moved = collections.Counter(element[0] for element in
+                                ((after_counts & before_counts) - in_order).elements())
+    paths = {}
+    for path in set(added) | set(removed) | set(moved):
+        changed = min(added[path], removed[path])
+        paths[path] = (added[path] - changed, removed[path] - changed, changed, moved[path])
+    return paths
+
+
+class ObjectPreview(object):
+    """
+    What uploading the file of an object would change
+    """
+
+    def __init__(self, result, paths=None, error=None):
+        """
+        :param result: CHANGED, UNCHANGED, MISSING, INVALID or FAILED
+        :param paths: the (added, removed, changed, moved) counts of elements by path, see structural_diff
+        :param error: what went wrong, for INVALID and FAILED
+        """
+        self.result = result
+        self.paths = paths or {}
+        self.error = error
+
+    def totals(self):
+        """
+        :return: the number of elements added, removed, changed and moved
+        """
+        return tuple(sum(counts[i] for counts in self.paths.values()) for i in range(4))
+
+
+def preview_object(repo, num, path, retries):
+    """
+    Compares the MODS the website has for an object with the local file
+    :param repo: the repository namespace of the object
+    :param num: the number of the object
+    :param path: the path of the local MODS XML file
+    :param retries: the RetryPolicy deciding whether download errors are tried again
+    :return: the ObjectPreview
+    """
+    try:
+        with open(path, 'rb') as f:
+            local = f.read()
+        out = io.BytesIO()
+        if snapshot.download(repo, num, out, retries) == snapshot.MISSING:
+            return ObjectPreview(MISSING)
+    except Exception as e:
+        return ObjectPreview(FAILED, error=str(e))
+    website = out.getvalue()
+    if normalized_hash(website) == normalized_hash(local):
+        return ObjectPreview(UNCHANGED)
+    try:
+        paths = structural_diff(website, local)
+        if len(paths) == 0:
+            # e.g. the spaces within a text, or comments, which the upload would still replace
+            return ObjectPreview(CHANGED, error='only the formatting differs')
+        return ObjectPreview(CHANGED, paths)
+    except ElementTree.ParseError as e:
+        try:
+            ElementTree.fromstring(local)
+        except ElementTree.ParseError as e:
+            return ObjectPreview(INVALID, error='not well-formed XML: ' + str(e))
+        # The website has something that is not XML, all of it is replaced
+        return ObjectPreview(CHANGED, error='the MODS on the website is not well-formed XML')
+
+
+class PreviewSummary(object):
+    """
+    The results of a dry run, and the elements changed in the most objects
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        # The number of changed objects in which each path has added, removed, changed or moved elements
+        self.touched = collections.Counter()
+        # The number of elements added, removed, changed and moved in every object
+        self.elements = [0, 0, 0, 0]
+
+    def add(self, preview):
+        """
+        :param preview: the ObjectPreview of an object
+        :return: None
+        """
+        self.counts[preview.result] += 1
+        self.touched.update(preview.paths.keys())
+        for i, total in enumerate(preview.totals()):
+            self.elements[i] = self.elements[i] + total
+
+    def text(self, top=default_top):
+        """
+        :param top: the number of elements to list
+        :return: the summary as text
+        """
+        lines = [', '.join(str(self.counts[result]) + ' ' + result for result in RESULTS),
+                 'Elements: ' + str(self.elements[0]) + ' added, ' + str(self.elements[1]) + ' removed, ' +
+                 str(self.elements[2]) + ' changed, ' + str(self.elements[3]) + ' moved']
+        if len(self.touched) > 0:
+            lines.append('Most changed elements (objects):')
+            for path, count in self.touched.most_common(top):
+                lines.append('  {:<50} {:>8}'.format(path, count))
+        return '\n'.join(lines)
+
+
+def preview_all(objects, threads=default_threads, retries=None, on_result=None):
+    """
+    Compares objects with the website concurrently
+    :param objects: an iterable of tuples starting with (repository, number, path)
+    :param threads: the number of objects compared at once
+    :param retries: the RetryPolicy deciding whether download errors are tried again, defaults to a new one
+    :param on_result: optional callback called with every object and its ObjectPreview
+    :return: the PreviewSummary
+    """
+    retries = retries or RetryPolicy()
+    summary = PreviewSummary()
+
+    def finish(obj, future):
+        preview = future.result()
+        summary.add(preview)
+        if on_result is not None:
+            on_result(obj, preview)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = collections.deque()
+        for obj in objects:
+            pending.append((obj, executor.submit(preview_object, obj[0], obj[1], obj[2], retries)))
+            while len(pending) > 0 and (pending[0][1].done() or len(pending) >= threads * 2):
+                finish(*pending.popleft())
+        while len(pending) > 0:
+            finish(*pending.popleft())
+    return summary
+
+
+def report_row(obj, preview):
+    """
+    :param obj: a tuple starting with (repository, number, path)
+    :param preview: its ObjectPreview
+    :return: the CSV report row of the object
+    """
+    added, removed, changed, moved = preview.totals()
+    return [obj[0], obj[1], obj[2], preview.result, added, removed, changed, moved,
+            '; '.join(sorted(preview.paths)), preview.error or '']
+
+
+def main(argv=None):
+    """
+    Entry point of the dry run
+    :param argv: the arguments without the program name, defaults to sys.argv
+    :return: the exit code
+    """
+    parser = argparse.ArgumentParser(description='Shows what uploading a folder of MODS XML files to the DOH Arca '
+                                                 'website would change, without changing anything.')
+    parser.add_argument('folder', help='the folder to search recursively for <repository>_<number>.xml files')
+    parser.add_argument('-u', '--username', required=True, help='the username to sign in with')
+    parser.add_argument('-p', '--password',
+                        help='the password (default: the DOH_PASSWORD environment variable, or a prompt)')
+    parser.add_argument('-t', '--threads', type=int, default=default_threads,
+                        help='the number of objects compared at once (default: %(default)s)')
+    parser.add_argument('--sessions', type=int, default=4,
+                        help='the number of signed in sessions the downloads are spread over (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=default_top,
+                        help='the number of most changed elements listed (default: %(default)s)')
+    parser.add_argument('--scan-threads', type=int, default=upload_core.scan_threads,
+                        help='the number of directories listed at once (default: %(default)s)')
+    parser.add_argument('--base-url', default=upload_core.base_url,
+                        help='the address of the website (default: %(default)s)')
+    parser.add_argument('-o', '--report', help='write what would change in every object to this CSV file')
+    ratelimit.add_arguments(parser)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    error = 'The number of threads must be at least 1' if args.threads < 1 else ratelimit.check_arguments(args)
+    if error is not None:
+        print(error)
+        return 2
+    ratelimit.configure(args.rate, args.burst, args.rate_file)
+    password = args.password or os.environ.get('DOH_PASSWORD') or getpass.getpass()
+    upload_core.base_url = args.base_url.rstrip('/')
+
+    # Signs in while the folder is scanned
+    signing_in = session_manager.start_sign_in(args.username, password, args.sessions)
+    objects = iter(scan_objects(args.folder, args.scan_threads))
+    first = next(objects, None)
+    if not signing_in.result():
+        print(session_manager.failure_message())
+        return 1
+    if first is None:
+        print('No MODS XML files found in ' + args.folder)
+        return 1
+    objects = itertools.chain([first], objects)
+    start = time.monotonic()
+    if args.report:
+        with open(args.report, 'w', newline='') as f:
+            report = csv.writer(f)
+            report.writerow(['repository', 'number', 'path', 'result', 'added', 'removed', 'changed', 'moved',
+                             'elements', 'error'])
+            summary = preview_all(objects, args.threads,
+                                  on_result=lambda obj, preview: report.writerow(report_row(obj, preview)))
+    else:
+        summary = preview_all(objects, args.threads)
+    elapsed = time.monotonic() - start
+    total = sum(summary.counts.values())
+    print('Compared ' + str(total) + ' objects in ' + format(elapsed, '.1f') + ' s (' +
+          format(total / max(elapsed, 0.001), '.0f') + ' objects/s)')
+    print(summary.text(args.top))
+    return 0 if summary.counts[FAILED] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
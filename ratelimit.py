@@ -0,0 +1,271 @@
+"""
+Limit on the rate of the requests made to the website, to stay under a
+requests per second budget whatever the concurrency. Every request waits
+for a token of a token bucket, the requests library through the adapter
+mounted on every signed in session (see upload_core.login) and aiohttp
+through the trace config of the asyncio engine, so redirects are counted
+too. The bucket is kept as the generic cell rate algorithm: only the time
+the next token is due is stored, and every request reserves the next one,
+so the requests are spaced out evenly instead of going in bursts, at most
+burst of them at once after a quiet spell.
+Several uploader processes on one host can share a budget through a file
+holding that time, locked while it is read and updated.
+"""
+import asyncio
+import os
+import struct
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# The max number of requests per second, None for no limit
+rate = None
+# The number of requests that may go at once after a quiet spell, 1 spaces out every request
+burst = 1
+# The path of the file shared with the other processes on the host, None to limit this process only
+shared_file = None
+
+# The bucket every request waits for, set by configure()
+limiter = None
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at a steady rate, safe to use from any thread
+    """
+    # The clock tokens are due by
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: the number of tokens per second
+        :param burst: the max number of tokens saved up
+        """
+        self.interval = 1.0 / rate
+        # How early a token may be taken, the burst beyond the first token
+        self.tolerance = (burst - 1) * self.interval
+        self.lock = threading.Lock()
+        # When the next token is due if none are saved up
+        self.due = 0.0
+
+    def take(self, now):
+        """
+        Reserves the next token, the lock must be held
+        :param now: the time by the clock
+        :return: how long to wait for the token, in seconds
+        """
+        start = max(now, self.due - self.tolerance)
+        self.due = max(self.due, start) + self.interval
+        return start - now
+
+    def reserve(self):
+        """
+        Reserves the next token
+        :return: how long to wait for it before making the request, in seconds
+        """
+        with self.lock:
+            return self.take(self.clock())
+
+    def acquire(self):
+        """
+        Waits for a token
+        :return: None
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """
+        Waits for a token without blocking the event loop
+        :return: None
+        """
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def lock_file(fd):
+    """
+    Waits for the exclusive lock of a file, held until unlock_file()
+    :param fd: the file descriptor
+    :return: None
+    """
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after 10 seconds
+                continue
+
+
+def unlock_file(fd):
+    """
+    :param fd: the file descriptor locked with lock_file()
+    :return: None
+    """
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket shared by every process on the host opening the same file.
+    Every process should be given the same rate and burst.
+    """
+    # The wall clock, the same in every process and after a restart
+    clock = staticmethod(time.time)
+
+    def __init__(self, path, rate, burst=1):
+        """
+        :param path: the path of the file, created if missing
+        :param rate: the number of tokens per second of every process together
+        :param burst: the max number of tokens saved up
+        """
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+
+    def reserve(self):
+        # The lock of the file does not keep out the other threads of this process
+        with self.lock:
+            lock_file(self.fd)
+            try:
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                data = os.read(self.fd, 8)
+                self.due = struct.unpack('<d', data)[0] if len(data) == 8 else 0.0
+                wait = self.take(self.clock())
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, struct.pack('<d', self.due))
+                return wait
+            finally:
+                unlock_file(self.fd)
+
+    def close(self):
+        """
+        :return: None
+        """
+        os.close(self.fd)
+
+
+def configure(new_rate, new_burst=1, path=None):
+    """
+    Sets the limit every request waits for from now on
+    :param new_rate: the max number of requests per second, None for no limit
+    :param new_burst: the number of requests that may go at once after a quiet spell
+    :param path: the path of the file to share the limit with the other processes on the host, if any
+    :return: None
+    """
+    global rate, burst, shared_file, limiter
+    if isinstance(limiter, SharedTokenBucket):
+        limiter.close()
+    rate, burst, shared_file = new_rate, new_burst, path
+    if rate is None:
+        limiter = None
+    elif path is not None:
+        limiter = SharedTokenBucket(path, rate, burst)
+    else:
+        limiter = TokenBucket(rate, burst)
+
+
+def acquire():
+    """
+    Waits until a request may be made, at once if there is no limit
+    :return: None
+    """
+    bucket = limiter
+    if bucket is not None:
+        bucket.acquire()
+
+
+async def acquire_async():
+    """
+    Waits until a request may be made without blocking the event loop
+    :return: None
+    """
+    bucket = limiter
+    if bucket is not None:
+        await bucket.acquire_async()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Transport adapter of the requests library that waits for the limit
+    before sending every request, including the ones following redirects
+    """
+
+    def send(self, request, **kwargs):
+        acquire()
+        return super(RateLimitedAdapter, self).send(request, **kwargs)
+
+
+def mount(session):
+    """
+    Makes every request of a requests.Session wait for the limit
+    :param session: the requests.Session
+    :return: the session
+    """
+    adapter = RateLimitedAdapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def trace_config():
+    """
+    :return: an aiohttp.TraceConfig making every request of a ClientSession, including
+    the ones following redirects, wait for the limit
+    """
+    import aiohttp
+
+    async def wait(session, context, params):
+        await acquire_async()
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(wait)
+    config.on_request_redirect.append(wait)
+    return config
+
+
+def add_arguments(parser):
+    """
+    Adds the arguments of the limit to a command line parser
+    :param parser: the argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--rate', type=float,
+                        help='the most requests per second made to the website, spaced out evenly '
+                             '(default: no limit)')
+    parser.add_argument('--burst', type=int, default=burst,
+                        help='the number of requests that may go at once after a quiet spell (default: %(default)s)')
+    parser.add_argument('--rate-file',
+                        help='share the --rate with the other uploaders on this machine given the same file')
+
+
+def check_arguments(args):
+    """
+    :param args: the arguments parsed with add_arguments
+    :return: what is wrong with them, or None if nothing is
+    """
+    if args.rate is not None and args.rate <= 0:
+        return 'The rate must be positive'
+    if args.burst < 1:
+        return 'The burst must be at least 1'
+    if args.rate_file is not None and args.rate is None:
+        return '--rate-file needs a --rate'
+    return None
@@ -0,0 +1,151 @@
+"""
+Retries of objects that failed for reasons that may go away.
+Server errors and network problems are retried after a jittered
+exponential backoff and objects locked by someone else are put
+back at the end of the queue after a longer delay, instead of
+being marked as failed for a human to re-run the whole folder.
+Retries are limited per object and by a global budget, so that a
+website that is down is not hammered by every object at once.
+Waiting objects are kept in a queue rather than sleeping on a
+worker, so they never take a slot from the objects being uploaded.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import upload_core
+
+# The max number of times an object is retried after server or network errors
+max_retries = 3
+# The max number of times an object locked by someone else is put back in the queue
+max_lock_retries = 5
+# The delay before the first retry after an error, doubled for every retry, in seconds
+base_delay = 1.0
+# The longest delay after an error, in seconds
+max_delay = 60.0
+# How long an object locked by someone else waits before it is tried again, in seconds
+lock_delay = 30.0
+# Retries after errors may add at most this fraction to the attempts made,
+# plus min_budget so that a small batch can still retry
+budget_ratio = 0.2
+min_budget = 10
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and when a finished attempt is tried again.
+    Safe to use from any thread.
+    """
+
+    def __init__(self, retries=None, lock_retries=None):
+        """
+        :param retries: the max number of retries after errors per object, defaults to max_retries
+        :param lock_retries: the max number of retries of a locked object, defaults to max_lock_retries
+        """
+        self.retries = max_retries if retries is None else retries
+        self.lock_retries = max_lock_retries if lock_retries is None else lock_retries
+        self.lock = threading.Lock()
+        # The number of retries of every object being retried, by key
+        self.attempts = {}
+        self.total_attempts = 0
+        self.total_retries = 0
+
+    def retry_delay(self, key, outcome):
+        """
+        Records the outcome of an attempt and decides whether to retry it.
+        Must be called for every attempt, successful or not, as the global
+        budget grows with the number of attempts.
+        :param key: what identifies the object
+        :param outcome: the outcome of the attempt e.g. upload_core.TRANSIENT
+        :return: the number of seconds to wait before retrying, or None if
+        the outcome is final
+        """
+        with self.lock:
+            self.total_attempts = self.total_attempts + 1
+            errors, locks = self.attempts.get(key, (0, 0))
+            if outcome == upload_core.TRANSIENT and errors < self.retries and \
+                    self.total_retries < min_budget + budget_ratio * self.total_attempts:
+                self.attempts[key] = (errors + 1, locks)
+                self.total_retries = self.total_retries + 1
+                delay = min(max_delay, base_delay * 2 ** errors)
+                # Half fixed, half random so that objects that failed together spread out
+                return delay / 2 + random.uniform(0, delay / 2)
+            if outcome == upload_core.LOCKED and locks < self.lock_retries:
+                self.attempts[key] = (errors, locks + 1)
+                return lock_delay + random.uniform(0, lock_delay / 2)
+            self.attempts.pop(key, None)
+            return None
+
+
+class RetryScheduler(object):
+    """
+    Queue of objects waiting to be retried, for the engines that pull
+    the objects that are due rather than sleeping until they are.
+    Safe to use from any thread.
+    """
+
+    def __init__(self, policy=None):
+        """
+        :param policy: the RetryPolicy deciding what is retried, defaults to a new one
+        """
+        self.policy = policy or RetryPolicy()
+        self.lock = threading.Lock()
+        # (due time, sequence number, object) tuples, the sequence
+        # number keeps objects due at the same time in order
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def schedule(self, key, obj, outcome):
+        """
+        Records the outcome of an attempt and queues the object if it is to be retried
+        :param key: what identifies the object
+        :param obj: what is handed back by take_due() once the retry is due
+        :param outcome: the outcome of the attempt e.g. upload_core.TRANSIENT
+        :return: whether the object was queued, if not the outcome is final
+        """
+        delay = self.policy.retry_delay(key, outcome)
+        if delay is None:
+            return False
+        with self.lock:
+            heapq.heappush(self.waiting, (time.monotonic() + delay, next(self.sequence), obj))
+        return True
+
+    def take_due(self):
+        """
+        Removes the objects whose retry is due
+        :return: a list of the objects, in the order they are due
+        """
+        due = []
+        now = time.monotonic()
+        with self.lock:
+            while len(self.waiting) > 0 and self.waiting[0][0] <= now:
+                due.append(heapq.heappop(self.waiting)[2])
+        return due
+
+    def take_all(self):
+        """
+        Removes every waiting object, e.g. when the uploads are cancelled
+        :return: a list of the objects, in the order they are due
+        """
+        with self.lock:
+            waiting = [item[2] for item in sorted(self.waiting)]
+            self.waiting = []
+        return waiting
+
+    def next_due(self):
+        """
+        :return: the number of seconds until the next retry is due, or None if nothing is waiting
+        """
+        with self.lock:
+            if len(self.waiting) == 0:
+                return None
+            return max(self.waiting[0][0] - time.monotonic(), 0)
+
+    def pending(self):
+        """
+        :return: the number of objects waiting to be retried
+        """
+        with self.lock:
+            return len(self.waiting)
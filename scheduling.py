@@ -0,0 +1,224 @@
+"""
+Order in which the objects are handed to the upload engines.
+Objects are taken round robin across repository namespaces, so a
+large collection can not hold back a small one, and by priority
+class, e.g. objects that failed in an earlier run first. Within a
+namespace objects go by number, so the order is the same from one
+run to the next whatever order the folder scan found the files in.
+The number of objects of a namespace being uploaded at once can be
+capped, so one collection's locks are not all taken at the same time.
+"""
+import bisect
+import heapq
+import itertools
+import threading
+
+# The priority classes, the lower ones are taken first
+PRIORITY_FAILED = 0
+PRIORITY_NORMAL = 1
+
+# The max number of objects of one namespace uploaded at once, by namespace
+namespace_caps = {}
+# The max number of objects of any other namespace uploaded at once, None for no limit
+default_namespace_cap = None
+
+
+def parse_caps(text):
+    """
+    Parses caps written as e.g. "doh=2, abc=4, 8": a cap for the doh and abc
+    namespaces and one for every other namespace
+    :param text: the caps as text, empty for no caps
+    :return: a tuple of a dict of the caps by namespace and the default cap, or None
+    :raises ValueError: if the text is not valid
+    """
+    caps = {}
+    default = None
+    for part in text.split(','):
+        part = part.strip()
+        if len(part) == 0:
+            continue
+        namespace, separator, cap = part.rpartition('=')
+        cap = int(cap)
+        if cap < 1:
+            raise ValueError('a cap must be at least 1: ' + part)
+        if separator:
+            caps[namespace.strip()] = cap
+        else:
+            default = cap
+    return caps, default
+
+
+def number_order(number):
+    """
+    :param number: the number of an object, as text
+    :return: a sort key ordering numbers numerically, e.g. 9 before 10
+    """
+    return len(number), number
+
+
+class FairScheduler(object):
+    """
+    Objects waiting to be uploaded, handed out fairly. Engines take() objects
+    when there is room for them, or iterate get() when the objects are pulled,
+    and report every finished one with done(). Safe to use from any thread.
+    """
+
+    def __init__(self, caps=None, default_cap=None):
+        """
+        :param caps: the max number of objects in flight by namespace, defaults to namespace_caps
+        :param default_cap: the max number of objects in flight of the other namespaces,
+        defaults to default_namespace_cap
+        """
+        self.caps = dict(namespace_caps if caps is None else caps)
+        self.default_cap = default_namespace_cap if default_cap is None else default_cap
+        self.condition = threading.Condition()
+        # The waiting objects as (order, sequence number, object) heaps, by priority then by namespace
+        self.waiting = {}
+        # The namespaces with waiting objects, sorted, by priority
+        self.namespaces = {}
+        # The namespace last taken from, by priority, the next take starts after it
+        self.cursors = {}
+        self.sequence = itertools.count()
+        # The number of objects taken and not done, by namespace
+        self.in_flight = {}
+        self.total_in_flight = 0
+        self.count = 0
+        # Whether no more objects will be put
+        self.closed = False
+        # Whether objects are held back until resume()
+        self.paused = False
+
+    def put(self, namespace, obj, priority=PRIORITY_NORMAL, order=None):
+        """
+        Adds an object to be uploaded
+        :param namespace: the repository namespace of the object
+        :param obj: what take() and get() hand back
+        :param priority: the priority class of the object e.g. PRIORITY_FAILED
+        :param order: the sort key of the object within its namespace, defaults to the order of put()
+        :return: None
+        """
+        with self.condition:
+            heaps = self.waiting.setdefault(priority, {})
+            heap = heaps.get(namespace)
+            if heap is None:
+                heap = heaps[namespace] = []
+                bisect.insort(self.namespaces.setdefault(priority, []), namespace)
+            heapq.heappush(heap, (() if order is None else order, next(self.sequence), obj))
+            self.count = self.count + 1
+            self.condition.notify_all()
+
+    def cap(self, namespace):
+        """
+        :param namespace: a repository namespace
+        :return: the max number of its objects in flight, or None for no limit
+        """
+        return self.caps.get(namespace, self.default_cap)
+
+    def take(self, limit=None):
+        """
+        Takes the next object: the first priority class with an object of a
+        namespace under its cap, and in it the namespace after the last one taken from
+        :param limit: the max number of objects in flight in total, None for no limit
+        :return: the object, or None if there is none or no room for one
+        """
+        with self.condition:
+            return self.take_locked(limit)
+
+    def take_locked(self, limit):
+        if self.paused or (limit is not None and self.total_in_flight >= limit):
+            return None
+        for priority in sorted(self.namespaces):
+            namespaces = self.namespaces[priority]
+            start = bisect.bisect_right(namespaces, self.cursors.get(priority, ''))
+            for i in range(len(namespaces)):
+                namespace = namespaces[(start + i) % len(namespaces)]
+                cap = self.cap(namespace)
+                if cap is not None and self.in_flight.get(namespace, 0) >= cap:
+                    continue
+                heaps = self.waiting[priority]
+                heap = heaps[namespace]
+                obj = heapq.heappop(heap)[2]
+                if len(heap) == 0:
+                    del heaps[namespace]
+                    namespaces.remove(namespace)
+                    if len(namespaces) == 0:
+                        del self.namespaces[priority]
+                        del self.waiting[priority]
+                self.cursors[priority] = namespace
+                self.in_flight[namespace] = self.in_flight.get(namespace, 0) + 1
+                self.total_in_flight = self.total_in_flight + 1
+                self.count = self.count - 1
+                return obj
+        return None
+
+    def get(self):
+        """
+        Waits for the next object, e.g. for an engine pulling the objects from an iterator
+        :return: the object, or None once closed and every object was taken
+        """
+        with self.condition:
+            while True:
+                obj = self.take_locked(None)
+                if obj is not None or (self.closed and self.count == 0):
+                    return obj
+                self.condition.wait()
+
+    def done(self, namespace):
+        """
+        Frees the room taken by an object, once it finished or was put back to be retried
+        :param namespace: the repository namespace of the object
+        :return: None
+        """
+        with self.condition:
+            self.in_flight[namespace] = self.in_flight[namespace] - 1
+            self.total_in_flight = self.total_in_flight - 1
+            self.condition.notify_all()
+
+    def pause(self):
+        """
+        Holds the waiting objects back until resume(), the objects in flight carry on
+        :return: None
+        """
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        """
+        Hands out objects again after pause()
+        :return: None
+        """
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def cancel(self):
+        """
+        Removes every waiting object and closes the scheduler, the objects in flight carry on
+        :return: a list of the objects that were waiting
+        """
+        with self.condition:
+            cancelled = [item[2] for heaps in self.waiting.values() for heap in heaps.values()
+                         for item in sorted(heap)]
+            self.waiting = {}
+            self.namespaces = {}
+            self.count = 0
+            self.closed = True
+            self.paused = False
+            self.condition.notify_all()
+        return cancelled
+
+    def close(self):
+        """
+        Tells get() that no more objects will be put
+        :return: None
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def pending(self):
+        """
+        :return: the number of objects waiting to be taken
+        """
+        with self.condition:
+            return self.count
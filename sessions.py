@@ -0,0 +1,240 @@
+"""
+The signed in sessions of the website used by the threads engine
+and the change detection.
+Drupal sessions expire, e.g. overnight during a large reingest, after
+which every page answers as it does to someone who is not signed in.
+The uploads notice it (see upload_core.is_signed_out) and ask for the
+session to be signed in again: the first one to ask does, the others
+wait for it and reuse its result rather than all signing in at once.
+Several sessions can be signed in so that concurrent uploads are spread
+over them, rather than all going through the lock of a single cookie
+jar. Signing in can also run in the background, e.g. while the folder
+is scanned.
+Signing in can fail for reasons other than a wrong password, e.g. a
+server error or the website being unreachable. The login function then
+raises SignInError, and the sign in is tried again a few times before
+it is reported, apart from a wrong password, as the website being
+unavailable.
+"""
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# The number of sessions signed in and shared round robin by the uploads
+pool_size = 1
+# A session is signed in again at most this often, in seconds, so that pages
+# denied for another reason do not cause a sign in for every object
+reauth_interval = 10.0
+# How many times a sign in failing with a SignInError is tried again, and the
+# delay before the first retry in seconds, doubled for every other one
+sign_in_retries = 3
+sign_in_backoff = 1.0
+
+"""
+The results of SessionManager.reauthenticate
+"""
+# Signed in again, or by another upload, the upload should start over
+RETRY = 'retry'
+# Not signed in again, the page was denied for another reason or the credentials were rejected
+DENIED = 'denied'
+# The website could not be signed into for now, the upload is worth trying again later
+UNAVAILABLE = 'unavailable'
+
+
+class SignInError(Exception):
+    """
+    Signing in failed for a reason other than the username or password,
+    e.g. the website answered with a server error or could not be reached
+    """
+
+
+class PooledSession(object):
+    """
+    A signed in requests session, replaced whenever it is signed in again
+    """
+
+    def __init__(self, session):
+        """
+        :param session: the signed in requests.Session
+        """
+        self.lock = threading.Lock()
+        self.session = session
+        # Increased every time the session is signed in again
+        self.generation = 0
+        self.signed_in_at = time.monotonic()
+
+    def current(self):
+        """
+        Waits if the session is being signed in again
+        :return: a tuple of the requests.Session and its generation
+        """
+        with self.lock:
+            return self.session, self.generation
+
+
+class SessionManager(object):
+    """
+    Signs in and hands out the sessions. Safe to use from any thread.
+    """
+
+    def __init__(self, login):
+        """
+        :param login: the function signing in, called with the username and the
+        password and returning a signed in requests.Session or None if they are wrong
+        """
+        self.login = login
+        self.lock = threading.Lock()
+        # The (username, password) the pool is signed in with
+        self.credentials = None
+        self.pool = []
+        self.turn = itertools.count()
+        # The Future of the sign in running in the background, if any
+        self.pending = None
+        # What went wrong the last time signing in failed for a reason other than
+        # the username or password, None if it did not
+        self.error = None
+
+    def login_retrying(self, username, password):
+        """
+        Signs in one session, trying again after a SignInError
+        :param username: the username to login with
+        :param password: the password to login with
+        :return: the signed in requests.Session, or None if the username or password is wrong
+        :raises SignInError: if every attempt failed for another reason
+        """
+        for attempt in range(sign_in_retries + 1):
+            try:
+                return self.login(username, password)
+            except Exception as e:
+                error = e if isinstance(e, SignInError) else SignInError(str(e) or type(e).__name__)
+            if attempt < sign_in_retries:
+                time.sleep(sign_in_backoff * 2 ** attempt)
+        raise error
+
+    def sign_in(self, username, password, size=None):
+        """
+        Signs in the sessions, unless they are already signed in with the same
+        username and password. Different credentials replace the sessions.
+        :param username: the username to login with
+        :param password: the password to login with
+        :param size: the number of sessions, defaults to pool_size
+        :return: a boolean indicating if the sign in was successful, see failure_message()
+        for why it was not
+        """
+        size = size or pool_size
+        with self.lock:
+            if self.credentials == (username, password) and len(self.pool) == size:
+                return True
+        try:
+            if size == 1:
+                sessions = [self.login_retrying(username, password)]
+            else:
+                with ThreadPoolExecutor(max_workers=size) as executor:
+                    sessions = list(executor.map(lambda i: self.login_retrying(username, password), range(size)))
+            error = None
+        except SignInError as e:
+            sessions = []
+            error = str(e)
+        with self.lock:
+            self.error = error
+            if len(sessions) == 0 or any(session is None for session in sessions):
+                self.credentials = None
+                self.pool = []
+                return False
+            self.credentials = (username, password)
+            self.pool = [PooledSession(session) for session in sessions]
+            return True
+
+    def failure_message(self):
+        """
+        :return: why the last sign in failed, for the user
+        """
+        error = self.error
+        if error is not None:
+            return 'Could not sign in, the website is unavailable: ' + error
+        return 'Ensure your username and password are correct!'
+
+    def start_sign_in(self, username, password, size=None):
+        """
+        Runs sign_in on a background thread, the uploads wait for it in acquire()
+        :param username: the username to login with
+        :param password: the password to login with
+        :param size: the number of sessions, defaults to pool_size
+        :return: a concurrent.futures.Future of the result of sign_in
+        """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.sign_in(username, password, size))
+            except Exception as e:
+                future.set_exception(e)
+
+        with self.lock:
+            self.pending = future
+        threading.Thread(target=run, name='sign-in', daemon=True).start()
+        return future
+
+    def wait(self):
+        """
+        Waits for the sign in running in the background, if any
+        :return: whether the sessions are signed in
+        """
+        pending = self.pending
+        if pending is not None:
+            try:
+                pending.result()
+            except Exception as e:
+                pass
+        with self.lock:
+            return len(self.pool) > 0
+
+    def acquire(self):
+        """
+        :return: the next PooledSession, round robin, or None if not signed in
+        """
+        self.wait()
+        with self.lock:
+            if len(self.pool) == 0:
+                return None
+            return self.pool[next(self.turn) % len(self.pool)]
+
+    def session(self):
+        """
+        :return: a signed in requests.Session, or None if not signed in
+        """
+        pooled = self.acquire()
+        return None if pooled is None else pooled.current()[0]
+
+    def reauthenticate(self, pooled, generation):
+        """
+        Signs a session in again after an upload found it signed out. Only the
+        first upload to ask signs in, the others wait for it.
+        :param pooled: the PooledSession that was signed out
+        :param generation: the generation of the session the upload used
+        :return: RETRY if the upload should be tried again with the session, DENIED if
+        not, UNAVAILABLE if signing in failed for a reason other than the credentials
+        """
+        with self.lock:
+            credentials = self.credentials
+        if credentials is None:
+            return DENIED
+        with pooled.lock:
+            # Another upload already signed it in again
+            if pooled.generation != generation:
+                return RETRY
+            # Just signed in, so the page was denied for another reason
+            if time.monotonic() - pooled.signed_in_at < reauth_interval:
+                return DENIED
+            try:
+                session = self.login(*credentials)
+            except Exception as e:
+                print('Could not sign in again: ' + (str(e) or type(e).__name__))
+                return UNAVAILABLE
+            if session is None:
+                return DENIED
+            pooled.session = session
+            pooled.generation = pooled.generation + 1
+            pooled.signed_in_at = time.monotonic()
+            return RETRY
@@ -0,0 +1,436 @@
+"""
+Snapshots of the MODS the website has, taken before a batch replaces
+them, so that a bad batch can be rolled back.
+The MODS datastreams of the objects of a folder are downloaded
+concurrently and streamed to disk, each into a file named and laid out
+like the files the uploads read (<repository>/<repository>_<number>.xml),
+so a snapshot is restored by uploading it like any other folder, at
+the same throughput. With --zip they go into compressed archives of
+part_size objects each instead.
+An interrupted export is resumed by running it again: objects already
+in the snapshot are skipped. A file is only given its final name, and
+an archive only written as a whole, once complete, so an interruption
+never leaves a partial snapshot of an object behind.
+
+Example:
+    python snapshot.py export /path/to/UpdatedXML /backups/before-batch-7 -u "Jane Doe"
+    python snapshot.py export /path/to/UpdatedXML /backups/before-batch-7 -u "Jane Doe" --zip
+    python snapshot.py restore /backups/before-batch-7 -u "Jane Doe" -e async
+"""
+import argparse
+import collections
+import csv
+import getpass
+import glob
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+import ratelimit
+import sessions
+import upload_core
+import uploader_cli
+from change_detection import mods_url
+from retry import RetryPolicy
+from upload_core import session_manager, scan_objects
+
+"""
+The results of exporting an object
+"""
+EXPORTED = 'exported'
+# Already in the snapshot, from an earlier run
+SKIPPED = 'skipped'
+# The website has no MODS for the object
+MISSING = 'missing'
+FAILED = 'failed'
+
+# The number of datastreams downloaded at once
+default_threads = 16
+# The number of objects in every archive written with --zip
+part_size = 5000
+# The size of the pieces a datastream is streamed in, in bytes
+chunk_size = 64 * 1024
+# A datastream waiting to be written to an archive is kept in memory up
+# to this size and in a temporary file beyond, in bytes
+spool_size = 1024 * 1024
+# The names of the archives written with --zip
+PART_PATTERN = 'mods-*.zip'
+
+
+def snapshot_name(repo, num):
+    """
+    :param repo: the repository namespace of the object
+    :param num: the number of the object
+    :return: the name of the file of the object in a snapshot, the same as the files uploaded
+    """
+    return repo + '_' + num + '.xml'
+
+
+def download(repo, num, out, retries):
+    """
+    Streams the MODS the website has for an object into a file
+    :param repo: the repository namespace of the object
+    :param num: the number of the object
+    :param out: the binary file object to write to, emptied before every attempt
+    :param retries: the RetryPolicy deciding whether errors are tried again
+    :return: EXPORTED, or MISSING if the object has no MODS
+    :raises Exception: if the MODS could not be downloaded
+    """
+    pooled = session_manager.acquire()
+    if pooled is None:
+        raise IOError('Not signed in')
+    reauthenticated = False
+    while True:
+        session, generation = pooled.current()
+        out.seek(0)
+        out.truncate()
+        try:
+            with session.get(mods_url(repo, num), stream=True) as response:
+                # Signed out sessions are denied or sent to the login page
+                if response.status_code == 403 or urlparse(response.url).path.startswith('/user/login'):
+                    if not reauthenticated and session_manager.reauthenticate(pooled, generation) == sessions.RETRY:
+                        reauthenticated = True
+                        continue
+                    raise IOError('Access denied, the session may have expired')
+                if response.status_code == 404:
+                    result = MISSING
+                else:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size):
+                        out.write(chunk)
+                    result = EXPORTED
+            # The retry budget grows with every attempt, successful or not
+            retries.retry_delay(repo + ':' + num, upload_core.UPLOADED)
+            return result
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            status = e.response.status_code if getattr(e, 'response', None) is not None else None
+            if status is not None and status < 500:
+                raise
+            delay = retries.retry_delay(repo + ':' + num, upload_core.TRANSIENT)
+            if delay is None:
+                raise
+            time.sleep(delay)
+
+
+class FolderSnapshot(object):
+    """
+    A snapshot as a folder of MODS XML files, written directly by the download threads
+    """
+
+    def __init__(self, destination):
+        """
+        :param destination: the folder of the snapshot, created if missing
+        """
+        self.destination = destination
+        os.makedirs(destination, exist_ok=True)
+
+    def path(self, repo, num):
+        return os.path.join(self.destination, repo, snapshot_name(repo, num))
+
+    def has(self, repo, num):
+        """
+        :return: whether the snapshot already has the object
+        """
+        return os.path.exists(self.path(repo, num))
+
+    def download(self, repo, num, retries):
+        """
+        Downloads the MODS of an object into the snapshot. Called from the download threads.
+        :return: a tuple of the result and None
+        """
+        path = self.path(repo, num)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + '.part'
+        try:
+            with open(partial, 'wb') as out:
+                result = download(repo, num, out, retries)
+            if result == EXPORTED:
+                # Only complete files get the name the resumed export and the restore look for
+                os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        return result, None
+
+    def store(self, repo, num, data):
+        """
+        Nothing to do, the download threads wrote the file
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class ZipSnapshot(object):
+    """
+    A snapshot as a folder of compressed archives of part_size objects each.
+    The download threads spool the datastreams and the thread calling store()
+    writes them to the current archive, which is renamed once closed.
+    """
+
+    def __init__(self, destination):
+        """
+        :param destination: the folder of the archives, created if missing
+        """
+        self.destination = destination
+        os.makedirs(destination, exist_ok=True)
+        # The archives of an interrupted export are incomplete, their objects are downloaded again
+        for partial in glob.glob(os.path.join(destination, PART_PATTERN + '.part')):
+            os.remove(partial)
+        self.names = set()
+        self.parts = 0
+        for path in glob.glob(os.path.join(destination, PART_PATTERN)):
+            with zipfile.ZipFile(path) as archive:
+                self.names.update(os.path.basename(name) for name in archive.namelist())
+            self.parts = max(self.parts, int(os.path.basename(path)[len('mods-'):-len('.zip')]) + 1)
+        self.archive = None
+        self.path = None
+
+    def has(self, repo, num):
+        """
+        :return: whether one of the archives already has the object
+        """
+        return snapshot_name(repo, num) in self.names
+
+    def download(self, repo, num, retries):
+        """
+        Downloads the MODS of an object into a spooled temporary file. Called from the download threads.
+        :return: a tuple of the result and the file, to pass to store()
+        """
+        out = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        try:
+            result = download(repo, num, out, retries)
+        except Exception as e:
+            out.close()
+            raise
+        return result, out
+
+    def store(self, repo, num, data):
+        """
+        Writes a downloaded datastream to the current archive
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :param data: the file returned by download()
+        :return: None
+        """
+        if self.archive is None:
+            self.path = os.path.join(self.destination, 'mods-' + str(self.parts).zfill(5) + '.zip')
+            self.archive = zipfile.ZipFile(self.path + '.part', 'w', zipfile.ZIP_DEFLATED)
+        name = snapshot_name(repo, num)
+        data.seek(0)
+        with self.archive.open(repo + '/' + name, 'w') as entry:
+            shutil.copyfileobj(data, entry, chunk_size)
+        data.close()
+        self.names.add(name)
+        if len(self.archive.namelist()) >= part_size:
+            self.close()
+
+    def close(self):
+        """
+        Finishes the current archive, if any
+        :return: None
+        """
+        if self.archive is None:
+            return
+        self.archive.close()
+        os.replace(self.path + '.part', self.path)
+        self.archive = None
+        self.parts = self.parts + 1
+
+
+def open_snapshot(destination, compressed=False):
+    """
+    :param destination: the folder of the snapshot
+    :param compressed: whether the MODS go into archives rather than loose files
+    :return: the FolderSnapshot or ZipSnapshot
+    """
+    return ZipSnapshot(destination) if compressed else FolderSnapshot(destination)
+
+
+def export_all(objects, snapshot, threads=default_threads, retries=None, on_result=None):
+    """
+    Downloads the MODS of objects into a snapshot concurrently. At most a
+    couple of datastreams per thread wait to be stored, so memory stays bounded.
+    :param objects: an iterable of tuples starting with (repository, number)
+    :param snapshot: the FolderSnapshot or ZipSnapshot to export to
+    :param threads: the number of datastreams downloaded at once
+    :param retries: the RetryPolicy deciding whether errors are tried again, defaults to a new one
+    :param on_result: optional callback called with every object and its result e.g. EXPORTED
+    :return: a dict of the number of objects per result
+    """
+    retries = retries or RetryPolicy()
+    counts = collections.Counter()
+
+    def finish(obj, future):
+        repo, num = obj[0], obj[1]
+        try:
+            result, data = future.result()
+            if result == EXPORTED:
+                snapshot.store(repo, num, data)
+        except Exception as e:
+            print('Could not export ' + repo + ':' + num + ': ' + str(e))
+            result = FAILED
+        counts[result] += 1
+        if on_result is not None:
+            on_result(obj, result)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = collections.deque()
+        try:
+            for obj in objects:
+                if snapshot.has(obj[0], obj[1]):
+                    counts[SKIPPED] += 1
+                    if on_result is not None:
+                        on_result(obj, SKIPPED)
+                    continue
+                pending.append((obj, executor.submit(snapshot.download, obj[0], obj[1], retries)))
+                while len(pending) > 0 and (pending[0][1].done() or len(pending) >= threads * 2):
+                    finish(*pending.popleft())
+            while len(pending) > 0:
+                finish(*pending.popleft())
+        finally:
+            snapshot.close()
+    return counts
+
+
+def restore_folder(source, extract_to):
+    """
+    :param source: the folder of a snapshot
+    :param extract_to: the folder to extract archives written with --zip to
+    :return: the folder of MODS XML files to upload to restore the snapshot
+    """
+    parts = sorted(glob.glob(os.path.join(source, PART_PATTERN)))
+    if len(parts) == 0:
+        return source
+    for path in parts:
+        with zipfile.ZipFile(path) as archive:
+            archive.extractall(extract_to)
+    return extract_to
+
+
+def export(args):
+    """
+    Exports the MODS of the objects of a folder
+    :param args: the parsed command line arguments
+    :return: the exit code
+    """
+    password = args.password or os.environ.get('DOH_PASSWORD') or getpass.getpass()
+    upload_core.base_url = args.base_url.rstrip('/')
+    # Signs in while the folder is scanned
+    signing_in = session_manager.start_sign_in(args.username, password, args.sessions)
+    objects = iter(scan_objects(args.folder, args.scan_threads))
+    first = next(objects, None)
+    if not signing_in.result():
+        print(session_manager.failure_message())
+        return 1
+    if first is None:
+        print('No MODS XML files found in ' + args.folder)
+        return 1
+    objects = itertools.chain([first], objects)
+    snapshot = open_snapshot(args.destination, args.zip)
+    start = time.monotonic()
+    if args.report:
+        with open(args.report, 'w', newline='') as f:
+            report = csv.writer(f)
+            report.writerow(['repository', 'number', 'result'])
+            counts = export_all(objects, snapshot, args.threads, RetryPolicy(args.retries),
+                                on_result=lambda obj, result: report.writerow([obj[0], obj[1], result]))
+    else:
+        counts = export_all(objects, snapshot, args.threads, RetryPolicy(args.retries))
+    elapsed = time.monotonic() - start
+    print('Exported ' + str(counts[EXPORTED]) + ' objects to ' + args.destination + ' in ' +
+          format(elapsed, '.1f') + ' s (' + format(counts[EXPORTED] / max(elapsed, 0.001), '.0f') + ' objects/s), ' +
+          str(counts[SKIPPED]) + ' already there, ' + str(counts[MISSING]) + ' without MODS, ' +
+          str(counts[FAILED]) + ' failed.')
+    return 0 if counts[FAILED] == 0 else 1
+
+
+def restore(args):
+    """
+    Uploads a snapshot back to the website with uploader_cli.py, every object
+    of it, even if the journal says that version was already uploaded, as
+    what replaced it may have been uploaded without the journal
+    :param args: the parsed command line arguments
+    :return: the exit code of uploader_cli.py
+    """
+    extract_to = tempfile.mkdtemp(prefix='doh-restore-')
+    try:
+        folder = restore_folder(args.source, extract_to)
+        return uploader_cli.main([folder, '--redo'] + args.options)
+    finally:
+        shutil.rmtree(extract_to, ignore_errors=True)
+
+
+def parse_args(argv):
+    """
+    Parses the command line arguments
+    :param argv: the arguments without the program name
+    :return: the parsed arguments namespace
+    """
+    parser = argparse.ArgumentParser(description='Backs up the MODS the DOH Arca website has before a batch '
+                                                 'replaces them, and restores them.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    exporting = commands.add_parser('export', help='download the MODS of the objects of a folder')
+    exporting.add_argument('folder', help='the folder to search recursively for <repository>_<number>.xml files')
+    exporting.add_argument('destination', help='the folder to write the snapshot to, an interrupted '
+                                               'export is resumed by giving the same folder')
+    exporting.add_argument('-u', '--username', required=True, help='the username to sign in with')
+    exporting.add_argument('-p', '--password',
+                           help='the password (default: the DOH_PASSWORD environment variable, or a prompt)')
+    exporting.add_argument('--zip', action='store_true',
+                           help='write compressed archives of ' + str(part_size) + ' objects instead of files')
+    exporting.add_argument('-t', '--threads', type=int, default=default_threads,
+                           help='the number of datastreams downloaded at once (default: %(default)s)')
+    exporting.add_argument('--sessions', type=int, default=4,
+                           help='the number of signed in sessions the downloads are spread over (default: %(default)s)')
+    exporting.add_argument('--retries', type=int, default=None,
+                           help='the max number of retries of an object after server or network errors')
+    exporting.add_argument('--scan-threads', type=int, default=upload_core.scan_threads,
+                           help='the number of directories listed at once (default: %(default)s)')
+    exporting.add_argument('--base-url', default=upload_core.base_url,
+                           help='the address of the website (default: %(default)s)')
+    exporting.add_argument('-o', '--report', help='write the result of every object to this CSV file')
+    ratelimit.add_arguments(exporting)
+    exporting.set_defaults(run=export)
+
+    restoring = commands.add_parser('restore', help='upload a snapshot back to the website',
+                                    description='Uploads a snapshot with uploader_cli.py, the options '
+                                                'after the source are passed on to it.')
+    restoring.add_argument('source', help='the folder of the snapshot')
+    restoring.add_argument('options', nargs=argparse.REMAINDER,
+                           help='the options of uploader_cli.py e.g. -u "Jane Doe" -e async')
+    restoring.set_defaults(run=restore)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Entry point of the snapshot tool
+    :param argv: the arguments without the program name, defaults to sys.argv
+    :return: the exit code
+    """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'export':
+        error = 'The number of threads must be at least 1' if args.threads < 1 else ratelimit.check_arguments(args)
+        if error is not None:
+            print(error)
+            return 2
+        ratelimit.configure(args.rate, args.burst, args.rate_file)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    # Lets the validation processes of a restore start in a frozen executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
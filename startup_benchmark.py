@@ -0,0 +1,131 @@
+"""
+Benchmark of the time the desktop application takes from being started
+to showing its window, to be run on every release so a slower cold
+start is noticed. The program, Uploader.py or the executable built with
+Uploader.spec, is started several times with the environment variable
+of Uploader.STARTUP_BENCHMARK_VARIABLE set, which makes it print when
+its window is shown and quit. The first start is reported on its own,
+as it is the one paying for files not yet in the disk cache.
+For Uploader.py the slowest modules imported before the window is
+shown are listed as well (python -X importtime), as a module imported
+too early is what usually makes the start slower.
+
+Example:
+    python startup_benchmark.py --runs 10
+    python startup_benchmark.py --exe dist/Uploader.exe --release 1.4.0 --history startup.csv
+"""
+import argparse
+import csv
+import datetime
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# The same as Uploader.STARTUP_BENCHMARK_VARIABLE, not imported from there so PyQt5 is not loaded in this process
+STARTUP_BENCHMARK_VARIABLE = 'DOH_UPLOADER_STARTUP_BENCHMARK'
+# The program measured by default
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Uploader.py')
+
+
+def time_to_window(command, timeout):
+    """
+    Starts the program once and waits for it to show its window and quit
+    :param command: the command starting the program, as a list
+    :param timeout: how long to wait for the window, in seconds
+    :return: the time from starting the program to its window being shown, in seconds
+    :raises RuntimeError: if the program quit without saying it was shown
+    """
+    environment = dict(os.environ)
+    environment[STARTUP_BENCHMARK_VARIABLE] = '1'
+    started = time.time()
+    output = subprocess.run(command, env=environment, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            timeout=timeout).stdout.decode('utf-8', 'replace')
+    for line in output.splitlines():
+        if line.startswith('shown '):
+            return float(line.split()[1]) - started
+    raise RuntimeError(' '.join(command) + ' quit without showing its window')
+
+
+def slowest_imports(script, count):
+    """
+    Lists the modules the script imports that take the longest, with their own imports
+    :param script: the path of the Python script
+    :param count: the number of modules to list
+    :return: a list of (module, seconds) tuples, the slowest first
+    """
+    directory, name = os.path.split(script)
+    command = [sys.executable, '-X', 'importtime', '-c', 'import ' + os.path.splitext(name)[0]]
+    output = subprocess.run(command, cwd=directory or None, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE).stderr.decode('utf-8', 'replace')
+    modules = []
+    for line in output.splitlines():
+        # e.g. "import time:       559 |      68472 |     page_parser", nested imports are indented further
+        parts = line.split('|')
+        if not line.startswith('import time:') or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        # Only the modules imported by the script itself, the others are counted in them
+        if len(parts[2]) - len(parts[2].lstrip()) == 3:
+            modules.append((parts[2].strip(), int(parts[1]) / 1000000.0))
+    modules.sort(key=lambda module: module[1], reverse=True)
+    return modules[:count]
+
+
+def record(history, release, command, first, times):
+    """
+    Appends the results to a CSV file of the results of every release
+    :param history: the path of the CSV file, created if missing
+    :param release: the version of the program measured
+    :param command: the command starting the program, as a list
+    :param first: the time to the window of the first start, in seconds
+    :param times: the times to the window of the other starts, in seconds
+    :return: None
+    """
+    new = not os.path.exists(history)
+    with open(history, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(['date', 'release', 'command', 'runs', 'first_s', 'median_s', 'min_s'])
+        writer.writerow([datetime.date.today().isoformat(), release, ' '.join(command), len(times) + 1,
+                         format(first, '.3f'), format(statistics.median(times), '.3f'), format(min(times), '.3f')])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measures the time the desktop application takes to show its window.')
+    parser.add_argument('--exe', help='the executable built with Uploader.spec (default: python Uploader.py)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='the number of times the program is started (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='how long to wait for the window, in seconds (default: %(default)s)')
+    parser.add_argument('--imports', type=int, default=10,
+                        help='the number of slowest imports listed, for Uploader.py (default: %(default)s)')
+    parser.add_argument('--release', default='', help='the version of the program, recorded with --history')
+    parser.add_argument('--history', help='path of a CSV file the results are appended to')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.runs < 2:
+        print('The number of runs must be at least 2')
+        return 2
+    command = [os.path.abspath(args.exe)] if args.exe else [sys.executable, SCRIPT]
+    try:
+        times = [time_to_window(command, args.timeout) for i in range(args.runs)]
+    except (RuntimeError, subprocess.TimeoutExpired) as e:
+        print('Could not measure the start: ' + str(e))
+        return 1
+    first = times.pop(0)
+    print('Time to the first window of ' + ' '.join(command) + ':')
+    print('{:<10} {:>8.3f} s'.format('first', first))
+    print('{:<10} {:>8.3f} s'.format('median', statistics.median(times)))
+    print('{:<10} {:>8.3f} s'.format('min', min(times)))
+    print('{:<10} {:>8.3f} s'.format('max', max(times)))
+    if not args.exe and args.imports > 0:
+        print('Slowest imports:')
+        for module, seconds in slowest_imports(SCRIPT, args.imports):
+            print('  {:<30} {:>8.1f} ms'.format(module, seconds * 1000))
+    if args.history:
+        record(args.history, args.release, command, first, times)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Checks which backend the rest backend ends up using for every object,
+against the stand-in website of mock_islandora.py, with either engine:
+python -m pytest test_backends.py
+"""
+import time
+
+import pytest
+
+import async_engine
+import backends
+import sessions
+import upload_core
+from concurrency import AdaptiveLimit
+from mock_islandora import MockIslandora
+
+MODS = '<?xml version="1.0" encoding="UTF-8"?>\n<mods><titleInfo><title>{}</title></titleInfo></mods>\n'
+
+OBJECTS = 3
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    """
+    :return: a function starting a MockIslandora with the given options, uploading
+    the objects to it with the rest backend and the given engine, and returning the
+    website and the (pid, transaction class name, success) of every attempt in order
+    """
+    websites = []
+    monkeypatch.setattr(backends, 'backend', backends.REST)
+    monkeypatch.setattr(backends, 'instances', {})
+    monkeypatch.setattr(sessions, 'reauth_interval', 0.0)
+    monkeypatch.setattr(upload_core, 'session_manager', sessions.SessionManager(upload_core.login))
+    files = []
+    for number in range(1, OBJECTS + 1):
+        path = tmp_path / ('doh_' + str(number) + '.xml')
+        path.write_text(MODS.format(number))
+        files.append(('doh', str(number), str(path)))
+    attempts = []
+
+    def record(pid, result):
+        transaction, success = result
+        attempts.append((pid, type(transaction).__name__, success))
+        return result
+
+    transact = upload_core.transact
+    monkeypatch.setattr(upload_core, 'transact', lambda file, repo, num, *args:
+                        record(repo + ':' + num, transact(file, repo, num, *args)))
+    transact_async = async_engine.AsyncUploader.transact
+
+    async def recorded(uploader, file, repo, num):
+        return record(repo + ':' + num, await transact_async(uploader, file, repo, num))
+
+    monkeypatch.setattr(async_engine.AsyncUploader, 'transact', recorded)
+
+    def run(engine, expire=False, **options):
+        website = MockIslandora(**options).start()
+        websites.append(website)
+        monkeypatch.setattr(upload_core, 'base_url', website.url)
+        assert upload_core.session_manager.sign_in('admin', 'secret', 1)
+        if expire:
+            time.sleep(website.session_lifetime + 0.1)
+        if engine == 'threads':
+            outcomes = [upload_core.upload_object(path, repo, num) for repo, num, path in files]
+        else:
+            outcomes = []
+            # One object at a time like the threads engine here, so the attempts are in order
+            failed = async_engine.run([(repo + ':' + num, repo, num, path) for repo, num, path in files],
+                                      'admin', 'secret', AdaptiveLimit(1, maximum=1, adaptive=False),
+                                      on_result=lambda key, outcome: outcomes.append(outcome),
+                                      cookies=upload_core.session_manager.session().cookies)
+            assert failed == 0
+        assert outcomes == [upload_core.UPLOADED] * OBJECTS
+        assert sorted(website.mods) == sorted(repo + ':' + num for repo, num, path in files)
+        return website, attempts
+
+    yield run
+    for website in websites:
+        website.stop()
+
+
+ENGINES = ['threads', 'async']
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_rest(uploads, engine):
+    website, attempts = uploads(engine)
+    assert [name for pid, name, success in attempts] == ['RestTransaction'] * OBJECTS
+    assert backends.current().available is True
+    assert website.locks == {}
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_no_lock_endpoint(uploads, engine):
+    website, attempts = uploads(engine, rest_lock=False)
+    assert [name for pid, name, success in attempts] == ['UploadTransaction'
+                                                         if engine == 'threads' else 'AsyncTransaction'] * OBJECTS
+    assert backends.current().available is False
+    assert website.locks == {}
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_expired_session(uploads, engine):
+    # The API turns the first object down with a 401 as the session expired,
+    # which is signed in again and uploaded through the API like the others
+    website, attempts = uploads(engine, expire=True, session_lifetime=0.5)
+    scraped = 'UploadTransaction' if engine == 'threads' else 'AsyncTransaction'
+    assert attempts[0] == ('doh:1', scraped, False)
+    assert [name for pid, name, success in attempts[1:]] == ['RestTransaction'] * OBJECTS
+    assert backends.current().available is True
+    assert website.stats()['sign_ins'] == 2
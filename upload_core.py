@@ -0,0 +1,704 @@
+"""
+The upload logic shared by the GUI (Uploader.py) and the
+command line tool (uploader_cli.py). Nothing in here may
+import PyQt5 so that it can run on a headless machine.
+"""
+import fnmatch
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from metrics import timings
+from page_parser import parse_page
+import sessions
+from sessions import SessionManager, SignInError
+
+"""
+The number of concurrent uploads to start with. While running,
+concurrency.AdaptiveLimit grows or shrinks it between 1 and
+max_concurrency depending on how quickly the website answers.
+"""
+initial_concurrency = 10
+max_concurrency = 32
+# The same for the asyncio engine, where objects in flight are cheap
+async_initial_concurrency = 50
+async_max_concurrency = 500
+
+"""
+Program logic
+"""
+# The base URL of the DOH Arca website
+base_url = 'https://doh.arcabc.ca'
+# The number of directories listed at once when scanning a folder
+scan_threads = 8
+# Files up to this many bytes are read whole and closed before they are sent, larger
+# ones are sent straight from the file, see UploadFile
+stream_threshold = 1024 * 1024
+# The number of bytes of a large file read at a time while it is sent
+stream_block_size = 64 * 1024
+
+"""
+The outcomes of an upload attempt, see retry.py
+"""
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+# A server error or a network problem, worth trying again later
+TRANSIENT = 'transient'
+# Someone else holds the lock of the object
+LOCKED = 'locked'
+# The upload was cancelled before the MODS was replaced, the lock if taken was released
+CANCELLED = 'cancelled'
+
+
+def login(username, password):
+    """
+    Signs into the DOH website with a new browser
+    :param username: the username to login with
+    :param password: the password to login with
+    :return: the signed in requests.Session, or None if the username or password is wrong
+    :raises SignInError: if the website could not be reached, answered with an error or without the login form
+    """
+    # Imported on first use, requests and robobrowser take a while to load and the GUI does not need them to start
+    import requests
+    from robobrowser import RoboBrowser
+    import ratelimit
+
+    def landed(url, *args, **kwargs):
+        try:
+            browser.open(url, *args, **kwargs)
+        except requests.RequestException as e:
+            raise SignInError('could not reach ' + url + ': ' + str(e))
+        status = browser.response.status_code
+        # A wrong password is answered with the login form again, not with an error
+        if status >= 400:
+            raise SignInError('the website answered ' + str(status) + ' to ' + url)
+        return parse_page(browser.response.text, browser.url)
+
+    with timings.time('sign_in'):
+        # Create Non-JS browser
+        browser = RoboBrowser(parser='html.parser')
+        # Every request of the session, signing in included, waits for the rate limit
+        ratelimit.mount(browser.session)
+        # Open login page and get the login form
+        form = landed(base_url + '/user/login').form(id='user-login')
+        if form is None:
+            raise SignInError('there is no login form at ' + base_url + '/user/login')
+        # Set the username & password and submit the form
+        fields = [(name, value) for name, value in form.fields('op') if name not in ('name', 'pass')]
+        page = landed(form.action, form.method, data=fields + [('name', username), ('pass', password)])
+        # If successfully signed in
+        if page.title == username:
+            return browser.session
+        return None
+
+
+"""
+The signed in sessions shared by every upload, see sign_in()
+"""
+session_manager = SessionManager(login)
+
+
+def sign_in(username, password, size=None):
+    """
+    Signs into the DOH website, unless already signed in with the same
+    username and password, so that every upload can share the session
+    :param username: the username to login with
+    :param password: the password to login with
+    :param size: the number of sessions the uploads are spread over, defaults to sessions.pool_size
+    :return: a boolean indicating if the sign in was successful
+    """
+    return session_manager.sign_in(username, password, size)
+
+
+def is_signed_out(page, status):
+    """
+    Whether the website answered as it does to someone who is not
+    signed in, e.g. after the session expired
+    :param page: the page_parser.Page it answered with
+    :param status: the HTTP status code of the answer
+    :return: True if access was denied or the page is the login form
+    """
+    return status == 403 or page.form(id='user-login') is not None
+
+
+def get_lock_link(page):
+    """
+    Gets the link that allows to lock a
+    collection object in order to modify it
+    :param page: the page_parser.Page the browser is on
+    :return: the href of the correct link to acquire the lock
+    """
+    return page.link('acquire the lock')
+
+
+def get_unlock_link(page):
+    """
+    Gets the link that allows to unlock a
+    collection object in order to let others to modify it again
+    :param page: the page_parser.Page the browser is on
+    :return: the href of the correct link to release the lock
+    """
+    return page.link('release')
+
+
+class PhaseCounter(object):
+    """
+    Thread safe count of the HTTP requests made in each phase
+    of the upload transactions, used to measure how many round
+    trips an object costs
+    """
+    PHASES = ('lock', 'replace', 'unlock')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Zeroes all the counts
+        :return: None
+        """
+        with self.lock:
+            self.requests = dict.fromkeys(PhaseCounter.PHASES, 0)
+            self.objects = 0
+
+    def add(self, phase, count=1):
+        """
+        Records requests made in a phase
+        :param phase: one of PhaseCounter.PHASES
+        :param count: the number of requests made
+        :return: None
+        """
+        with self.lock:
+            self.requests[phase] = self.requests[phase] + count
+
+    def add_object(self):
+        """
+        Records that one more object went through a transaction
+        :return: None
+        """
+        with self.lock:
+            self.objects = self.objects + 1
+
+    def summary(self):
+        """
+        :return: a human readable average of requests per object per phase
+        """
+        with self.lock:
+            objects = max(self.objects, 1)
+            parts = [phase + ' ' + format(self.requests[phase] / objects, '.1f') for phase in PhaseCounter.PHASES]
+            total = sum(self.requests.values()) / objects
+        return 'Requests per object: ' + ', '.join(parts) + ' (total ' + format(total, '.1f') + ')'
+
+
+"""
+Counts of the requests made by every transaction
+"""
+request_counts = PhaseCounter()
+
+
+class MultipartBody(object):
+    """
+    A multipart/form-data request body of form fields and one file, which
+    requests reads block by block, the file part straight from the file.
+    It has a length, so it is sent with a Content-Length like the bodies
+    requests builds itself rather than in chunks.
+    """
+
+    def __init__(self, fields, name, filename, file, size, content_type):
+        """
+        :param fields: a list of (name, value) tuples of the form fields
+        :param name: the name of the file field
+        :param filename: the file name sent with the file
+        :param file: the file, open for reading in binary mode
+        :param size: the number of bytes of the file to send
+        :param content_type: the content type sent with the file
+        """
+        boundary = os.urandom(16).hex()
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        head = b''
+        for field, value in fields:
+            head = head + ('--' + boundary + '\r\nContent-Disposition: form-data; name="' + field +
+                           '"\r\n\r\n').encode('utf-8') + str(value).encode('utf-8') + b'\r\n'
+        head = head + ('--' + boundary + '\r\nContent-Disposition: form-data; name="' + name + '"; filename="' +
+                       filename + '"\r\nContent-Type: ' + content_type + '\r\n\r\n').encode('utf-8')
+        self.head = io.BytesIO(head)
+        self.file = file
+        self.remaining = size
+        self.tail = io.BytesIO(('\r\n--' + boundary + '--\r\n').encode('utf-8'))
+        self.length = len(head) + size + len(self.tail.getvalue())
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            block = self.read(stream_block_size)
+            if len(block) == 0:
+                return
+            yield block
+
+    def read(self, size=-1):
+        """
+        :param size: the max number of bytes to read, -1 for a block
+        :return: the next bytes of the body, empty at the end
+        :raises IOError: if the file got shorter since it was opened
+        """
+        if size is None or size < 0:
+            size = stream_block_size
+        block = self.head.read(size)
+        if len(block) > 0:
+            return block
+        if self.remaining > 0:
+            block = self.file.read(min(size, self.remaining))
+            if len(block) == 0:
+                raise IOError('The file ' + self.file.name + ' got shorter while it was sent')
+            self.remaining = self.remaining - len(block)
+            return block
+        return self.tail.read(size)
+
+
+class UploadFile(object):
+    """
+    The MODS XML file of an object, read as raw bytes for an upload. Used
+    in a with block: files up to stream_threshold bytes are read whole and
+    closed at once, so most uploads hold no file open while they wait for
+    the website. Larger files are sent straight from the file, so the memory
+    used does not grow with them, and stay open until the with block ends,
+    whatever happens in it. An upload in flight holds at most one file open
+    this way, so the number of files open is capped at the concurrency.
+    """
+
+    def __init__(self, path, content_type='application/xml'):
+        """
+        :param path: the path of the file
+        :param content_type: the content type sent with the file
+        """
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.content_type = content_type
+        # The bytes of a small file, or the open file of a large one
+        self.contents = None
+        self.file = None
+        self.size = 0
+
+    def __enter__(self):
+        with timings.time('file_read'):
+            f = open(self.path, 'rb')
+            try:
+                self.size = os.fstat(f.fileno()).st_size
+                if self.size <= stream_threshold:
+                    self.contents = f.read()
+                else:
+                    self.file, f = f, None
+            finally:
+                if f is not None:
+                    f.close()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def request_arguments(self, fields, name):
+        """
+        The arguments of a requests call posting the file with form fields
+        :param fields: a list of (name, value) tuples of the form fields
+        :param name: the name of the file field
+        :return: a dict of the keyword arguments
+        """
+        if self.file is None:
+            return {'data': fields, 'files': {name: (self.filename, self.contents, self.content_type)}}
+        body = MultipartBody(fields, name, self.filename, self.file, self.size, self.content_type)
+        return {'data': body, 'headers': {'Content-Type': body.content_type}}
+
+    def payload(self):
+        """
+        :return: what to give aiohttp as the value of the file field, the bytes of a small
+        file or the open file of a large one, which aiohttp reads block by block
+        """
+        return self.contents if self.file is None else self.file
+
+
+class UploadTransaction(object):
+    """
+    The lock -> replace -> unlock sequence for a single object.
+    Every page the browser lands on is checked for what the next
+    step needs before fetching it again, e.g. the lock confirmation
+    redirects back to the replace page so its form is reused, and the
+    page after the replace usually holds the release link.
+    An object that is free takes 6 requests: the replace page, the lock
+    confirmation page and its submit, the replace submit, the release
+    confirmation page and its submit. One already locked by the user,
+    e.g. left over from an interrupted run, skips the lock confirmation,
+    4 requests, and one locked by someone else stops after the replace
+    page. The replace page is only fetched again if the lock confirmation
+    or the replace did not land on it.
+    RoboBrowser only makes the requests, the pages are read with
+    page_parser rather than by its BeautifulSoup tree.
+    """
+
+    def __init__(self, browser, repo, num, counter=None):
+        """
+        :param browser: the RoboBrowser sharing the signed in session
+        :param repo: the repository namespace of the object
+        :param num: the number of the object
+        :param counter: the PhaseCounter to record requests in, defaults to request_counts
+        """
+        self.browser = browser
+        self.manage_url = base_url + '/islandora/object/' + repo + '%3A' + num + '/datastream/MODS/replace'
+        self.counter = counter or request_counts
+        self.counter.add_object()
+        # The page_parser.Page the browser currently shows
+        self.page = None
+        # What went wrong, reported to the concurrency controller
+        self.server_error = False
+        self.lock_failed = False
+        # and used to decide whether to retry
+        self.network_error = False
+        self.locked_by_other = False
+        # Whether the website answered as to someone not signed in
+        self.signed_out = False
+        # Whether the upload was cancelled once the lock was acquired
+        self.cancelled = False
+
+    def check_response(self):
+        """
+        Raises if the website answered with a server error
+        :return: None
+        """
+        status = self.browser.response.status_code
+        if status >= 500:
+            self.server_error = True
+            raise IOError('Server error ' + str(status) + ' from ' + self.browser.url)
+
+    def open(self, phase, url, method='get', **kwargs):
+        """
+        Opens a page, recording the request against the phase
+        :param phase: one of PhaseCounter.PHASES
+        :param url: the url to open
+        :param method: the HTTP method
+        :param kwargs: passed on to requests e.g. data and files
+        :return: None
+        """
+        import requests
+        try:
+            self.browser.open(url, method, **kwargs)
+        except requests.RequestException as e:
+            self.network_error = True
+            raise
+        self.counter.add(phase)
+        self.check_response()
+        with timings.time('html_parse'):
+            self.page = parse_page(self.browser.response.text, self.browser.url)
+        if is_signed_out(self.page, self.browser.response.status_code):
+            self.signed_out = True
+            raise IOError('Signed out of the website at ' + self.browser.url)
+
+    def submit(self, phase, form, submit=None, upload=None):
+        """
+        Submits a form, recording the request against the phase
+        :param phase: one of PhaseCounter.PHASES
+        :param form: the page_parser.Form to submit
+        :param submit: the name of the submit button to click, if any
+        :param upload: a tuple of the name of the file field to fill and the UploadFile to fill it with
+        :return: None
+        """
+        fields = form.fields(submit)
+        if form.method == 'get':
+            self.open(phase, form.action, params=fields)
+        elif upload is not None:
+            self.open(phase, form.action, form.method, **upload[1].request_arguments(fields, upload[0]))
+        else:
+            self.open(phase, form.action, form.method, data=fields)
+
+    def replace_form(self):
+        """
+        :return: the replace form of the current page, or None if it is not there
+        """
+        if self.page is None:
+            return None
+        return self.page.form(id='islandora-datastream-version-replace-form')
+
+    def acquire_lock(self):
+        """
+        Acquires the lock of the object in order to modify it
+        :return: a boolean indicating if the acquisition was successful
+        """
+        try:
+            self.open('lock', self.manage_url)
+            # Already locked by us, e.g. left over from an interrupted run
+            if self.replace_form() is not None:
+                return True
+            lock_link = get_lock_link(self.page)
+            if lock_link is not None:
+                # Open the link to lock
+                self.open('lock', base_url + lock_link)
+                # Find the form by class and submit it
+                self.submit('lock', self.page.form(class_='confirmation'))
+                # Success
+                return True
+            # Failed to acquire lock because someone else
+            # has locked this object
+            else:
+                self.lock_failed = True
+                self.locked_by_other = True
+                return False
+        # Any error indicates failure
+        except Exception as e:
+            self.lock_failed = True
+            return False
+
+    def replace(self, file):
+        """
+        Replaces the MODS datastream with the file. The lock must be held.
+        :param file: the path of the MODS XML file
+        :return: None
+        """
+        # The lock confirmation normally redirects back to the replace page
+        form = self.replace_form()
+        if form is None:
+            with timings.time('replace_page'):
+                self.open('replace', self.manage_url)
+                form = self.replace_form()
+        with UploadFile(file) as upload:
+            with timings.time('replace_submit'):
+                self.submit('replace', form, submit='op', upload=('files[file]', upload))
+
+    def release_lock(self):
+        """
+        Releases the lock of the object in order to let others modify it.
+        """
+        try:
+            # The page after the replace normally shows the release link
+            unlock_link = get_unlock_link(self.page) if self.page is not None else None
+            if unlock_link is None:
+                self.open('unlock', self.manage_url)
+                unlock_link = get_unlock_link(self.page)
+            # if unlock_link is None, then
+            # the object is not locked anyways
+            if unlock_link is not None:
+                self.open('unlock', base_url + unlock_link)
+                self.submit('unlock', self.page.form(class_='confirmation'))
+        # No return for this as we don't really care
+        # if we released the lock since it automatically
+        # releases in 30 minutes.
+        except Exception as e:
+            pass
+
+
+def outcome_of(transaction, success):
+    """
+    :param transaction: an UploadTransaction, async_engine.AsyncTransaction or backends.Transaction that finished
+    :param success: whether the MODS was replaced
+    :return: the outcome of the attempt, UPLOADED, FAILED, TRANSIENT, LOCKED or CANCELLED
+    """
+    if success:
+        return UPLOADED
+    if transaction.cancelled:
+        return CANCELLED
+    if transaction.locked_by_other:
+        return LOCKED
+    if transaction.server_error or transaction.network_error:
+        return TRANSIENT
+    return FAILED
+
+
+def upload_xml(file, repo, num, controller=None):
+    """
+    Uploads the MODS XML file to the appropriate object given the
+    repository namespace and number of the specific object.
+    :param file: the path of the MODS XML file to reingest
+    :param repo: the repository namespace derived from the file name
+    :param num: the number of the object derived from the file name
+    :param controller: an optional concurrency.AdaptiveLimit to report the
+    latency and errors of the object to
+    :return: a boolean indicating if the upload was successful
+    """
+    return upload_object(file, repo, num, controller) == UPLOADED
+
+
+def upload_object(file, repo, num, controller=None, cancel=None):
+    """
+    Makes one attempt at uploading the MODS XML file, see upload_xml. The
+    attempt is started over once if the session turns out to have expired.
+    :param file: the path of the MODS XML file to reingest
+    :param repo: the repository namespace derived from the file name
+    :param num: the number of the object derived from the file name
+    :param controller: an optional concurrency.AdaptiveLimit to report the
+    latency and errors of the object to
+    :param cancel: an optional threading.Event set to cancel the upload session,
+    the object is then not started or, if it is locked but not yet replaced, its
+    lock is released without replacing it
+    :return: the outcome of the attempt, UPLOADED, FAILED, TRANSIENT, LOCKED or CANCELLED
+    """
+    if cancel is not None and cancel.is_set():
+        return CANCELLED
+    start = time.monotonic()
+    pooled = session_manager.acquire()
+    if pooled is None:
+        print('Failed to update object: ' + file + ' as the website is not signed in to.')
+        return FAILED
+    session, generation = pooled.current()
+    transaction, success = transact(file, repo, num, session, cancel)
+    # Signed out e.g. as the session expired: sign in again, once
+    # for all the uploads that found out, and start over
+    if transaction.signed_out:
+        reauthenticated = session_manager.reauthenticate(pooled, generation)
+        if reauthenticated == sessions.RETRY:
+            transaction, success = transact(file, repo, num, pooled.current()[0], cancel)
+        elif reauthenticated == sessions.UNAVAILABLE:
+            # Retried later, like a server error
+            transaction.network_error = True
+
+    latency = time.monotonic() - start
+    timings.observe('object', latency)
+    if controller is not None:
+        controller.record(latency, transaction.server_error, transaction.lock_failed)
+    return outcome_of(transaction, success)
+
+
+def transact(file, repo, num, session, cancel=None):
+    """
+    Replaces the MODS of an object once with the selected backend, see backends.py
+    :param file: the path of the MODS XML file to reingest
+    :param repo: the repository namespace derived from the file name
+    :param num: the number of the object derived from the file name
+    :param session: the signed in requests.Session to use
+    :param cancel: an optional threading.Event, if set before the MODS is
+    replaced the object is left as it is
+    :return: a tuple of the transaction, see outcome_of, and whether the MODS was replaced
+    """
+    # Imported here as the backends build on this module
+    import backends
+    return backends.current().transact(file, repo, num, session, cancel)
+
+
+def scrape(file, repo, num, session, cancel=None):
+    """
+    Runs the lock -> replace -> unlock transaction of an object once
+    through the pages of the website, the scraping backend
+    :param file: the path of the MODS XML file to reingest
+    :param repo: the repository namespace derived from the file name
+    :param num: the number of the object derived from the file name
+    :param session: the signed in requests.Session to use
+    :param cancel: an optional threading.Event, if set once the lock is
+    acquired the lock is released without replacing the MODS
+    :return: a tuple of the UploadTransaction and whether the MODS was replaced
+    """
+    from robobrowser import RoboBrowser
+    # Create a new browser instance
+    browser = RoboBrowser(session=session, parser='html.parser')
+    transaction = UploadTransaction(browser, repo, num)
+    success = False
+    try:
+        # Acquire the lock for the object
+        with timings.time('lock'):
+            locked = transaction.acquire_lock()
+        if locked and cancel is not None and cancel.is_set():
+            transaction.cancelled = True
+            with timings.time('unlock'):
+                transaction.release_lock()
+        elif locked:
+            transaction.replace(file)
+            with timings.time('unlock'):
+                transaction.release_lock()
+            # Success
+            success = True
+        elif transaction.signed_out:
+            print('Failed to update object: ' + file + ' as the website signed us out.')
+        else:
+            print('Failed to update object: ' + file + ' as the lock could not be acquired.')
+    except Exception as e:
+        print('Failed to update object: ' + file)
+        # Release the lock
+        with timings.time('unlock'):
+            transaction.release_lock()
+    return transaction, success
+
+
+def scan_directory(directory):
+    """
+    Lists one directory without descending into it
+    :param directory: the path of the directory
+    :return: a tuple of the list of XML file paths and the list of subdirectory paths in it
+    """
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # Hidden entries are skipped like glob does
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    subdirectories.append(entry.path)
+                elif fnmatch.fnmatch(entry.name, '*.xml'):
+                    files.append(entry.path)
+    except OSError as e:
+        print('Could not read ' + directory + ': ' + str(e))
+    return files, subdirectories
+
+
+def find_xml_files(folder, threads=1):
+    """
+    Finds all XML files in a folder recursively with os.scandir, yielding
+    each one as soon as it is found so that the caller can start working
+    before the scan finishes.
+    :param folder: the root folder to search
+    :param threads: the number of directories listed at once, more than 1
+    helps on network shares where every listing is a round trip
+    :return: an iterator over the paths of the XML files
+    """
+    folder = folder.replace("/", os.sep)
+    if threads <= 1:
+        directories = [folder]
+        while len(directories) > 0:
+            files, subdirectories = scan_directory(directories.pop())
+            yield from files
+            directories.extend(reversed(subdirectories))
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(scan_directory, folder)}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirectories = future.result()
+                pending.update(executor.submit(scan_directory, subdirectory) for subdirectory in subdirectories)
+                yield from files
+
+
+def scan_objects(folder, threads=1):
+    """
+    Finds all the objects to upload in a folder, see find_xml_files
+    :param folder: the root folder to search
+    :param threads: the number of directories listed at once
+    :return: an iterator over (repository, number, path) tuples. Files
+    not named <repository>_<number>.xml are skipped.
+    """
+    for filename in find_xml_files(folder, threads):
+        try:
+            repository, number = parse_object_id(filename)
+        except Exception as e:
+            print('Skipping ' + filename + ' as its name is not <repository>_<number>.xml')
+            continue
+        yield repository, number, filename
+
+
+def parse_object_id(filename):
+    """
+    Parses the repository namespace and object number out of a
+    file name of the form <repository>_<number>.xml
+    :param filename: the path of the MODS XML file
+    :return: a tuple of the repository and number as strings
+    :raises IndexError: if the file name does not follow the convention
+    """
+    fnms = filename.split(os.sep)
+    objIDpts = fnms[-1].split("_")
+    repository = objIDpts[0]
+    number = objIDpts[1].split(".")[0]
+    return repository, number
@@ -0,0 +1,451 @@
+"""
+Command line version of the uploader for running large
+reingests on a headless machine (e.g. from cron).
+Shares all of its upload logic with the GUI through upload_core.py
+and never imports PyQt5.
+
+Example:
+    python uploader_cli.py /data/UpdatedXML -u "Jane Doe" -t 10 -o report.csv
+    python uploader_cli.py /data/UpdatedXML -u "Jane Doe" -e async -t 200
+"""
+import argparse
+import csv
+import getpass
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import backends
+import journal
+import ratelimit
+import retry
+import sessions
+import upload_core
+import validation
+from change_detection import ChangeDetector, find_changed
+from concurrency import AdaptiveLimit
+from journal import Journal, file_hash
+from metrics import timings
+from retry import RetryPolicy, RetryScheduler
+from upload_core import session_manager, upload_object, scan_objects
+from validation import load_schema, validate_all
+
+
+def parse_args(argv):
+    """
+    Parses the command line arguments
+    :param argv: the arguments without the program name
+    :return: the parsed arguments namespace
+    """
+    parser = argparse.ArgumentParser(description='Reingests MODS XML files into the DOH Arca website.')
+    parser.add_argument('folder', help='the folder to search recursively for <repository>_<number>.xml files')
+    add_upload_arguments(parser)
+    parser.add_argument('-o', '--report', help='path of a CSV file to write the result of every object to')
+    parser.add_argument('-j', '--journal', default=journal.default_path,
+                        help='the journal of past results used to skip objects already uploaded '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-journal', action='store_true', help='neither read nor write the journal')
+    parser.add_argument('--redo', action='store_true',
+                        help='upload every object again even if the journal says it was already uploaded')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='compare every file with the MODS the website has first and only upload the '
+                             'ones that differ, needs the journal to cache what the website has')
+    parser.add_argument('--scan-threads', type=int, default=upload_core.scan_threads,
+                        help='the number of directories listed at once while scanning the folder, '
+                             'uploads start while the scan is still running (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def add_upload_arguments(parser):
+    """
+    Adds the arguments of how objects are validated and uploaded, shared
+    with the workers of a distributed reingest (see distributed.py)
+    :param parser: the argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('-u', '--username', required=True, help='the username to login with')
+    parser.add_argument('-p', '--password',
+                        help='the password to login with. Defaults to the DOH_PASSWORD environment '
+                             'variable, otherwise it is prompted for')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='the number of objects to upload concurrently to start with (default: ' +
+                             str(upload_core.initial_concurrency) + ', or ' +
+                             str(upload_core.async_initial_concurrency) + ' for the async engine)')
+    parser.add_argument('--max-threads', type=int,
+                        help='the most objects the adaptive concurrency may grow to (default: ' +
+                             str(upload_core.max_concurrency) + ', or ' +
+                             str(upload_core.async_max_concurrency) + ' for the async engine)')
+    parser.add_argument('--fixed', action='store_true',
+                        help='keep the concurrency fixed at --threads instead of adapting it to '
+                             'how quickly the website answers')
+    parser.add_argument('-e', '--engine', choices=['threads', 'async'], default='threads',
+                        help='threads uploads each object on its own thread, async keeps every object '
+                             'on one event loop sharing a pooled connection set (default: %(default)s)')
+    parser.add_argument('--backend', choices=backends.BACKENDS, default=backends.backend,
+                        help='how the MODS is replaced: scraping goes through the pages of the website, rest '
+                             'makes one request to the Islandora REST API where the website has it, mock makes '
+                             'no requests, for testing (default: %(default)s)')
+    parser.add_argument('--sessions', type=int, default=sessions.pool_size,
+                        help='the number of signed in sessions the threads engine spreads the uploads over '
+                             '(default: %(default)s)')
+    parser.add_argument('--connections', type=int,
+                        help='the size of the connection pool of the async engine (default: the concurrency)')
+    ratelimit.add_arguments(parser)
+    parser.add_argument('--retries', type=int, default=retry.max_retries,
+                        help='how many times an object is retried after server or network errors, '
+                             'with an exponential backoff (default: %(default)s)')
+    parser.add_argument('--lock-retries', type=int, default=retry.max_lock_retries,
+                        help='how many times an object locked by someone else is put back at the end of '
+                             'the queue to be tried again later (default: %(default)s)')
+    parser.add_argument('--no-validate', action='store_true',
+                        help='do not check that every file is well-formed MODS identifying the right object '
+                             'before uploading')
+    parser.add_argument('--schema', default=validation.schema_path,
+                        help='also validate every file against this MODS XML schema (.xsd), needs lxml')
+    parser.add_argument('--processes', type=int,
+                        help='the number of processes validating files (default: the number of cores)')
+    parser.add_argument('--base-url', default=upload_core.base_url,
+                        help='the base URL of the Islandora site (default: %(default)s)')
+    parser.add_argument('--metrics', action='append', default=[],
+                        help='path of a file to write the timings of every upload phase to, as JSON if it ends '
+                             'with .json and in the Prometheus text format otherwise, can be repeated')
+
+
+def check_upload_arguments(args):
+    """
+    :param args: the arguments parsed with add_upload_arguments
+    :return: what is wrong with them, or None if nothing is
+    """
+    if args.retries < 0 or args.lock_retries < 0:
+        return 'The number of retries can not be negative'
+    if (args.threads is not None and args.threads < 1) or (args.max_threads is not None and args.max_threads < 1):
+        return 'The concurrency must be at least 1'
+    if args.sessions < 1:
+        return 'The number of sessions must be at least 1'
+    error = ratelimit.check_arguments(args)
+    if error is not None:
+        return error
+    if args.schema is not None and not args.no_validate:
+        try:
+            load_schema(args.schema)
+        except Exception as e:
+            return 'Could not load the schema ' + args.schema + ': ' + str(e)
+    return None
+
+
+class ScanProgress(object):
+    """
+    Counts the files found by the folder scan
+    """
+
+    def __init__(self):
+        self.found = 0
+        self.skipped = 0
+        self.start = time.monotonic()
+        self.finished = None
+
+    def rate(self):
+        """
+        :return: the number of files found per second
+        """
+        elapsed = (self.finished or time.monotonic()) - self.start
+        return self.found / max(elapsed, 0.001)
+
+
+def find_objects(args, results_journal, progress):
+    """
+    Streams the objects to upload out of the folder as the scan finds them
+    :param args: the parsed command line arguments
+    :param results_journal: the Journal of past results, if any
+    :param progress: the ScanProgress to count found and skipped files in
+    :return: an iterator over (repository, number, path, content_hash) tuples
+    """
+    for repository, number, filename in scan_objects(args.folder, args.scan_threads):
+        progress.found = progress.found + 1
+        content_hash = None
+        if results_journal is not None:
+            content_hash = file_hash(filename)
+            if not args.redo and results_journal.is_done(repository + ':' + number, content_hash):
+                progress.skipped = progress.skipped + 1
+                continue
+        yield repository, number, filename, content_hash
+    progress.finished = time.monotonic()
+    print('Scanned ' + str(progress.found) + ' files at ' + format(progress.rate(), '.0f') + ' files/s')
+
+
+class ResultRecorder(object):
+    """
+    Records the result of every object in the CSV report and the journal
+    and counts them
+    """
+
+    def __init__(self, report=None, results_journal=None, detector=None, on_failed=None):
+        """
+        :param report: the csv.writer of the report, if any
+        :param results_journal: the Journal to record results in, if any
+        :param detector: the ChangeDetector to tell about uploaded files, if any
+        :param on_failed: optional callback called with every object that failed to upload
+        """
+        self.report = report
+        self.journal = results_journal
+        self.detector = detector
+        self.on_failed = on_failed
+        self.uploaded = 0
+        self.failed = 0
+        self.unchanged = 0
+        self.invalid = 0
+        self.retried = 0
+
+    def record(self, obj, success):
+        """
+        :param obj: the (repository, number, path, content_hash) tuple of the object
+        :param success: whether the object was uploaded
+        :return: None
+        """
+        repository, number, path, content_hash = obj
+        if success:
+            self.uploaded = self.uploaded + 1
+        else:
+            self.failed = self.failed + 1
+        if self.report is not None:
+            self.report.writerow([repository, number, path, 'uploaded' if success else 'failed'])
+        if self.journal is not None:
+            self.journal.record(repository + ':' + number, content_hash, path,
+                                journal.SUCCEEDED if success else journal.FAILED)
+        if success and self.detector is not None:
+            self.detector.uploaded(repository, number, path)
+        if not success and self.on_failed is not None:
+            self.on_failed(obj)
+
+    def record_unchanged(self, obj):
+        """
+        :param obj: the (repository, number, path, content_hash) tuple of an object
+        the website already has the same MODS for
+        :return: None
+        """
+        repository, number, path, content_hash = obj
+        self.unchanged = self.unchanged + 1
+        if self.report is not None:
+            self.report.writerow([repository, number, path, 'unchanged'])
+        if self.journal is not None:
+            self.journal.record(repository + ':' + number, content_hash, path, journal.UNCHANGED)
+
+    def record_retry(self, obj):
+        """
+        :param obj: the (repository, number, path, content_hash) tuple of an object
+        put back to be retried later
+        :return: None
+        """
+        self.retried = self.retried + 1
+
+    def record_invalid(self, obj, error):
+        """
+        :param obj: the (repository, number, path, content_hash) tuple of an object
+        whose file did not pass validation
+        :param error: what is wrong with the file
+        :return: None
+        """
+        repository, number, path, content_hash = obj
+        print('Skipping ' + path + ' as it is ' + error)
+        self.invalid = self.invalid + 1
+        if self.report is not None:
+            self.report.writerow([repository, number, path, 'invalid'])
+        if self.journal is not None:
+            self.journal.record(repository + ':' + number, content_hash, path, journal.INVALID)
+
+
+def make_controller(args):
+    """
+    Creates the concurrency controller from the command line arguments
+    :param args: the parsed command line arguments
+    :return: the concurrency.AdaptiveLimit
+    """
+    if args.engine == 'async':
+        initial, maximum = upload_core.async_initial_concurrency, upload_core.async_max_concurrency
+    else:
+        initial, maximum = upload_core.initial_concurrency, upload_core.max_concurrency
+    initial = args.threads or initial
+    maximum = args.max_threads or max(maximum, initial)
+    if args.fixed:
+        maximum = initial
+    return AdaptiveLimit(initial, maximum=maximum, adaptive=not args.fixed)
+
+
+def run_threads(args, password, objects, controller, recorder):
+    """
+    Uploads all the objects using a thread pool. Objects are taken from the
+    iterator only as fast as they are uploaded, so the scan can still be running.
+    Objects to retry wait in a RetryScheduler, not on a thread, and are
+    submitted again once due.
+    :param args: the parsed command line arguments
+    :param password: the password to login with
+    :param objects: an iterable of (repository, number, path, content_hash) tuples to upload
+    :param controller: the concurrency.AdaptiveLimit deciding how many threads upload at once
+    :param recorder: the ResultRecorder to record every result with
+    :return: True, the threads engine uses the sessions signed in by main()
+    """
+    def upload(path, repository, number):
+        controller.acquire()
+        try:
+            return upload_object(path, repository, number, controller)
+        finally:
+            controller.release()
+
+    def submit(obj):
+        futures[executor.submit(upload, obj[2], obj[0], obj[1])] = obj
+
+    def collect(done):
+        for future in done:
+            obj = futures.pop(future)
+            try:
+                outcome = future.result()
+            except Exception as e:
+                # Not retried, whatever went wrong would likely go wrong again
+                print('Could not upload ' + obj[0] + ':' + obj[1] + ': ' + (str(e) or type(e).__name__))
+                outcome = upload_core.FAILED
+            if retries.schedule(obj, obj, outcome):
+                recorder.record_retry(obj)
+            else:
+                recorder.record(obj, outcome == upload_core.UPLOADED)
+
+    retries = RetryScheduler(RetryPolicy(args.retries, args.lock_retries))
+    futures = {}
+    with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+        for obj in objects:
+            for due in retries.take_due():
+                submit(due)
+            submit(obj)
+            # Keep a little more queued than can run so the threads never wait on the scan
+            if len(futures) >= controller.maximum * 2:
+                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+        while len(futures) > 0 or retries.pending() > 0:
+            for due in retries.take_due():
+                submit(due)
+            if len(futures) > 0:
+                done, not_done = wait(futures, timeout=retries.next_due(), return_when=FIRST_COMPLETED)
+                collect(done)
+            else:
+                time.sleep(retries.next_due())
+    return True
+
+
+def run_async(args, password, objects, controller, recorder):
+    """
+    Uploads all the objects using the asyncio engine
+    :param args: the parsed command line arguments
+    :param password: the password to login with
+    :param objects: an iterable of (repository, number, path, content_hash) tuples to upload
+    :param controller: the concurrency.AdaptiveLimit deciding how many objects are in flight
+    :param recorder: the ResultRecorder to record every result with
+    :return: True, the asyncio engine uses the cookies of the session signed in by main()
+    """
+    # Imported here so the threads engine does not need aiohttp installed
+    import async_engine
+    return async_engine.run(((obj, obj[0], obj[1], obj[2]) for obj in objects),
+                            args.username, password, controller, args.connections,
+                            on_result=lambda obj, outcome: recorder.record(obj, outcome == upload_core.UPLOADED),
+                            retries=RetryPolicy(args.retries, args.lock_retries),
+                            on_retry=recorder.record_retry, cookies=session_manager.session().cookies) is not None
+
+
+def upload_changed(args, password, objects, recorder, signing_in):
+    """
+    Runs the validation and the change detection, if enabled, then uploads
+    what is valid and changed with the chosen engine
+    :param args: the parsed command line arguments
+    :param password: the password to login with
+    :param objects: an iterable of (repository, number, path, content_hash) tuples to upload
+    :param recorder: the ResultRecorder to record every result with
+    :param signing_in: the Future of the sign in running in the background
+    :return: whether the user and the upload engine could sign in
+    """
+    if not args.no_validate:
+        objects = validate_all(objects, args.processes, args.schema, on_invalid=recorder.record_invalid)
+    # Pulling the first object starts the folder scan and the validation
+    # processes, which run while the sign in finishes
+    objects = iter(objects)
+    first = next(objects, None)
+    if not signing_in.result():
+        return False
+    if first is not None:
+        objects = itertools.chain([first], objects)
+    if recorder.detector is not None:
+        objects = find_changed(objects, recorder.detector, on_unchanged=recorder.record_unchanged)
+
+    controller = make_controller(args)
+    print('Uploading with the ' + args.engine + ' engine, ' + str(controller.limit) + ' at a time' +
+          ('' if args.fixed else ' growing up to ' + str(controller.maximum)))
+    run = run_async if args.engine == 'async' else run_threads
+    signed_in = run(args, password, objects, controller, recorder)
+    print('Concurrency: ' + controller.history_text())
+    return signed_in
+
+
+def main(argv=None):
+    """
+    Entry point of the command line tool
+    :param argv: the arguments without the program name, defaults to sys.argv
+    :return: the exit code, 0 if every object was uploaded
+    """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    password = args.password or os.environ.get('DOH_PASSWORD') or getpass.getpass()
+    upload_core.base_url = args.base_url.rstrip('/')
+    backends.backend = args.backend
+
+    if args.skip_unchanged and args.no_journal:
+        print('--skip-unchanged needs the journal to cache what the website has')
+        return 2
+    error = check_upload_arguments(args)
+    if error is not None:
+        print(error)
+        return 2
+    ratelimit.configure(args.rate, args.burst, args.rate_file)
+    # A sign in failing as the website is unavailable is tried again as often as an upload
+    sessions.sign_in_retries = args.retries
+    # Signs in while the folder is scanned
+    signing_in = session_manager.start_sign_in(args.username, password, args.sessions)
+
+    results_journal = None if args.no_journal else Journal(args.journal)
+    detector = ChangeDetector(results_journal) if args.skip_unchanged else None
+    progress = ScanProgress()
+    objects = find_objects(args, results_journal, progress)
+    try:
+        if args.report:
+            with open(args.report, 'w', newline='') as f:
+                report = csv.writer(f)
+                report.writerow(['repository', 'number', 'path', 'result'])
+                recorder = ResultRecorder(report, results_journal, detector)
+                signed_in = upload_changed(args, password, objects, recorder, signing_in)
+        else:
+            recorder = ResultRecorder(None, results_journal, detector)
+            signed_in = upload_changed(args, password, objects, recorder, signing_in)
+    finally:
+        if results_journal is not None:
+            results_journal.close()
+    if not signed_in:
+        print(session_manager.failure_message())
+        return 1
+
+    if progress.found == 0:
+        print('No valid MODS XML files found in ' + args.folder)
+        return 1
+    if progress.skipped > 0:
+        print('Skipped ' + str(progress.skipped) + ' objects already uploaded according to the journal')
+    print('Finished! Uploaded ' + str(recorder.uploaded) + ' of ' + str(progress.found) + ' objects, ' +
+          str(recorder.failed) + ' failed, ' + str(recorder.unchanged) + ' unchanged, ' +
+          str(recorder.invalid) + ' invalid, after ' + str(recorder.retried) + ' retries.')
+    print(upload_core.request_counts.summary())
+    print(timings.table())
+    for path in args.metrics:
+        timings.write(path)
+    return 0 if recorder.failed == 0 and recorder.invalid == 0 else 1
+
+
+if __name__ == '__main__':
+    # Lets the validation processes start in a frozen executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Pre-flight validation stage run before any network work.
+A malformed or non-MODS file would otherwise only be found out
+after its object was locked and the file submitted, wasting the
+round trips and sometimes leaving a broken datastream behind.
+Files are parsed on a pool of processes so that every core is used,
+and can optionally be checked against the MODS XML schema, which
+needs lxml.
+"""
+import collections
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import unquote
+
+MODS_NAMESPACE = 'http://www.loc.gov/mods/v3'
+MODS_TAG = '{' + MODS_NAMESPACE + '}mods'
+IDENTIFIER_TAG = '{' + MODS_NAMESPACE + '}identifier'
+# A PID on its own or at the end of a URL e.g. https://doh.arcabc.ca/islandora/object/doh:123
+PID_PATTERN = re.compile(r'(?:^|/)([A-Za-z][\w.-]*:[\w.-]+)$')
+
+# The MODS XML schema (.xsd) files are validated against, None to only
+# check that they are well-formed MODS
+schema_path = None
+# The number of files sent to a process at once
+chunk_size = 32
+
+# The schemas this process already parsed, by path
+schemas = {}
+
+
+def load_schema(path):
+    """
+    Parses an XML schema once per process
+    :param path: the path of the .xsd file
+    :return: the lxml.etree.XMLSchema
+    """
+    schema = schemas.get(path)
+    if schema is None:
+        # Imported here so validating without a schema does not need lxml
+        from lxml import etree
+        schema = schemas[path] = etree.XMLSchema(etree.parse(path))
+    return schema
+
+
+def embedded_pids(root):
+    """
+    :param root: the mods element
+    :return: the PIDs found in the top level identifiers of the MODS. The identifiers
+    of related items are not included as they are about other objects.
+    """
+    pids = []
+    for identifier in root.findall(IDENTIFIER_TAG):
+        match = PID_PATTERN.search(unquote((identifier.text or '').strip()))
+        if match is not None:
+            pids.append(match.group(1))
+    return pids
+
+
+def validate_file(path, repo, num, schema_file=None):
+    """
+    Checks that a file is well-formed MODS, valid against the schema if one
+    is given, and that the PID it has in its identifiers, if any, is the
+    one its name says
+    :param path: the path of the MODS XML file
+    :param repo: the repository namespace parsed from the file name
+    :param num: the number of the object parsed from the file name
+    :param schema_file: the path of the MODS XML schema, if any
+    :return: None if the file is valid, otherwise what is wrong with it
+    """
+    try:
+        if schema_file is None:
+            tree = ElementTree.parse(path)
+        else:
+            from lxml import etree
+            schema = load_schema(schema_file)
+            tree = etree.parse(path)
+    except Exception as e:
+        return 'not well-formed XML: ' + str(e)
+    root = tree.getroot()
+    if root.tag != MODS_TAG:
+        return 'not MODS, its root element is ' + str(root.tag) + ' rather than ' + MODS_TAG
+    if schema_file is not None and not schema.validate(tree):
+        return 'not valid MODS: ' + str(schema.error_log.last_error)
+    pid = repo + ':' + num
+    pids = embedded_pids(root)
+    if len(pids) > 0 and pid not in pids:
+        return 'identified as ' + pids[0] + ' rather than ' + pid
+    return None
+
+
+def validate_files(files, schema_file=None):
+    """
+    Validates a chunk of files, runs in the worker processes
+    :param files: a list of (path, repository, number) tuples
+    :param schema_file: the path of the MODS XML schema, if any
+    :return: the list of results of validate_file, in the same order
+    """
+    return [validate_file(path, repo, num, schema_file) for path, repo, num in files]
+
+
+def validate_all(objects, processes=None, schema_file=None, on_invalid=None):
+    """
+    Validates objects on a process pool, streaming the valid ones out in
+    the original order as soon as they are checked
+    :param objects: an iterable of tuples starting with (repository, number, path)
+    :param processes: the number of processes, defaults to the number of cores
+    :param schema_file: the path of the MODS XML schema, if any
+    :param on_invalid: optional callback called with every invalid object and what is wrong with it
+    :return: an iterator over the valid objects
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    processes = processes or os.cpu_count() or 1
+    # Spawned rather than forked as the uploaders have threads
+    # running, and so it works the same on every platform
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        pending = collections.deque()
+
+        def submit(chunk):
+            files = [(obj[2], obj[0], obj[1]) for obj in chunk]
+            pending.append((chunk, executor.submit(validate_files, files, schema_file)))
+
+        def collect():
+            chunk, future = pending.popleft()
+            for obj, error in zip(chunk, future.result()):
+                if error is None:
+                    yield obj
+                elif on_invalid is not None:
+                    on_invalid(obj, error)
+
+        chunk = []
+        for obj in objects:
+            chunk.append(obj)
+            if len(chunk) == chunk_size:
+                submit(chunk)
+                chunk = []
+            # Hand over what is already checked, keeping every process busy
+            while len(pending) > 0 and (pending[0][1].done() or len(pending) >= processes * 2):
+                yield from collect()
+        if len(chunk) > 0:
+            submit(chunk)
+        while len(pending) > 0:
+            yield from collect()
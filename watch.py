@@ -0,0 +1,555 @@
+"""
+Watch mode: uploads MODS XML files as they are dropped or edited in a
+folder, instead of pushing the whole folder again as one batch.
+Changes are noticed with inotify on Linux, read through ctypes so no
+extra package is needed, and by comparing the size and modification
+time of every file at an interval elsewhere or on network shares, where
+inotify does not see what other machines write. A file is handed over
+once it has gone without writes for a little while, so a burst of saves
+or a large copy only uploads it once, and only if its content is not
+what was last uploaded (see journal.Journal.is_done).
+
+Example:
+    python watch.py /share/UpdatedXML -u "Jane Doe" -o uploads.csv
+    python watch.py /share/UpdatedXML -u "Jane Doe" --poll --poll-interval 30
+"""
+import argparse
+import csv
+import ctypes
+import ctypes.util
+import getpass
+import os
+import select
+import struct
+import sys
+import time
+
+import backends
+import journal
+import ratelimit
+import sessions
+import upload_core
+import uploader_cli
+from change_detection import ChangeDetector, find_changed
+from journal import Journal, file_hash
+from metrics import timings
+from upload_core import session_manager, parse_object_id
+from validation import validate_file
+
+# How long a file must go without writes before it is uploaded, in seconds
+debounce = 2.0
+# How often the folder is listed when polling, in seconds
+poll_interval = 5.0
+# Whether inotify is used where it is available, rather than polling
+use_inotify = True
+# The max number of files handed over at once
+batch_size = 500
+
+"""
+inotify constants, see inotify(7)
+"""
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# The fixed part of an event: watch descriptor, mask, cookie and length of the name
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_xml_name(name):
+    """
+    :param name: the name of a file, without its directory
+    :return: whether it is a file the uploads read, hidden files being skipped like the folder scan does
+    """
+    return name.endswith('.xml') and not name.startswith('.')
+
+
+def stat_tree(folder):
+    """
+    Lists the XML files of a folder recursively with their size and modification time
+    :param folder: the root folder
+    :return: a dict of (size, modification time in ns) by path
+    """
+    files = {}
+    directories = [folder]
+    while len(directories) > 0:
+        directory = directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        directories.append(entry.path)
+                    elif is_xml_name(entry.name):
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError as e:
+            print('Could not read ' + directory + ': ' + str(e))
+    return files
+
+
+class PollingSource(object):
+    """
+    Finds the files written to by comparing listings of the folder taken at an interval
+    """
+
+    name = 'polling'
+
+    def __init__(self, folder, interval=None):
+        """
+        :param folder: the root folder to watch
+        :param interval: how often the folder is listed, in seconds, defaults to poll_interval
+        """
+        self.folder = folder
+        self.interval = poll_interval if interval is None else interval
+        self.files = stat_tree(folder)
+        self.next_poll = time.monotonic() + self.interval
+
+    def read(self, timeout):
+        """
+        Waits for writes
+        :param timeout: the max number of seconds to wait
+        :return: the paths of the files written to, possibly none
+        """
+        wait = self.next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(wait, 0))
+        self.next_poll = time.monotonic() + self.interval
+        files = stat_tree(self.folder)
+        changed = [path for path, stat in files.items() if self.files.get(path) != stat]
+        self.files = files
+        return changed
+
+    def close(self):
+        """
+        :return: None
+        """
+        self.files = {}
+
+
+class InotifySource(object):
+    """
+    Finds the files written to with inotify, watching every directory of the folder
+    """
+
+    name = 'inotify'
+
+    def __init__(self, folder):
+        """
+        :param folder: the root folder to watch
+        :raises OSError: if inotify is not available or the directories can not all be watched,
+        e.g. past fs.inotify.max_user_watches
+        """
+        library = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # The watched directory of every watch descriptor
+        self.directories = {}
+        self.folder = folder
+        try:
+            self.watch_tree(folder)
+        except OSError:
+            self.close()
+            raise
+
+    def watch(self, directory):
+        """
+        :param directory: a directory to watch, without its subdirectories
+        :return: None
+        :raises OSError: if it can not be watched
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'could not watch ' + directory + ': ' + os.strerror(error))
+        self.directories[wd] = directory
+
+    def watch_tree(self, folder):
+        """
+        Watches a directory and every directory in it
+        :param folder: the root directory
+        :return: the paths of the XML files already in it
+        """
+        files = []
+        directories = [folder]
+        while len(directories) > 0:
+            directory = directories.pop()
+            # Watched before it is listed so nothing written in between is missed
+            self.watch(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir():
+                            directories.append(entry.path)
+                        elif is_xml_name(entry.name):
+                            files.append(entry.path)
+            except OSError as e:
+                print('Could not read ' + directory + ': ' + str(e))
+        return files
+
+    def read(self, timeout):
+        """
+        Waits for writes
+        :param timeout: the max number of seconds to wait
+        :return: the paths of the files written to, possibly none
+        """
+        readable, writable, failed = select.select([self.fd], [], [], max(timeout, 0))
+        if len(readable) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset = offset + EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset = offset + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, every file may have been written to
+                print('Too many changes at once, listing ' + self.folder + ' again')
+                changed.extend(stat_tree(self.folder))
+                continue
+            if mask & IN_IGNORED:
+                # The directory was deleted or moved away
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        changed.extend(self.watch_tree(path))
+                    except OSError as e:
+                        print(str(e) + ', files written in it are only noticed on a restart')
+            elif is_xml_name(name):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        """
+        :return: None
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def open_source(folder, poll=False, interval=None):
+    """
+    :param folder: the root folder to watch
+    :param poll: whether to poll even where inotify is available
+    :param interval: how often the folder is listed when polling, defaults to poll_interval
+    :return: an InotifySource, or a PollingSource if inotify is not available
+    """
+    if use_inotify and not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifySource(folder)
+        except Exception as e:
+            print('Could not use inotify, polling instead: ' + str(e))
+    return PollingSource(folder, interval)
+
+
+class Debouncer(object):
+    """
+    Holds paths back until they have gone without events for a while
+    """
+
+    def __init__(self, quiet):
+        """
+        :param quiet: the number of seconds a path must go without events
+        """
+        self.quiet = quiet
+        # When each path last had an event
+        self.pending = {}
+
+    def add(self, paths, now):
+        """
+        :param paths: the paths that had an event
+        :param now: the time.monotonic() of the events
+        :return: None
+        """
+        for path in paths:
+            self.pending[path] = now
+
+    def ready(self, now, limit=None):
+        """
+        Takes the paths that have been quiet long enough
+        :param now: the current time.monotonic()
+        :param limit: the max number of paths to take, None for all of them
+        :return: the paths, oldest first
+        """
+        ready = sorted((last, path) for path, last in self.pending.items() if now - last >= self.quiet)
+        ready = [path for last, path in ready[:limit]]
+        for path in ready:
+            del self.pending[path]
+        return ready
+
+    def next_ready(self, now):
+        """
+        :param now: the current time.monotonic()
+        :return: the number of seconds until a path is ready, or None if none is pending
+        """
+        if len(self.pending) == 0:
+            return None
+        return max(min(self.pending.values()) + self.quiet - now, 0)
+
+
+class FolderWatcher(object):
+    """
+    The objects of a folder whose files changed, for watch mode. Files are hashed
+    on the thread calling changes(), so that is best not the GUI thread.
+    """
+
+    def __init__(self, folder, is_done=None, known=None, since=None, poll=False, interval=None, quiet=None):
+        """
+        :param folder: the root folder to watch
+        :param is_done: optional function called with the PID and content hash of a file
+        returning whether it is what was last uploaded, e.g. journal.Journal.is_done
+        :param known: optional dict of the content hash by path of the files already
+        handed to the uploads, e.g. by a folder scan
+        :param since: optional time.time(), the files modified since are handed over
+        too e.g. the start of the folder scan, 0 for every file
+        :param poll: whether to poll even where inotify is available
+        :param interval: how often the folder is listed when polling, defaults to poll_interval
+        :param quiet: how long a file must go without writes, defaults to debounce
+        """
+        self.is_done = is_done
+        self.known = dict(known or {})
+        self.debouncer = Debouncer(debounce if quiet is None else quiet)
+        self.source = open_source(folder, poll, interval)
+        if since is not None:
+            # Listed after the source is open so nothing written in between is missed
+            self.debouncer.add([path for path, (size, mtime) in stat_tree(folder).items()
+                                if mtime >= since * 1e9], time.monotonic())
+
+    def changes(self, timeout):
+        """
+        Waits for files whose content changed
+        :param timeout: the max number of seconds to wait
+        :return: a list of (repository, number, path, content_hash) tuples, possibly empty
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            objects = self.changed_objects(self.debouncer.ready(now, batch_size))
+            if len(objects) > 0:
+                return objects
+            wait = deadline - now
+            next_ready = self.debouncer.next_ready(now)
+            if next_ready is not None:
+                wait = min(wait, next_ready)
+            if wait <= 0 and next_ready != 0:
+                return []
+            self.debouncer.add(self.source.read(wait), time.monotonic())
+
+    def changed_objects(self, paths):
+        """
+        :param paths: the paths of files that were written to
+        :return: the (repository, number, path, content_hash) tuples of the ones whose
+        content is not what was last handed over, nor what was last uploaded for the
+        files not handed over yet
+        """
+        objects = []
+        for path in paths:
+            try:
+                repository, number = parse_object_id(path)
+            except Exception as e:
+                print('Skipping ' + path + ' as its name is not <repository>_<number>.xml')
+                continue
+            try:
+                content_hash = file_hash(path)
+            except OSError:
+                # Deleted or moved away since
+                continue
+            handed_over = self.known.get(path)
+            if handed_over == content_hash:
+                continue
+            self.known[path] = content_hash
+            # Once a version was handed over, the journal may not know yet it is the one the
+            # website has, so a file reverted to what was uploaded before is uploaded again
+            if handed_over is None and self.is_done is not None and \
+                    self.is_done(repository + ':' + number, content_hash):
+                continue
+            objects.append((repository, number, path, content_hash))
+        return objects
+
+    def forget(self, path, content_hash):
+        """
+        Forgets that a version of a file was handed over, after its upload failed,
+        so that saving the file again uploads it even if its content is the same
+        :param path: the path of the file
+        :param content_hash: the content hash of the version that failed
+        :return: None
+        """
+        if self.known.get(path) == content_hash:
+            del self.known[path]
+
+    def close(self):
+        """
+        Stops watching
+        :return: None
+        """
+        self.source.close()
+
+
+def upload_batch(args, password, objects, controller, recorder):
+    """
+    Validates the changed objects and uploads the valid ones, and only the ones
+    that differ from the website if asked to. Files are validated on this thread
+    as a batch is usually a handful of files, not worth starting processes for.
+    :param args: the parsed command line arguments
+    :param password: the password to login with
+    :param objects: a list of (repository, number, path, content_hash) tuples
+    :param controller: the concurrency.AdaptiveLimit shared by every batch
+    :param recorder: the uploader_cli.ResultRecorder to record every result with
+    :return: whether the upload engine could sign in
+    """
+    valid = []
+    for obj in objects:
+        error = None if args.no_validate else validate_file(obj[2], obj[0], obj[1], args.schema)
+        if error is None:
+            valid.append(obj)
+        else:
+            recorder.record_invalid(obj, error)
+    changed = valid
+    if recorder.detector is not None:
+        changed = find_changed(valid, recorder.detector, on_unchanged=recorder.record_unchanged)
+    run = uploader_cli.run_async if args.engine == 'async' else uploader_cli.run_threads
+    return run(args, password, changed, controller, recorder)
+
+
+def watch(args, password, watcher, recorder, report_file=None):
+    """
+    Uploads the changed files until interrupted
+    :param args: the parsed command line arguments
+    :param password: the password to login with
+    :param watcher: the FolderWatcher of the folder
+    :param recorder: the uploader_cli.ResultRecorder to record every result with
+    :param report_file: the file of the CSV report, flushed after every batch, if any
+    :return: whether the upload engine could sign in
+    """
+    controller = uploader_cli.make_controller(args)
+    while True:
+        objects = watcher.changes(60.0)
+        if len(objects) == 0:
+            continue
+        before = (recorder.uploaded, recorder.failed, recorder.unchanged, recorder.invalid)
+        start = time.monotonic()
+        if not upload_batch(args, password, objects, controller, recorder):
+            return False
+        if report_file is not None:
+            report_file.flush()
+        counts = [now - then for now, then in
+                  zip((recorder.uploaded, recorder.failed, recorder.unchanged, recorder.invalid), before)]
+        print(time.strftime('%H:%M:%S') + ' ' + str(len(objects)) + ' changed files: ' + str(counts[0]) +
+              ' uploaded, ' + str(counts[1]) + ' failed, ' + str(counts[2]) + ' unchanged, ' + str(counts[3]) +
+              ' invalid in ' + format(time.monotonic() - start, '.1f') + ' s')
+
+
+def main(argv=None):
+    """
+    Entry point of watch mode
+    :param argv: the arguments without the program name, defaults to sys.argv
+    :return: the exit code
+    """
+    parser = argparse.ArgumentParser(description='Watches a folder and uploads the MODS XML files dropped or '
+                                                 'edited in it to the DOH Arca website as they change.')
+    parser.add_argument('folder', help='the folder to watch recursively for <repository>_<number>.xml files')
+    uploader_cli.add_upload_arguments(parser)
+    parser.add_argument('-o', '--report', help='path of a CSV file to append the result of every object to')
+    parser.add_argument('-j', '--journal', default=journal.default_path,
+                        help='the journal of past results, files already uploaded are not uploaded again '
+                             '(default: %(default)s)')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='compare every changed file with the MODS the website has first and only upload '
+                             'the ones that differ')
+    parser.add_argument('--debounce', type=float, default=debounce,
+                        help='how long a file must go without writes before it is uploaded, in seconds '
+                             '(default: %(default)s)')
+    parser.add_argument('--poll', action='store_true',
+                        help='list the folder at an interval instead of using inotify, needed on network shares '
+                             'written to from other machines')
+    parser.add_argument('--poll-interval', type=float, default=poll_interval,
+                        help='how often the folder is listed when polling, in seconds (default: %(default)s)')
+    parser.add_argument('--changed-only', action='store_true',
+                        help='only upload files changed from now on, not the ones already in the folder that '
+                             'the journal does not have as uploaded')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    password = args.password or os.environ.get('DOH_PASSWORD') or getpass.getpass()
+    upload_core.base_url = args.base_url.rstrip('/')
+    backends.backend = args.backend
+
+    error = uploader_cli.check_upload_arguments(args)
+    if error is None and (args.debounce < 0 or args.poll_interval <= 0):
+        error = 'The debounce can not be negative and the poll interval must be positive'
+    if error is not None:
+        print(error)
+        return 2
+    ratelimit.configure(args.rate, args.burst, args.rate_file)
+    # A sign in failing as the website is unavailable is tried again as often as an upload
+    sessions.sign_in_retries = args.retries
+    if not os.path.isdir(args.folder):
+        print('No such folder: ' + args.folder)
+        return 2
+    signing_in = session_manager.start_sign_in(args.username, password, args.sessions)
+    results_journal = Journal(args.journal)
+    detector = ChangeDetector(results_journal) if args.skip_unchanged else None
+    report_file = None
+    try:
+        # Files dropped while not watching are uploaded first, unless already uploaded
+        watcher = FolderWatcher(args.folder, results_journal.is_done, since=None if args.changed_only else 0,
+                                poll=args.poll, interval=args.poll_interval, quiet=args.debounce)
+        if not signing_in.result():
+            print(session_manager.failure_message())
+            return 1
+        report = None
+        if args.report:
+            new = not os.path.exists(args.report)
+            report_file = open(args.report, 'a', newline='')
+            report = csv.writer(report_file)
+            if new:
+                report.writerow(['repository', 'number', 'path', 'result'])
+        recorder = uploader_cli.ResultRecorder(report, results_journal, detector,
+                                               on_failed=lambda obj: watcher.forget(obj[2], obj[3]))
+        print('Watching ' + args.folder + ' with ' + watcher.source.name + ', press Ctrl+C to stop')
+        try:
+            if not watch(args, password, watcher, recorder, report_file):
+                print(session_manager.failure_message())
+                return 1
+        except KeyboardInterrupt:
+            print('Stopped. Uploaded ' + str(recorder.uploaded) + ' objects, ' + str(recorder.failed) +
+                  ' failed, ' + str(recorder.unchanged) + ' unchanged, ' + str(recorder.invalid) + ' invalid.')
+        finally:
+            watcher.close()
+    finally:
+        if report_file is not None:
+            report_file.close()
+        results_journal.close()
+    print(timings.table())
+    for path in args.metrics:
+        timings.write(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())